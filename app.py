@@ -1,18 +1,40 @@
 # Note: unchanged server except version bump to reflect UI update
+import atexit
+import contextlib
+import bisect
 import csv
+import errno
+import gzip
+import hashlib
+import heapq
+import io
+import ipaddress
 import json
+import lzma
+import math
+import multiprocessing
 import os
+import queue
+import random
 import re
+import selectors
+import shutil
 import socket
+import sqlite3
+import struct
 import subprocess
 import threading
 import time
+import urllib3
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Any, Tuple, Optional, List
+from typing import Dict, Any, Tuple, Optional, List, Iterable, Set
 
 import requests
-from flask import Flask, request, jsonify, send_file, session, render_template, abort, make_response
+from flask import Flask, Response, request, jsonify, send_file, session, render_template, abort, make_response, g
 from werkzeug.utils import secure_filename
 
 PDFIUM_IMPORT_ERROR = ""
@@ -22,6 +44,12 @@ except Exception as _e:
     pdfium = None
     PDFIUM_IMPORT_ERROR = repr(_e)
 
+try:
+    from PIL import Image, features as pil_features
+except Exception:
+    Image = None
+    pil_features = None
+
 APP_NAME = os.getenv("APP_NAME", "Ford Device Dashboard")
 APP_VERSION = "2025.11.13-storage-inventory.v2"
 
@@ -51,11 +79,68 @@ def user_data_dir() -> Path:
 DATA_DIR = user_data_dir()
 LOG_DIR = DATA_DIR / "logs"
 MAPS_DIR = DATA_DIR / "maps"
+SERIES_DIR = LOG_DIR / "series"
+TILES_DIR = MAPS_DIR / "tiles"
+SOURCES_DIR = MAPS_DIR / "sources"
+RENDER_CACHE_DIR = MAPS_DIR / "render-cache"
 STATE_FILE = DATA_DIR / "state.json"
+PROBE_STATE_FILE = DATA_DIR / "probe-state.json"
+DB_FILE = DATA_DIR / "pc-monitor.db"
 SECRET_FILE = DATA_DIR / ".flask_secret"
 
 AUTH_EPOCH = os.urandom(8).hex()
 PING_PERIOD_SECONDS = 15 * 60
+STATE_FLUSH_SECONDS = float(os.getenv("STATE_FLUSH_SECONDS", "5"))
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()               # json | sqlite
+LOG_FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", "2"))
+LOG_BUFFER_ROWS = int(os.getenv("LOG_BUFFER_ROWS", "500"))
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "gzip").lower()                     # gzip | lzma | none
+LOG_RAW_DAYS = max(1, int(os.getenv("LOG_RAW_DAYS", "30")))                 # full-resolution probes, then hourly
+LOG_RETENTION_DAYS = max(LOG_RAW_DAYS, int(os.getenv("LOG_RETENTION_DAYS", "365")))
+LOG_MAINTENANCE_SECONDS = int(os.getenv("LOG_MAINTENANCE_SECONDS", "3600"))
+HISTORY_RAW_MAX_DAYS = int(os.getenv("HISTORY_RAW_MAX_DAYS", "7"))          # res=auto switches to hourly beyond this
+ROLLUP_HOURS = int(os.getenv("ROLLUP_HOURS", "48"))
+ROLLUP_DAYS = int(os.getenv("ROLLUP_DAYS", "30"))
+CHANGE_LOG_SIZE = int(os.getenv("CHANGE_LOG_SIZE", "5000"))
+PUBLIC_SNAPSHOT_SECONDS = float(os.getenv("PUBLIC_SNAPSHOT_SECONDS", "1"))  # max staleness of public views
+SSE_HEARTBEAT_SECONDS = 15
+MAP_TILE_SIZE = 256
+MAP_RENDER_WORKERS = int(os.getenv("MAP_RENDER_WORKERS", "1"))
+JOB_HISTORY = 200
+MAP_DEFAULT_DPI = 220
+MAP_DPI_MIN, MAP_DPI_MAX = 36, 600
+RENDER_CACHE_MB = int(os.getenv("RENDER_CACHE_MB", "512"))
+MAP_PREVIEW_PX = int(os.getenv("MAP_PREVIEW_PX", "1024"))
+PROBE_BACKEND = os.getenv("PROBE_BACKEND", "native").lower()               # native | subprocess
+PING_WORKERS = int(os.getenv("PING_WORKERS", "64"))
+PING_FLOOR_CONCURRENCY = int(os.getenv("PING_FLOOR_CONCURRENCY", "0"))      # 0 = no per-floor cap
+PING_SUBNET_CONCURRENCY = int(os.getenv("PING_SUBNET_CONCURRENCY", "0"))    # 0 = no per-subnet cap
+PING_SUBNET_PREFIX = int(os.getenv("PING_SUBNET_PREFIX", "24"))
+PING_SWEEP_DEADLINE_SECONDS = int(os.getenv("PING_SWEEP_DEADLINE_SECONDS", str(PING_PERIOD_SECONDS - 60)))
+PING_CACHE_SECONDS = float(os.getenv("PING_CACHE_SECONDS", "5"))             # /api/ping/<id> reuses results this fresh
+PROBE_INTERVAL_SECONDS = int(os.getenv("PROBE_INTERVAL_SECONDS", str(PING_PERIOD_SECONDS)))
+PROBE_CATEGORY_INTERVALS = {k.strip(): int(v) for k, v in
+                            (p.split("=", 1) for p in os.getenv("PROBE_CATEGORY_INTERVALS", "").split(",") if "=" in p)}
+PROBE_JITTER = float(os.getenv("PROBE_JITTER", "0.1"))                      # +/- fraction of the interval
+PROBE_RECHECK_SECONDS = int(os.getenv("PROBE_RECHECK_SECONDS", "30"))
+PROBE_BACKOFF_AFTER = int(os.getenv("PROBE_BACKOFF_AFTER", "10"))           # consecutive downs before backing off
+PROBE_BACKOFF_MAX_SECONDS = int(os.getenv("PROBE_BACKOFF_MAX_SECONDS", "3600"))
+PROBE_STARTUP_SPREAD_SECONDS = int(os.getenv("PROBE_STARTUP_SPREAD_SECONDS", "60"))
+CHECK_TYPES = ("icmp", "tcp", "tcp_multi", "http")
+CHECK_TIMEOUT_MS = int(os.getenv("CHECK_TIMEOUT_MS", "2000"))               # default per-check timeout
+HTTP_CHECK_MAX_BODY = int(os.getenv("HTTP_CHECK_MAX_BODY", str(64 * 1024)))  # bytes read for body matching
+DISCOVERY_MAX_HOSTS = int(os.getenv("DISCOVERY_MAX_HOSTS", "4096"))
+DISCOVERY_CONCURRENCY = int(os.getenv("DISCOVERY_CONCURRENCY", "256" if os.name == "nt" else "512"))  # sockets in flight
+DISCOVERY_TIMEOUT_MS = int(os.getenv("DISCOVERY_TIMEOUT_MS", "300"))
+DISCOVERY_PORTS = [int(p) for p in os.getenv("DISCOVERY_PORTS", "22,80,443,445,3389,5900,7000,8008,62078").split(",") if p.strip()]
+DISCOVERY_FINGERPRINTS = {cat.strip(): {int(p) for p in ports.split(",") if p.strip()} for cat, ports in
+                          (x.split(":", 1) for x in os.getenv("DISCOVERY_FINGERPRINTS",
+                                                              "brightsign:8008;apple:62078,7000,3689,548").split(";") if ":" in x)}
+ALERT_DOWN_AFTER = max(1, int(os.getenv("ALERT_DOWN_AFTER", "2")))          # consecutive failures before alerting
+ALERT_BATCH_SECONDS = float(os.getenv("ALERT_BATCH_SECONDS", "10"))
+ALERT_DIGEST_LINES = int(os.getenv("ALERT_DIGEST_LINES", "20"))
+ALERT_RETRIES = int(os.getenv("ALERT_RETRIES", "4"))
+ALERT_QUEUE_SIZE = int(os.getenv("ALERT_QUEUE_SIZE", "10000"))
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 if SECRET_FILE.exists():
@@ -66,9 +151,143 @@ else:
     app.secret_key = sec
 app.config.update(SESSION_COOKIE_HTTPONLY=True, SESSION_COOKIE_SAMESITE="Lax")
 
-state_lock = threading.RLock()
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SWEEP_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+class Metrics:
+    """Minimal counter/histogram registry rendered in Prometheus text format.
+
+    Recording is a dict lookup, a bisect and a few adds under one lock, so
+    it is cheap enough for the probe path. Gauges are computed at scrape
+    time by registered callbacks.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str, Tuple[str, ...], Tuple[float, ...]]] = {}
+        self._counters: Dict[Tuple[str, Tuple[str, ...]], float] = {}
+        self._hists: Dict[Tuple[str, Tuple[str, ...]], List[Any]] = {}
+        self._gauges: List[Any] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self._meta[name] = ("counter", help, labels, ())
+
+    def histogram(self, name: str, help: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self._meta[name] = ("histogram", help, labels, buckets)
+
+    def gauge(self, name: str, help: str, labels: Tuple[str, ...], fn) -> None:
+        """``fn()`` returns {label values tuple: value} when scraped."""
+        self._meta[name] = ("gauge", help, labels, ())
+        self._gauges.append((name, fn))
+
+    def inc(self, name: str, labels: Tuple[str, ...] = (), v: float = 1) -> None:
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + v
+
+    def observe(self, name: str, labels: Tuple[str, ...], v: float) -> None:
+        key = (name, labels)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(self._meta[name][3]) + 1), 0.0, 0]
+            h[0][bisect.bisect_left(self._meta[name][3], v)] += 1
+            h[1] += v
+            h[2] += 1
+
+    @staticmethod
+    def _labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+        parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                 for k, v in zip(names, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        gauges = {}
+        for name, fn in self._gauges:
+            try: gauges[name] = fn()
+            except Exception as e: print("Metrics gauge failed:", name, e)
+        with self._lock:
+            counters = dict(self._counters)
+            hists = {k: [list(h[0]), h[1], h[2]] for k, h in self._hists.items()}
+        out = []
+        for name, (kind, help, lnames, buckets) in sorted(self._meta.items()):
+            out.append(f"# HELP {name} {help}")
+            out.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                rows = [(lv, v) for (n, lv), v in sorted(counters.items()) if n == name]
+                for lv, v in rows or ([((), 0)] if not lnames else []):
+                    out.append(f"{name}{self._labels(lnames, lv)} {v:g}")
+            elif kind == "gauge":
+                for lv, v in sorted(gauges.get(name, {}).items()):
+                    out.append(f"{name}{self._labels(lnames, lv)} {v:g}")
+            else:
+                for (n, lv), (counts, total, count) in sorted(hists.items()):
+                    if n != name:
+                        continue
+                    acc = 0
+                    for le, c in zip(list(buckets) + ["+Inf"], counts):
+                        acc += c
+                        bucket = self._labels(lnames, lv, 'le="%s"' % le)
+                        out.append(f"{name}_bucket{bucket} {acc}")
+                    out.append(f"{name}_sum{self._labels(lnames, lv)} {total:g}")
+                    out.append(f"{name}_count{self._labels(lnames, lv)} {count}")
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+METRICS.histogram("pcmon_probe_duration_seconds", "Device check duration by check type and result.", ("check", "result"))
+METRICS.histogram("pcmon_sweep_duration_seconds", "Wall time of full sweeps.", (), SWEEP_BUCKETS)
+METRICS.counter("pcmon_sweep_overruns_total", "Sweeps that hit their deadline.")
+METRICS.counter("pcmon_probes_deduplicated_total", "Probe requests answered without a new check.", ("source",))
+METRICS.histogram("pcmon_save_state_seconds", "save_state duration on the caller (snapshot and hand-off).")
+METRICS.histogram("pcmon_state_write_seconds", "Duration of one state file write.", ("file",))
+METRICS.counter("pcmon_state_write_bytes_total", "Bytes written to state files.", ("file",))
+METRICS.histogram("pcmon_append_log_seconds", "append_log duration on the probe path.")
+METRICS.histogram("pcmon_log_flush_seconds", "Ping log buffer flush duration.")
+METRICS.counter("pcmon_log_write_bytes_total", "Bytes written to the daily ping logs.")
+METRICS.histogram("pcmon_state_lock_wait_seconds", "Time spent waiting to acquire state_lock.")
+METRICS.histogram("pcmon_state_lock_hold_seconds", "Time state_lock was held (outermost acquisition).")
+METRICS.histogram("pcmon_http_request_seconds", "Request latency by route, method and status.", ("route", "method", "status"))
+METRICS.counter("pcmon_alert_messages_total", "Alert webhook posts by outcome.", ("outcome",))
+METRICS.counter("pcmon_alert_retries_total", "Alert webhook retries.")
+METRICS.counter("pcmon_alerts_dropped_total", "Alerts dropped because the queue was full.")
+METRICS.histogram("pcmon_alert_delivery_seconds", "Time from an alert being queued to its delivery.", (), SWEEP_BUCKETS[:4] + (30, 60, 120))
+
+class TimedRLock:
+    """RLock that records wait and hold times of its outermost acquisitions."""
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            ok = self._lock.acquire(blocking, timeout)
+        else:
+            t0 = time.perf_counter()
+            ok = self._lock.acquire(blocking, timeout)
+            if ok:
+                self._local.t = time.perf_counter()
+                METRICS.observe("pcmon_state_lock_wait_seconds", (), self._local.t - t0)
+        if ok:
+            self._local.depth = depth + 1
+        return ok
+
+    def release(self) -> None:
+        self._local.depth -= 1
+        held = time.perf_counter() - self._local.t if self._local.depth == 0 else None
+        self._lock.release()
+        if held is not None:
+            METRICS.observe("pcmon_state_lock_hold_seconds", (), held)
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+state_lock = TimedRLock()
 STATE: Dict[str, Any] = {}
-NEXT_PING_AT_UTC: Optional[datetime] = None
 
 def require_password() -> str:
     pw = os.getenv("PASSWORD", "")
@@ -83,7 +302,60 @@ def require_auth():
     if not authed():
         abort(401)
 
-def load_state() -> Dict[str, Any]:
+class MachineIndex:
+    """Secondary indexes over STATE["machines"]: floor -> ids, category -> ids, storage ids.
+
+    Kept in step with every write (create, update, delete, import, load) so
+    per-floor and storage views cost O(result) instead of a fleet scan.
+    Index sets are insertion-ordered dicts so views keep a stable order.
+    Callers hold state_lock.
+    """
+    def __init__(self):
+        self.by_floor: Dict[str, Dict[str, None]] = {}
+        self.by_category: Dict[str, Dict[str, None]] = {}
+        self.storage: Dict[str, None] = {}
+        self._keys: Dict[str, Tuple[str, str, bool]] = {}
+
+    @staticmethod
+    def _key(m: Dict[str, Any]) -> Tuple[str, str, bool]:
+        return (m.get("floor_id") or "", m.get("category") or "global", bool(m.get("operational", True)))
+
+    def add(self, mid: str, m: Dict[str, Any]) -> None:
+        """Index a new or updated machine; unchanged keys keep their position."""
+        key = self._key(m)
+        if self._keys.get(mid) == key:
+            return
+        self.remove(mid)
+        self._keys[mid] = key
+        self.by_floor.setdefault(key[0], {})[mid] = None
+        self.by_category.setdefault(key[1], {})[mid] = None
+        if not key[2]:
+            self.storage[mid] = None
+
+    def remove(self, mid: str) -> None:
+        key = self._keys.pop(mid, None)
+        if key is None:
+            return
+        for table, k in ((self.by_floor, key[0]), (self.by_category, key[1])):
+            ids = table.get(k)
+            if ids is not None:
+                ids.pop(mid, None)
+                if not ids:
+                    del table[k]
+        self.storage.pop(mid, None)
+
+    def rebuild(self, machines: Dict[str, Dict[str, Any]]) -> None:
+        self.by_floor.clear(); self.by_category.clear(); self.storage.clear(); self._keys.clear()
+        for mid, m in machines.items():
+            self.add(mid, m)
+
+    def on_floor(self, fid: str) -> Iterable[str]:
+        return self.by_floor.get(fid, {}).keys()
+
+INDEX = MachineIndex()
+
+def read_state_files() -> Dict[str, Any]:
+    """state.json with the probe counters from probe-state.json merged in."""
     if STATE_FILE.exists():
         try:
             st = json.loads(STATE_FILE.read_text(encoding="utf-8"))
@@ -92,6 +364,21 @@ def load_state() -> Dict[str, Any]:
     else:
         st = {}
     st.setdefault("machines", {})
+    if PROBE_STATE_FILE.exists():
+        try:
+            probes = json.loads(PROBE_STATE_FILE.read_text(encoding="utf-8"))
+        except Exception:
+            probes = {}
+        for mid, vals in probes.items():
+            if mid in st["machines"] and isinstance(vals, dict):
+                st["machines"][mid].update(vals)
+    return st
+
+def load_state() -> Dict[str, Any]:
+    st = STORE.load() if STORE is not None else None
+    migrate = STORE is not None and st is None
+    if st is None:
+        st = read_state_files()
     st.setdefault("floors", [{
         "id": "main",
         "name": "Floor 1",
@@ -110,17 +397,528 @@ def load_state() -> Dict[str, Any]:
         m.setdefault("floor_id", st["default_floor_id"])
         m.setdefault("check", "icmp")
         m.setdefault("tcp_port", 0)
+        m.setdefault("probe_interval_s", 0)
+        for k, v in check_settings({}).items():
+            m.setdefault(k, v)
         m.setdefault("os", "")
         m.setdefault("category", "global")
         m.setdefault("operational", True)
         if m["category"] not in CATEGORIES:
             m["category"] = "global"
+    if migrate:
+        STORE.migrate(st)
+    elif STORE is not None:
+        STORE.mark_clean(st)
+    with state_lock:
+        INDEX.rebuild(st["machines"])
+    VIEW.invalidate()
     return st
 
+# Per-probe counters live in PROBE_STATE_FILE so that state.json only changes
+# on configuration edits.
+VOLATILE_FIELDS = ("last_seen", "last_status", "last_rtt_ms", "last_error",
+                   "total_pings", "up_pings", "consec_down", "last_rtt_detail")
+
+def probe_fields(st: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    return {mid: {k: m[k] for k in VOLATILE_FIELDS if k in m} for mid, m in st.get("machines", {}).items()}
+
+def config_fields(st: Dict[str, Any]) -> Dict[str, Any]:
+    cfg = {k: v for k, v in st.items() if k != "machines"}
+    cfg["machines"] = {mid: {k: v for k, v in m.items() if k not in VOLATILE_FIELDS}
+                       for mid, m in st.get("machines", {}).items()}
+    return cfg
+
+def shallow_state(st: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of ``st`` that stays consistent after the lock is released.
+
+    Machine records are replaced, never edited in place, so sharing them is
+    safe; only the containers (and the small floor dicts) are copied.
+    Callers hold state_lock.
+    """
+    return {**st, "machines": dict(st.get("machines", {})), "floors": [dict(f) for f in st.get("floors", [])]}
+
+class SqliteStore:
+    """Floors, machines and probe results in one SQLite database (WAL mode).
+
+    Selected with STORAGE_BACKEND=sqlite in place of state.json,
+    probe-state.json and the CSV logs. Machines and floors are one row each
+    and a write only touches rows that changed since the previous one:
+    machine records are replaced rather than edited in place, so identity
+    against the last written snapshot is the change test. Every write is a
+    single transaction. The schema is created once, at construction; calls
+    borrow a connection from a small pool and hand it back when done, and
+    WAL lets history reads run alongside the writer.
+    """
+    POOL_SIZE = 4           # idle connections kept open between calls
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS floors (id TEXT PRIMARY KEY, pos INTEGER NOT NULL, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS machines (
+            id TEXT PRIMARY KEY, floor_id TEXT, category TEXT, operational INTEGER, data TEXT NOT NULL,
+            last_seen TEXT, last_status TEXT, last_rtt_ms INTEGER, last_error TEXT,
+            total_pings INTEGER, up_pings INTEGER, consec_down INTEGER, last_rtt_detail TEXT);
+        CREATE INDEX IF NOT EXISTS machines_floor ON machines (floor_id);
+        CREATE TABLE IF NOT EXISTS probe_results (
+            ts REAL NOT NULL, id TEXT NOT NULL, ok INTEGER NOT NULL, status INTEGER NOT NULL,
+            rtt_ms INTEGER NOT NULL, error TEXT NOT NULL DEFAULT '');
+        CREATE INDEX IF NOT EXISTS probe_results_id_ts ON probe_results (id, ts);
+        CREATE INDEX IF NOT EXISTS probe_results_ts ON probe_results (ts);
+        CREATE TABLE IF NOT EXISTS probe_hourly (
+            hour REAL NOT NULL, id TEXT NOT NULL, n INTEGER NOT NULL, up INTEGER NOT NULL,
+            rtt_sum INTEGER NOT NULL, rtt_max INTEGER NOT NULL, PRIMARY KEY (id, hour));
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._pool: List[sqlite3.Connection] = []
+        self._pool_lock = threading.Lock()
+        self._seq = 0
+        self._machines: Dict[str, Dict[str, Any]] = {}     # last written records
+        self._floors: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        self._default = ""
+        self.rows_written = 0
+        self.results_written = 0
+        c = self._open()
+        c.execute("PRAGMA journal_mode=WAL")                # persistent: recorded in the database file
+        c.executescript(self.SCHEMA)
+        if "last_rtt_detail" not in {r[1] for r in c.execute("PRAGMA table_info(machines)")}:
+            c.execute("ALTER TABLE machines ADD COLUMN last_rtt_detail TEXT")
+        self._pool.append(c)
+
+    def _open(self) -> sqlite3.Connection:
+        c = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+        c.execute("PRAGMA synchronous=NORMAL")
+        return c
+
+    @contextlib.contextmanager
+    def conn(self):
+        """A connection for the duration of the block; at most POOL_SIZE stay open afterwards."""
+        with self._pool_lock:
+            c = self._pool.pop() if self._pool else None
+        if c is None:
+            c = self._open()
+        try:
+            yield c
+        finally:
+            with self._pool_lock:
+                if len(self._pool) < self.POOL_SIZE and not c.in_transaction:
+                    self._pool.append(c)
+                    c = None
+            if c is not None:
+                c.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.conn() as c:
+            c.execute("BEGIN IMMEDIATE")
+            try:
+                yield c
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+            c.execute("COMMIT")
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """The stored state, or None if this database has never been written."""
+        with self.conn() as c:
+            meta = dict(c.execute("SELECT key, value FROM meta"))
+            if "schema" not in meta:
+                return None
+            floors = [json.loads(d) for d, in c.execute("SELECT data FROM floors ORDER BY pos")]
+            rows = c.execute("SELECT id, data, " + ", ".join(VOLATILE_FIELDS) + " FROM machines").fetchall()
+        machines = {}
+        for row in rows:
+            m = json.loads(row[1])
+            m.update({k: v for k, v in zip(VOLATILE_FIELDS, row[2:]) if v is not None})
+            if isinstance(m.get("last_rtt_detail"), str):
+                m["last_rtt_detail"] = json.loads(m["last_rtt_detail"])
+            machines[row[0]] = m
+        return {"floors": floors, "default_floor_id": meta.get("default_floor_id", "main"), "machines": machines}
+
+    def mark_clean(self, st: Dict[str, Any]) -> None:
+        """Record ``st`` (just loaded) as what the database already holds."""
+        self._machines = dict(st["machines"])
+        self._floors = {f["id"]: (i, dict(f)) for i, f in enumerate(st.get("floors", []))}
+        self._default = st.get("default_floor_id", "")
+
+    @staticmethod
+    def _machine_row(mid: str, m: Dict[str, Any]) -> Tuple[Any, ...]:
+        cfg = {k: v for k, v in m.items() if k not in VOLATILE_FIELDS}
+        return (mid, m.get("floor_id"), m.get("category"), 1 if m.get("operational", True) else 0,
+                json.dumps(cfg, separators=(",", ":"))) + \
+            tuple(json.dumps(m[k]) if isinstance(m.get(k), dict) else m.get(k) for k in VOLATILE_FIELDS)
+
+    def write(self, seq: int, st: Dict[str, Any]) -> int:
+        """Write the rows of ``st`` that changed; returns rows touched. Called by the persister only."""
+        if seq < self._seq:
+            return 0
+        machines = st["machines"]
+        upserts = [self._machine_row(mid, m) for mid, m in machines.items() if self._machines.get(mid) is not m]
+        deletes = [(mid,) for mid in self._machines if mid not in machines]
+        floors = {f["id"]: (i, f) for i, f in enumerate(st.get("floors", []))}
+        fl_up = [(fid, i, json.dumps(f)) for fid, (i, f) in floors.items() if self._floors.get(fid) != (i, f)]
+        fl_del = [(fid,) for fid in self._floors if fid not in floors]
+        default = st.get("default_floor_id", "")
+        with self.transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO machines (id, floor_id, category, operational, data, " +
+                          ", ".join(VOLATILE_FIELDS) + ") VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)", upserts)
+            c.executemany("DELETE FROM machines WHERE id = ?", deletes)
+            c.executemany("INSERT OR REPLACE INTO floors VALUES (?,?,?)", fl_up)
+            c.executemany("DELETE FROM floors WHERE id = ?", fl_del)
+            if default != self._default:
+                c.execute("INSERT OR REPLACE INTO meta VALUES ('default_floor_id', ?)", (default,))
+            c.execute("INSERT OR IGNORE INTO meta VALUES ('schema', '1')")
+        self._seq = seq
+        self._machines = dict(machines)
+        self._floors = {fid: (i, dict(f)) for fid, (i, f) in floors.items()}
+        self._default = default
+        n = len(upserts) + len(deletes) + len(fl_up) + len(fl_del)
+        self.rows_written += n
+        return n
+
+    def append_results(self, rows: List[Tuple[datetime, str, bool, str, int, str]]) -> None:
+        with self.transaction() as c:
+            c.executemany("INSERT INTO probe_results VALUES (?,?,?,?,?,?)",
+                          [((ts - EPOCH).total_seconds(), mid, 1 if ok else 0, STATUS_CODES.get(status, 2),
+                            max(0, int(rtt or 0)), err or "") for ts, mid, ok, status, rtt, err in rows])
+        self.results_written += len(rows)
+
+    def iter_results(self, since: datetime, until: datetime, mid: Optional[str] = None
+                     ) -> Iterable[Tuple[datetime, str, bool, str, int, str]]:
+        """Probe results in [since, until), oldest first, optionally for one device."""
+        args: List[Any] = [(since - EPOCH).total_seconds(), (until - EPOCH).total_seconds()]
+        sql = "SELECT ts, id, ok, status, rtt_ms, error FROM probe_results WHERE ts >= ? AND ts < ?"
+        if mid is not None:
+            sql += " AND id = ?"
+            args.append(mid)
+        with self.conn() as c:
+            for ts, rid, ok, status, rtt, err in c.execute(sql + " ORDER BY ts", args):
+                yield EPOCH + timedelta(seconds=ts), rid, bool(ok), STATUS_NAMES.get(status, "unknown"), rtt, err
+
+    def history(self, mid: str, since: datetime, until: datetime, res: str) -> List[Dict[str, Any]]:
+        """One device's points: hourly summaries for downsampled hours, then raw or hourly for the rest."""
+        lo, hi = (since - EPOCH).total_seconds(), (until - EPOCH).total_seconds()
+        with self.conn() as c:
+            out = [hourly_point(EPOCH + timedelta(seconds=h), *rest) for h, *rest in c.execute(
+                "SELECT hour, n, up, rtt_sum, rtt_max FROM probe_hourly WHERE id = ? AND hour >= ? AND hour < ? ORDER BY hour",
+                (mid, lo - 3600, hi))]
+            if res == "hour":
+                out += [hourly_point(EPOCH + timedelta(seconds=h), *rest) for h, *rest in c.execute(
+                    "SELECT CAST(ts / 3600 AS INTEGER) * 3600 AS h, COUNT(*), SUM(ok), SUM(CASE WHEN ok THEN rtt_ms ELSE 0 END),"
+                    " MAX(CASE WHEN ok THEN rtt_ms ELSE 0 END) FROM probe_results WHERE id = ? AND ts >= ? AND ts < ?"
+                    " GROUP BY h ORDER BY h", (mid, lo, hi))]
+        if res != "hour":
+            out += [{"t": ts.isoformat(), "rtt_ms": rtt, "ok": ok, "status": status}
+                    for ts, _mid, ok, status, rtt, _err in self.iter_results(since, until, mid)]
+        return out
+
+    def iter_hourly(self, since: datetime, until: datetime) -> Iterable[Tuple[datetime, str, int, int, int, int]]:
+        """(hour, id, n, up, rtt_sum, rtt_max) for every device, ordered by hour then id."""
+        lo, hi = (since - EPOCH).total_seconds(), (until - EPOCH).total_seconds()
+        with self.conn() as c:
+            for h, mid, n, up, rtt_sum, rtt_max in c.execute("""
+                    SELECT hour, id, n, up, rtt_sum, rtt_max FROM probe_hourly WHERE hour >= ? AND hour < ?
+                    UNION ALL
+                    SELECT CAST(ts / 3600 AS INTEGER) * 3600, id, COUNT(*), SUM(ok),
+                           SUM(CASE WHEN ok THEN rtt_ms ELSE 0 END), MAX(CASE WHEN ok THEN rtt_ms ELSE 0 END)
+                    FROM probe_results WHERE ts >= ? AND ts < ? GROUP BY 1, 2
+                    ORDER BY 1, 2""", (lo, hi, lo, hi)):
+                yield EPOCH + timedelta(seconds=h), mid, n, up, rtt_sum, rtt_max
+
+    def maintain(self, raw_before: datetime, expire_before: datetime) -> Dict[str, Set[str]]:
+        """Fold raw results older than ``raw_before`` into probe_hourly and drop expired hours.
+
+        Returns the days (YYYY-MM-DD) that were downsampled and expired.
+        """
+        raw, expire = (raw_before - EPOCH).total_seconds(), (expire_before - EPOCH).total_seconds()
+        days = "SELECT DISTINCT strftime('%Y-%m-%d', {0}, 'unixepoch') FROM {1} WHERE {0} < ?"
+        with self.transaction() as c:
+            folded = {r[0] for r in c.execute(days.format("ts", "probe_results"), (raw,))}
+            expired = {r[0] for r in c.execute(days.format("hour", "probe_hourly"), (expire,))}
+            c.execute("""
+                INSERT INTO probe_hourly (hour, id, n, up, rtt_sum, rtt_max)
+                SELECT CAST(ts / 3600 AS INTEGER) * 3600, id, COUNT(*), SUM(ok),
+                       SUM(CASE WHEN ok THEN rtt_ms ELSE 0 END), MAX(CASE WHEN ok THEN rtt_ms ELSE 0 END)
+                FROM probe_results WHERE ts < ? GROUP BY 1, 2
+                ON CONFLICT (id, hour) DO UPDATE SET n = n + excluded.n, up = up + excluded.up,
+                    rtt_sum = rtt_sum + excluded.rtt_sum, rtt_max = MAX(rtt_max, excluded.rtt_max)""", (raw,))
+            c.execute("DELETE FROM probe_results WHERE ts < ?", (raw,))
+            c.execute("DELETE FROM probe_hourly WHERE hour < ?", (expire,))
+        return {"downsampled": folded, "expired": expired}
+
+    def migrate(self, st: Dict[str, Any]) -> None:
+        """First start on SQLite: import the JSON state and every raw pings-* log.
+
+        The old files are left in place as a backup.
+        """
+        self.write(0, st)
+        rows = 0
+        for day in log_days():
+            batch = []
+            for row in iter_log_day(day):
+                try: ts = datetime.fromisoformat(row["timestamp"])
+                except Exception: continue
+                batch.append((ts, row.get("id") or "", row.get("ok") == "1", row.get("status") or "unknown",
+                              int(row.get("rtt_ms") or 0), row.get("error") or ""))
+            if batch:
+                self.append_results(batch)
+                rows += len(batch)
+        for day in HOURLY_STORE.days():
+            hourly = [(mid, HOURLY_STORE.read_day(mid, day) or []) for mid in HOURLY_STORE.ids(day)]
+            with self.transaction() as c:
+                c.executemany("INSERT OR REPLACE INTO probe_hourly VALUES (?,?,?,?,?,?)",
+                              [((h - EPOCH).total_seconds(), mid, n, up, rtt_sum, rtt_max)
+                               for mid, recs in hourly for h, n, up, rtt_sum, rtt_max in recs])
+        with self.transaction() as c:
+            c.execute("INSERT OR REPLACE INTO meta VALUES ('migrated_at', ?)", (datetime.utcnow().isoformat() + "Z",))
+            c.execute("INSERT OR REPLACE INTO meta VALUES ('migrated_rows', ?)", (str(rows),))
+        print(f"Migrated {len(st['machines'])} machines and {rows} probe results into {self.path}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "path": str(self.path),
+                "bytes": self.path.stat().st_size if self.path.exists() else 0,
+                "rows_written": self.rows_written, "results_written": self.results_written}
+
+STORE = SqliteStore(DB_FILE) if STORAGE_BACKEND == "sqlite" else None
+
+class StatePersister:
+    """Single writer thread for state.json and the probe-counter file (or STORE).
+
+    Writers never touch the disk: save_state hands the persister a shallow
+    snapshot taken under state_lock and returns, and probe results only
+    mark the counters dirty (written at most every ``interval`` seconds).
+    Field extraction, JSON encoding and the writes all happen on the
+    persister thread, outside the critical section. Snapshots carry a
+    sequence number so an older one never replaces a newer file.
+    """
+    def __init__(self, interval: float):
+        self.interval = max(0.1, interval)
+        self.dirty = False
+        self.flushes = 0
+        self._seq = 0
+        self._written: Dict[Path, int] = {}
+        self._pending: Optional[Tuple[int, Dict[str, Any]]] = None
+        self._cv = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def next_seq(self) -> int:
+        # Callers hold state_lock.
+        self._seq += 1
+        return self._seq
+
+    def _start(self) -> None:
+        with self._cv:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="state-persist", daemon=True)
+                self._thread.start()
+
+    def mark_dirty(self) -> None:
+        self.dirty = True
+        self._start()
+
+    def submit(self, seq: int, snap: Dict[str, Any]) -> None:
+        """Queue a full snapshot; a newer one supersedes any still waiting."""
+        with self._cv:
+            if self._pending is None or seq > self._pending[0]:
+                self._pending = (seq, snap)
+            self._cv.notify()
+        self._start()
+
+    def _loop(self) -> None:
+        while True:
+            with self._cv:
+                if self._pending is None:
+                    self._cv.wait(self.interval)
+            try: self.flush()
+            except Exception as e: print("State flush failed:", e)
+
+    def write(self, path: Path, obj: Any, seq: int, indent: Optional[int] = None) -> None:
+        t0 = time.perf_counter()
+        text = json.dumps(obj, indent=indent) if indent else json.dumps(obj, separators=(",", ":"))
+        with self._write_lock:
+            if seq < self._written.get(path, 0):
+                return
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(text, encoding="utf-8")
+            tmp.replace(path)
+            self._written[path] = seq
+        METRICS.observe("pcmon_state_write_seconds", (path.name,), time.perf_counter() - t0)
+        METRICS.inc("pcmon_state_write_bytes_total", (path.name,), len(text))
+
+    def write_store(self, seq: int, snap: Dict[str, Any]) -> None:
+        t0 = time.perf_counter()
+        STORE.write(seq, snap)
+        METRICS.observe("pcmon_state_write_seconds", (STORE.path.name,), time.perf_counter() - t0)
+
+    def flush(self) -> None:
+        """Write whatever is outstanding, in the calling thread.
+
+        Waits for a write already in progress, so on return everything
+        committed before the call is on disk.
+        """
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        with self._cv:
+            pending, self._pending = self._pending, None
+        if pending is not None:
+            seq, snap = pending
+            try:
+                if STORE is not None:
+                    self.write_store(seq, snap)
+                else:
+                    self.write(STATE_FILE, config_fields(snap), seq, indent=2)
+                    self.write(PROBE_STATE_FILE, probe_fields(snap), seq)
+            except Exception:
+                self.submit(seq, snap)
+                raise
+        if not self.dirty:
+            return
+        with state_lock:
+            self.dirty = False
+            seq = self.next_seq()
+            snap = shallow_state(STATE) if STORE is not None else {"machines": dict(STATE.get("machines", {}))}
+        try:
+            if STORE is not None:
+                self.write_store(seq, snap)
+            else:
+                self.write(PROBE_STATE_FILE, probe_fields(snap), seq)
+            self.flushes += 1
+        except Exception:
+            self.dirty = True
+            raise
+
+PERSIST = StatePersister(STATE_FLUSH_SECONDS)
+atexit.register(PERSIST.flush)
+
 def save_state(st: Dict[str, Any]) -> None:
-    tmp = STATE_FILE.with_suffix(".tmp")
-    tmp.write_text(json.dumps(st, indent=2), encoding="utf-8")
-    tmp.replace(STATE_FILE)
+    """Commit config and probe counters; the persister thread writes them."""
+    t0 = time.perf_counter()
+    with state_lock:
+        seq = PERSIST.next_seq()
+        PERSIST.dirty = False
+        snap = shallow_state(st)
+    PERSIST.submit(seq, snap)
+    METRICS.observe("pcmon_save_state_seconds", (), time.perf_counter() - t0)
+
+class ChangeFeed:
+    """Versioned log of machine and floor changes behind /api/public/events.
+
+    Every mutation of STATE publishes an event while still holding
+    state_lock, so a snapshot taken under the lock always matches
+    ``version``. The last ``size`` events are kept for clients resuming with
+    Last-Event-ID; anyone further behind gets a fresh snapshot.
+
+    Besides the global version, each event bumps the versions of the scopes
+    it touches ("floor:<id>", "storage", "floors") so cached public views
+    are only invalidated when their own data changed.
+    """
+    def __init__(self, size: int):
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.scopes: Dict[str, int] = {}
+        self._log: deque = deque(maxlen=max(1, size))
+        self._cv = threading.Condition()
+
+    def publish(self, kind: str, payload: Any, scopes: Tuple[str, ...] = ()) -> int:
+        with self._cv:
+            self.version += 1
+            for sc in scopes:
+                self.scopes[sc] = self.version
+            self._log.append((self.version, kind, payload))
+            self._cv.notify_all()
+            return self.version
+
+    def machines(self, upsert: List[Dict[str, Any]] = (), delete: List[str] = (),
+                 old: List[Dict[str, Any]] = ()) -> int:
+        """Publish changed/deleted machines; ``old`` are the prior records of moved or deleted ones."""
+        scopes = set()
+        for m in list(upsert) + list(old):
+            scopes.add("floor:" + (m.get("floor_id") or ""))
+            if not m.get("operational", True):
+                scopes.add("storage")
+        return self.publish("machines", {"upsert": [dict(m) for m in upsert], "delete": list(delete)},
+                            tuple(scopes))
+
+    def scope_version(self, scope: str) -> int:
+        with self._cv:
+            return self.version if scope == "all" else self.scopes.get(scope, 0)
+
+    def since(self, version: int) -> Optional[List[Tuple[int, str, Any]]]:
+        """Events after ``version``, or None when they are no longer retained."""
+        with self._cv:
+            if version > self.version:
+                return None
+            if version == self.version:
+                return []
+            if not self._log or self._log[0][0] > version + 1:
+                return None
+            return [e for e in self._log if e[0] > version]
+
+    def wait(self, version: int, timeout: float) -> bool:
+        with self._cv:
+            return self._cv.wait_for(lambda: self.version > version, timeout)
+
+CHANGES = ChangeFeed(CHANGE_LOG_SIZE)
+
+class Snapshot:
+    """Immutable view of the state as of one change-feed version."""
+    __slots__ = ("version", "built_at", "scopes", "machines", "floors", "default_floor_id", "by_floor", "storage")
+
+    def scope_version(self, scope: str) -> int:
+        return self.version if scope == "all" else self.scopes.get(scope, 0)
+
+class StateView:
+    """Publishes Snapshots for readers, so reads never run under state_lock.
+
+    A new snapshot is cut lazily by the first reader after a change (every
+    mutation publishes to CHANGES, whose version tags the snapshot) and
+    swapped in with a single reference assignment. ``max_age`` lets a
+    reader accept a snapshot that is up to that many seconds old, so a
+    sweep or import changing the fleet continuously does not force a
+    rebuild per request; such readers also keep the previous snapshot
+    instead of queueing behind a writer that holds the lock. With the
+    default ``max_age=0`` the reader waits for the lock, so authenticated
+    and mutating paths always see their own writes.
+    """
+    def __init__(self):
+        self._snap: Optional[Snapshot] = None
+        self._build_lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        self._snap = None
+
+    def get(self, max_age: float = 0.0) -> Snapshot:
+        snap = self._snap
+        if snap is not None and (snap.version == CHANGES.version or time.monotonic() - snap.built_at < max_age):
+            return snap
+        with self._build_lock:
+            snap = self._snap
+            if snap is not None and (snap.version == CHANGES.version or time.monotonic() - snap.built_at < max_age):
+                return snap
+            if not state_lock.acquire(blocking=False):
+                if snap is not None and max_age > 0:
+                    return snap
+                state_lock.acquire()
+            try:
+                new = Snapshot()
+                new.version = CHANGES.version
+                new.built_at = time.monotonic()
+                new.scopes = dict(CHANGES.scopes)
+                new.machines = dict(STATE.get("machines", {}))
+                new.floors = tuple(dict(f) for f in STATE.get("floors", []))
+                new.default_floor_id = STATE.get("default_floor_id", "main")
+                new.by_floor = {fid: tuple(ids) for fid, ids in INDEX.by_floor.items()}
+                new.storage = frozenset(INDEX.storage)
+            finally:
+                state_lock.release()
+            self._snap = new
+            return new
+
+VIEW = StateView()
 
 def get_floor(fid: Optional[str]) -> Dict[str, Any]:
     with state_lock:
@@ -137,18 +935,598 @@ def get_floor(fid: Optional[str]) -> Dict[str, Any]:
 def log_path_for(dt: datetime) -> Path:
     return LOG_DIR / f"pings-{dt.strftime('%Y-%m-%d')}.csv"
 
-def append_log(m: Dict[str, Any], ok: bool, rtt_ms: int, err: str) -> None:
-    p = log_path_for(datetime.utcnow())
-    new = not p.exists()
-    with p.open("a", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
+LOG_CODECS = {"gzip": (".gz", gzip), "lzma": (".xz", lzma)}
+
+def log_files_for(day: str) -> List[Path]:
+    """A day's raw CSV logs: the compressed file, then any plain one written after compression."""
+    return [p for p in (LOG_DIR / f"pings-{day}.csv{ext}" for ext in (".gz", ".xz", "")) if p.exists()]
+
+def log_days() -> List[str]:
+    return sorted({p.name[len("pings-"):len("pings-YYYY-MM-DD")] for p in LOG_DIR.glob("pings-*.csv*")})
+
+def open_log(p: Path):
+    codec = {".gz": gzip, ".xz": lzma}.get(p.suffix)
+    if codec is not None:
+        return codec.open(p, "rt", encoding="utf-8", newline="")
+    return p.open("r", encoding="utf-8", newline="")
+
+def iter_log_day(day: str) -> Iterable[Dict[str, str]]:
+    """CSV rows for one day across the plain and compressed files."""
+    for p in log_files_for(day):
+        try:
+            with open_log(p) as f:
+                yield from csv.DictReader(f)
+        except FileNotFoundError:
+            continue  # compressed or expired while we were listing
+
+EPOCH = datetime(1970, 1, 1)
+STATUS_CODES = {"down": 0, "up": 1, "unknown": 2}
+STATUS_NAMES = {v: k for k, v in STATUS_CODES.items()}
+
+class HistoryStore:
+    """Per-day, append-only binary segments with a per-device index.
+
+    ``hist-YYYY-MM-DD.seg`` holds fixed-size records
+    (ts, prev_offset, rtt_ms, ok, status). Each record points back at the
+    previous record of the same device, and ``hist-YYYY-MM-DD.idx`` maps
+    device id -> [last_offset, count] plus the committed segment size. Reading
+    one device's day walks only that device's chain instead of every row.
+    The CSV logs remain the human-readable export and the backfill source.
+    """
+    REC = struct.Struct("<dqIBB2x")
+    PREFIX = "hist"
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._idx: Dict[str, Dict[str, Any]] = {}
+
+    def _paths(self, day: str) -> Tuple[Path, Path]:
+        return self.root / f"{self.PREFIX}-{day}.seg", self.root / f"{self.PREFIX}-{day}.idx"
+
+    def _pack(self, row: Tuple[Any, ...], last: int) -> bytes:
+        ts, _mid, ok, status, rtt = row
+        return self.REC.pack((ts - EPOCH).total_seconds(), last, max(0, int(rtt)), 1 if ok else 0,
+                             STATUS_CODES.get(status, 2))
+
+    def _unpack(self, data: bytes) -> Tuple[Tuple[Any, ...], int]:
+        ts, prev, rtt, ok, status = self.REC.unpack(data)
+        return (EPOCH + timedelta(seconds=ts), bool(ok), STATUS_NAMES.get(status, "unknown"), rtt), prev
+
+    def _load(self, day: str) -> Optional[Dict[str, Any]]:
+        # Callers hold _lock.
+        idx = self._idx.get(day)
+        if idx is not None:
+            return idx
+        seg, ip = self._paths(day)
+        if not ip.exists():
+            return None
+        try:
+            idx = json.loads(ip.read_text(encoding="utf-8"))
+        except Exception:
+            return None
+        # Drop any tail appended after the last committed index write.
+        if seg.exists() and seg.stat().st_size > idx["size"]:
+            with seg.open("r+b") as f:
+                f.truncate(idx["size"])
+        self._idx[day] = idx
+        return idx
+
+    def _commit(self, day: str, idx: Dict[str, Any]) -> None:
+        _seg, ip = self._paths(day)
+        tmp = ip.with_suffix(".tmp")
+        tmp.write_text(json.dumps(idx, separators=(",", ":")), encoding="utf-8")
+        tmp.replace(ip)
+        self._idx[day] = idx
+
+    def _append(self, day: str, idx: Dict[str, Any], rows: List[Tuple[Any, ...]]) -> None:
+        seg, _ip = self._paths(day)
+        ids = idx["ids"]
+        off = idx["size"]
+        buf = bytearray()
+        for row in rows:
+            mid = row[1]
+            last, cnt = ids.get(mid, (-1, 0))
+            buf += self._pack(row, last)
+            ids[mid] = [off, cnt + 1]
+            off += self.REC.size
+        with seg.open("ab") as f:
+            f.write(buf)
+        idx["size"] = off
+        self._commit(day, idx)
+
+    def _write_day(self, day: str, rows: List[Tuple[Any, ...]]) -> Dict[str, Any]:
+        # Callers hold _lock.
+        seg, _ip = self._paths(day)
+        seg.unlink(missing_ok=True)
+        idx: Dict[str, Any] = {"size": 0, "ids": {}}
+        seg.touch()
+        self._append(day, idx, rows)
+        return idx
+
+    def _build_from_csv(self, day: str) -> Dict[str, Any]:
+        # Callers hold _lock.
+        rows = []
+        for row in iter_log_day(day):
+            try: ts = datetime.fromisoformat(row["timestamp"])
+            except Exception: continue
+            rows.append((ts, row.get("id") or "", row.get("ok") == "1",
+                         row.get("status") or "unknown", int(row.get("rtt_ms") or 0)))
+        return self._write_day(day, rows)
+
+    def write_day(self, day: str, rows: List[Tuple[Any, ...]]) -> None:
+        """Replace a whole day with ``rows`` (oldest first)."""
+        with self._lock:
+            self._write_day(day, rows)
+
+    def has_day(self, day: str) -> bool:
+        return self._paths(day)[1].exists()
+
+    def days(self) -> List[str]:
+        return sorted(p.stem[len(self.PREFIX) + 1:] for p in self.root.glob(f"{self.PREFIX}-*.idx"))
+
+    def ids(self, day: str) -> List[str]:
+        with self._lock:
+            idx = self._load(day)
+            return list(idx["ids"]) if idx else []
+
+    def drop_day(self, day: str) -> None:
+        with self._lock:
+            self._idx.pop(day, None)
+            for p in self._paths(day):
+                p.unlink(missing_ok=True)
+
+    def append_many(self, rows: List[Tuple[datetime, str, bool, str, int]]) -> None:
+        by_day: Dict[str, List[Tuple[datetime, str, bool, str, int]]] = {}
+        for r in rows:
+            by_day.setdefault(r[0].strftime("%Y-%m-%d"), []).append(r)
+        with self._lock:
+            for day, day_rows in by_day.items():
+                idx = self._load(day)
+                if idx is None:
+                    # First write of the day: LogWriter writes the CSV first,
+                    # so it already holds these rows.
+                    self._build_from_csv(day)
+                    continue
+                self._append(day, idx, day_rows)
+
+    def read_day(self, mid: str, day: str) -> Optional[List[Tuple[Any, ...]]]:
+        """One device's points for a day (oldest first), or None if the day isn't indexed."""
+        with self._lock:
+            idx = self._load(day)
+            if idx is None:
+                return None
+            off = idx["ids"].get(mid, (-1, 0))[0]
+        out = []
+        if off < 0:
+            return out
+        seg, _ip = self._paths(day)
+        with seg.open("rb") as f:
+            while off >= 0:
+                f.seek(off)
+                rec, off = self._unpack(f.read(self.REC.size))
+                out.append(rec)
+        out.reverse()
+        return out
+
+    def backfill(self) -> int:
+        """Index every daily CSV that has no segment yet; returns days built."""
+        built = 0
+        for day in log_days():
+            with self._lock:
+                if self._load(day) is None:
+                    self._build_from_csv(day)
+                    built += 1
+        return built
+
+HISTORY_STORE = HistoryStore(SERIES_DIR)
+
+class HourlyStore(HistoryStore):
+    """Downsampled tier: one (n, up, rtt_sum, rtt_max) record per device and hour."""
+    REC = struct.Struct("<dqIIII")
+    PREFIX = "hourly"
+
+    def _pack(self, row: Tuple[Any, ...], last: int) -> bytes:
+        ts, _mid, n, up, rtt_sum, rtt_max = row
+        return self.REC.pack((ts - EPOCH).total_seconds(), last, n, up, rtt_sum, rtt_max)
+
+    def _unpack(self, data: bytes) -> Tuple[Tuple[Any, ...], int]:
+        ts, prev, n, up, rtt_sum, rtt_max = self.REC.unpack(data)
+        return (EPOCH + timedelta(seconds=ts), n, up, rtt_sum, rtt_max), prev
+
+HOURLY_STORE = HourlyStore(SERIES_DIR)
+
+def hourly_rows(rows: Iterable[Tuple[datetime, bool, str, int]]) -> List[Tuple[datetime, int, int, int, int]]:
+    """Fold one device's raw points into (hour, n, up, rtt_sum, rtt_max), oldest first."""
+    buckets: Dict[datetime, List[int]] = {}
+    for ts, ok, _status, rtt in rows:
+        b = buckets.setdefault(ts.replace(minute=0, second=0, microsecond=0), [0, 0, 0, 0])
+        b[0] += 1
+        if ok:
+            b[1] += 1; b[2] += rtt; b[3] = max(b[3], rtt)
+    return [(h, *b) for h, b in sorted(buckets.items())]
+
+def hourly_point(hour: datetime, n: int, up: int, rtt_sum: int, rtt_max: int) -> Dict[str, Any]:
+    return {"t": hour.isoformat(), "res": "hour", "n": n, "up": up, "uptime": round(100.0 * up / n, 2) if n else 0.0,
+            "rtt_ms": round(rtt_sum / up) if up else 0, "rtt_max_ms": rtt_max,
+            "ok": up > 0, "status": "up" if up * 2 >= n and up else "down"}
+
+LOG_HEADER = ["timestamp","id","name","ip","serial","ok","status","rtt_ms","error"]
+
+class LogWriter:
+    """Long-lived, buffered appender for the daily ping logs (or STORE's probe_results).
+
+    Probe workers only push rows into an in-memory buffer. A background
+    thread writes them out every ``flush_interval`` seconds, or sooner once
+    ``max_rows`` are waiting, keeping the current day's file open and
+    rotating to a new file at UTC midnight.
+    """
+    def __init__(self, flush_interval: float, max_rows: int):
+        self.flush_interval = max(0.1, flush_interval)
+        self.max_rows = max(1, max_rows)
+        self._buf: List[Tuple[datetime, List[Any]]] = []
+        self._lock = threading.Lock()       # guards _buf
+        self._io_lock = threading.Lock()    # serialises file writes
+        self._wake = threading.Event()
+        self._fh = None
+        self._day = ""
+        self._thread: Optional[threading.Thread] = None
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.rotations = 0
+        self.index_errors = 0
+
+    def append(self, ts: datetime, row: List[Any]) -> None:
+        with self._lock:
+            self._buf.append((ts, row))
+            full = len(self._buf) >= self.max_rows
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="log-writer", daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _loop(self) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try: self.flush()
+            except Exception as e: print("Log flush failed:", e)
+
+    def _open(self, day: str, ts: datetime):
+        if self._fh is not None and self._day == day:
+            return self._fh
+        if self._fh is not None:
+            self._fh.close()
+            self.rotations += 1
+        p = log_path_for(ts)
+        new = not p.exists() or p.stat().st_size == 0
+        self._fh = p.open("a", newline="", encoding="utf-8")
+        self._day = day
         if new:
-            w.writerow(["timestamp","id","name","ip","serial","ok","status","rtt_ms","error"])
-        w.writerow([
-            datetime.utcnow().isoformat(),
-            m.get("id",""), m.get("name",""), m.get("ip",""), m.get("serial",""),
-            "1" if ok else "0", m.get("last_status","unknown"), rtt_ms, err
-        ])
+            csv.writer(self._fh).writerow(LOG_HEADER)
+        return self._fh
+
+    def flush(self) -> None:
+        with self._io_lock:
+            with self._lock:
+                rows, self._buf = self._buf, []
+            if not rows:
+                return
+            t0 = time.perf_counter()
+            if STORE is not None:
+                try:
+                    STORE.append_results([(ts, r[1], r[5] == "1", r[6], r[7], r[8]) for ts, r in rows])
+                except Exception:
+                    with self._lock:
+                        self._buf[:0] = rows
+                    raise
+                self.rows_written += len(rows)
+                self.flushes += 1
+                METRICS.observe("pcmon_log_flush_seconds", (), time.perf_counter() - t0)
+                return
+            # The CSV is the record; a day's rows reach the binary index only
+            # once they are on disk, and rows that failed go back in the buffer.
+            i = 0
+            while i < len(rows):
+                day = rows[i][0].strftime("%Y-%m-%d")
+                out = io.StringIO()
+                w = csv.writer(out)
+                j = i
+                while j < len(rows) and rows[j][0].strftime("%Y-%m-%d") == day:
+                    w.writerow(rows[j][1]); j += 1
+                try:
+                    fh = self._open(day, rows[i][0])
+                    text = out.getvalue()
+                    fh.write(text)
+                    fh.flush()
+                except Exception:
+                    with self._lock:
+                        self._buf[:0] = rows[i:]
+                    raise
+                self.bytes_written += len(text)
+                self.rows_written += j - i
+                METRICS.inc("pcmon_log_write_bytes_total", (), len(text))
+                try:
+                    HISTORY_STORE.append_many([(ts, r[1], r[5] == "1", r[6], r[7]) for ts, r in rows[i:j]])
+                except Exception as e:
+                    # Reads fall back to the CSV, and the next append rebuilds the day from it.
+                    HISTORY_STORE.drop_day(day)
+                    self.index_errors += 1
+                    print("History index append failed:", day, e)
+                i = j
+            self.flushes += 1
+            METRICS.observe("pcmon_log_flush_seconds", (), time.perf_counter() - t0)
+
+    def close(self) -> None:
+        self.flush()
+        with self._io_lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None; self._day = ""
+
+    def current_day(self) -> str:
+        """The day whose file is open for appending ("" if none)."""
+        return self._day
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            depth = len(self._buf)
+        return {"rows_written": self.rows_written, "bytes_written": self.bytes_written,
+                "flushes": self.flushes, "rotations": self.rotations, "buffer_depth": depth,
+                "index_errors": self.index_errors}
+
+LOG_WRITER = LogWriter(LOG_FLUSH_SECONDS, LOG_BUFFER_ROWS)
+atexit.register(LOG_WRITER.close)
+
+class LogLifecycle:
+    """Background upkeep of the probe history tiers.
+
+    Every ``interval`` seconds: raw CSV logs of closed days are compressed
+    (LOG_COMPRESS), days older than LOG_RAW_DAYS are folded into hourly
+    per-device summaries (HOURLY_STORE) and their raw rows and index
+    dropped, and anything older than LOG_RETENTION_DAYS is deleted. With
+    the SQLite backend the same happens inside the database, and the
+    pings-* files left behind by the migration are still compressed and
+    expired. A day that fails (e.g. a file still open on Windows) is
+    retried on the next run. ``downsampled`` and ``expired`` count days
+    on both backends.
+    """
+    def __init__(self, interval: int):
+        self.interval = max(60, interval)
+        self.compressed = 0
+        self.downsampled = 0
+        self.expired = 0
+        self.bytes_saved = 0
+        self.last_run = ""
+        self.last_error = ""
+
+    def run_forever(self) -> None:
+        while True:
+            try: self.run_once()
+            except Exception as e:
+                self.last_error = str(e)
+                print("Log maintenance failed:", e)
+            time.sleep(self.interval)
+
+    def run_once(self, now: Optional[datetime] = None) -> Dict[str, Any]:
+        now = now or datetime.utcnow()
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        raw_before = today - timedelta(days=LOG_RAW_DAYS)
+        expire_before = today - timedelta(days=LOG_RETENTION_DAYS)
+        downsampled: Set[str] = set(); expired: Set[str] = set()
+        if STORE is not None:
+            LOG_WRITER.flush()
+            res = STORE.maintain(raw_before, expire_before)
+            downsampled |= res["downsampled"]; expired |= res["expired"]
+        days = set(log_days()) | set(HISTORY_STORE.days()) | set(HOURLY_STORE.days())
+        for day in sorted(days):
+            try:
+                d = datetime.strptime(day, "%Y-%m-%d")
+            except ValueError:
+                continue
+            try:
+                if d < expire_before:
+                    self.expire(day); expired.add(day)
+                elif d < raw_before and STORE is None:
+                    self.downsample(day); downsampled.add(day)
+                elif d + timedelta(days=1, hours=1) <= now:
+                    self.compress(day)  # on SQLite: the migrated files, kept as a backup
+            except OSError as e:
+                self.last_error = f"{day}: {e}"
+                print("Log maintenance:", self.last_error)
+        self.downsampled += len(downsampled - expired); self.expired += len(expired)
+        self.last_run = now.isoformat() + "Z"
+        return self.stats()
+
+    def compress(self, day: str) -> None:
+        """Move a closed day's plain CSV into its compressed file (appending if one exists)."""
+        if LOG_COMPRESS not in LOG_CODECS or LOG_WRITER.current_day() == day:
+            return
+        plain = LOG_DIR / f"pings-{day}.csv"
+        if not plain.exists():
+            return
+        ext, codec = LOG_CODECS[LOG_COMPRESS]
+        dst = plain.with_name(plain.name + ext)
+        tmp = dst.with_name(dst.name + ".tmp")
+        before = plain.stat().st_size + (dst.stat().st_size if dst.exists() else 0)
+        with codec.open(tmp, "wt", encoding="utf-8", newline="") as out:
+            if dst.exists():
+                with open_log(dst) as f:
+                    shutil.copyfileobj(f, out)
+            with plain.open("r", encoding="utf-8", newline="") as f:
+                if dst.exists():
+                    f.readline()  # header already written
+                shutil.copyfileobj(f, out)
+        tmp.replace(dst)
+        plain.unlink()
+        self.compressed += 1
+        self.bytes_saved += max(0, before - dst.stat().st_size)
+
+    def downsample(self, day: str) -> None:
+        """Replace a day's raw rows and per-probe index with hourly summaries."""
+        if not HOURLY_STORE.has_day(day):
+            buckets: Dict[Tuple[datetime, str], List[int]] = {}
+            for row in iter_log_day(day):
+                try: ts = datetime.fromisoformat(row["timestamp"])
+                except Exception: continue
+                b = buckets.setdefault((ts.replace(minute=0, second=0, microsecond=0), row.get("id") or ""), [0, 0, 0, 0])
+                b[0] += 1
+                if row.get("ok") == "1":
+                    rtt = int(row.get("rtt_ms") or 0)
+                    b[1] += 1; b[2] += rtt; b[3] = max(b[3], rtt)
+            HOURLY_STORE.write_day(day, [(h, mid, *b) for (h, mid), b in sorted(buckets.items())])
+        for p in log_files_for(day):
+            p.unlink()
+        HISTORY_STORE.drop_day(day)
+
+    def expire(self, day: str) -> None:
+        for p in log_files_for(day):
+            p.unlink()
+        HISTORY_STORE.drop_day(day)
+        HOURLY_STORE.drop_day(day)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"compress": LOG_COMPRESS, "raw_days": LOG_RAW_DAYS, "retention_days": LOG_RETENTION_DAYS,
+                "compressed": self.compressed, "downsampled": self.downsampled, "expired": self.expired,
+                "bytes_saved": self.bytes_saved, "last_run": self.last_run, "last_error": self.last_error}
+
+LOG_LIFECYCLE = LogLifecycle(LOG_MAINTENANCE_SECONDS)
+
+def iter_probe_results(since: datetime, until: datetime) -> Iterable[Tuple[datetime, str, bool, str, int, str]]:
+    """Every logged result in [since, until), oldest first: (ts, id, ok, status, rtt_ms, error)."""
+    if STORE is not None:
+        yield from STORE.iter_results(since, until)
+        return
+    day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < until:
+        rows = iter_log_day(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
+        for row in rows:
+            try: ts = datetime.fromisoformat(row["timestamp"])
+            except Exception: continue
+            if since <= ts < until:
+                yield ts, row.get("id") or "", row.get("ok") == "1", row.get("status") or "unknown", \
+                    int(row.get("rtt_ms") or 0), row.get("error") or ""
+
+def append_log(m: Dict[str, Any], ok: bool, rtt_ms: int, err: str) -> None:
+    t0 = time.perf_counter()
+    now = datetime.utcnow()
+    LOG_WRITER.append(now, [
+        now.isoformat(),
+        m.get("id",""), m.get("name",""), m.get("ip",""), m.get("serial",""),
+        "1" if ok else "0", m.get("last_status","unknown"), rtt_ms, err
+    ])
+    METRICS.observe("pcmon_append_log_seconds", (), time.perf_counter() - t0)
+
+RTT_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+class RollupBucket:
+    __slots__ = ("count", "up", "flips", "rtt_n", "rtt_sum", "rtt_min", "rtt_max", "hist")
+
+    def __init__(self):
+        self.count = self.up = self.flips = self.rtt_n = self.rtt_sum = self.rtt_max = 0
+        self.rtt_min = -1
+        self.hist = [0] * (len(RTT_BUCKETS_MS) + 1)
+
+    def add(self, ok: bool, rtt_ms: int, flipped: bool) -> None:
+        self.count += 1
+        if flipped:
+            self.flips += 1
+        if not ok:
+            return
+        self.up += 1
+        self.rtt_n += 1
+        self.rtt_sum += rtt_ms
+        self.rtt_max = max(self.rtt_max, rtt_ms)
+        self.rtt_min = rtt_ms if self.rtt_min < 0 else min(self.rtt_min, rtt_ms)
+        i = 0
+        while i < len(RTT_BUCKETS_MS) and rtt_ms > RTT_BUCKETS_MS[i]:
+            i += 1
+        self.hist[i] += 1
+
+    def p95(self) -> int:
+        # Upper bound of the histogram bucket holding the 95th percentile.
+        if not self.rtt_n:
+            return 0
+        need = -(-95 * self.rtt_n // 100)
+        seen = 0
+        for i, n in enumerate(self.hist):
+            seen += n
+            if seen >= need:
+                return min(RTT_BUCKETS_MS[i], self.rtt_max) if i < len(RTT_BUCKETS_MS) else self.rtt_max
+        return self.rtt_max
+
+    def to_dict(self, start: datetime) -> Dict[str, Any]:
+        return {
+            "start": start.isoformat() + "Z",
+            "probes": self.count,
+            "up": self.up,
+            "uptime_pct": round(100.0 * self.up / self.count, 2) if self.count else None,
+            "rtt_min": max(0, self.rtt_min),
+            "rtt_avg": round(self.rtt_sum / self.rtt_n, 1) if self.rtt_n else 0,
+            "rtt_p95": self.p95(),
+            "flips": self.flips,
+        }
+
+class Rollups:
+    """Hourly and daily uptime/RTT aggregates, maintained as results arrive.
+
+    Kept per device, floor, category and for the whole fleet; each series
+    holds at most ``hours`` hourly and ``days`` daily buckets, so queries cost
+    the same no matter how much history is on disk.
+    """
+    def __init__(self, hours: int, days: int):
+        self.keep = {"hour": max(1, hours), "day": max(1, days)}
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, str, str], Dict[datetime, RollupBucket]] = {}
+        self.started_at = datetime.utcnow()
+
+    def _bucket(self, scope: str, sid: str, res: str, start: datetime) -> RollupBucket:
+        series = self._series.setdefault((scope, sid, res), {})
+        b = series.get(start)
+        if b is None:
+            b = series[start] = RollupBucket()
+            if len(series) > self.keep[res]:
+                del series[min(series)]
+        return b
+
+    def record(self, ts: datetime, m: Dict[str, Any], ok: bool, rtt_ms: int, flipped: bool) -> None:
+        hour = ts.replace(minute=0, second=0, microsecond=0)
+        day = hour.replace(hour=0)
+        keys = [("device", m.get("id") or ""), ("fleet", "all")]
+        if m.get("floor_id"):
+            keys.append(("floor", m["floor_id"]))
+        if m.get("category"):
+            keys.append(("category", m["category"]))
+        with self._lock:
+            for scope, sid in keys:
+                self._bucket(scope, sid, "hour", hour).add(ok, rtt_ms, flipped)
+                self._bucket(scope, sid, "day", day).add(ok, rtt_ms, flipped)
+
+    def query(self, scope: str, sid: str, res: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = sorted(self._series.get((scope, sid, res), {}).items())
+            return [b.to_dict(start) for start, b in items]
+
+    def backfill(self) -> int:
+        """Replay results logged before this process started; returns rows replayed."""
+        since = (self.started_at - timedelta(days=self.keep["day"])).replace(hour=0, minute=0, second=0, microsecond=0)
+        with state_lock:
+            meta = {mid: {"id": mid, "floor_id": m.get("floor_id", ""), "category": m.get("category", "")}
+                    for mid, m in STATE.get("machines", {}).items()}
+        last: Dict[str, str] = {}
+        n = 0
+        for ts, mid, ok, status, rtt, _err in iter_probe_results(since, self.started_at):
+            flipped = mid in last and last[mid] != status
+            last[mid] = status
+            self.record(ts, meta.get(mid) or {"id": mid}, ok, rtt, flipped)
+            n += 1
+        return n
+
+ROLLUPS = Rollups(ROLLUP_HOURS, ROLLUP_DAYS)
 
 def parse_rtt_ms(text: str) -> int:
     m = re.search(r"time[=<]\s*([\d.,]+)\s*ms", text, re.IGNORECASE)
@@ -182,6 +1560,12 @@ def ping_icmp(ip: str, timeout_ms: int = 2000) -> Tuple[bool,int,str]:
     except Exception as e:
         return False, 0, str(e)
 
+def is_ipv6(ip: str) -> bool:
+    try:
+        return ipaddress.ip_address(ip).version == 6
+    except ValueError:
+        return False
+
 def ping_tcp(ip: str, port: int, timeout_ms: int = 2000) -> Tuple[bool,int,str]:
     if not ip or not port:
         return False, 0, "tcp requires ip and port"
@@ -193,63 +1577,852 @@ def ping_tcp(ip: str, port: int, timeout_ms: int = 2000) -> Tuple[bool,int,str]:
     except Exception as e:
         return False, 0, str(e)
 
-def do_check(m: Dict[str, Any]) -> Tuple[bool,int,str]:
-    if (m.get("check") or "icmp").lower() == "tcp":
-        return ping_tcp(m.get("ip",""), int(m.get("tcp_port") or 0), 2000)
-    return ping_icmp(m.get("ip",""), 2000)
+def icmp_checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b"\0"
+    s = sum(struct.unpack(f"!{len(data)//2}H", data))
+    s = (s >> 16) + (s & 0xFFFF)
+    s += s >> 16
+    return ~s & 0xFFFF
+
+class IcmpPinger:
+    """In-process ICMP echo over one shared socket.
+
+    Uses an unprivileged ICMP datagram socket (Linux ``ping_group_range``) and
+    falls back to a raw socket when running privileged. Any number of probes
+    may be in flight; a single receiver thread matches replies by
+    (address, sequence) and, on raw sockets, by our identifier.
+    """
+    PAYLOAD = b"pc-monitor".ljust(48, b"\0")
+
+    def __init__(self):
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.raw = False
+        except OSError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.raw = True
+        self.kind = "raw" if self.raw else "dgram"
+        self.ident = os.getpid() & 0xFFFF
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._waiting: Dict[Tuple[str,int], Dict[str, Any]] = {}
+        threading.Thread(target=self._recv_loop, name="icmp-recv", daemon=True).start()
+
+    def _next_seq(self) -> int:
+        self._seq = self._seq % 0xFFFF + 1
+        return self._seq
+
+    def _packet(self, seq: int) -> bytes:
+        hdr = struct.pack("!BBHHH", 8, 0, 0, self.ident, seq)
+        csum = icmp_checksum(hdr + self.PAYLOAD)
+        return struct.pack("!BBHHH", 8, 0, csum, self.ident, seq) + self.PAYLOAD
+
+    def _resolve(self, w: Dict[str, Any], ok: bool, err: str = "") -> None:
+        if not w["event"].is_set():
+            w["recv"] = time.perf_counter(); w["ok"] = ok; w["err"] = err
+            w["event"].set()
+
+    def _recv_loop(self) -> None:
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(2048)
+            except OSError:
+                time.sleep(0.1); continue
+            if self.raw:
+                data = data[(data[0] & 0x0F) * 4:]
+            if len(data) < 8:
+                continue
+            typ, _code, _csum, ident, seq = struct.unpack("!BBHHH", data[:8])
+            if typ == 0:
+                # Datagram sockets get their identifier rewritten by the kernel.
+                if self.raw and ident != self.ident:
+                    continue
+                with self._lock:
+                    w = self._waiting.get((addr[0], seq))
+                if w: self._resolve(w, True)
+            elif typ in (3, 11) and self.raw and len(data) >= 36:
+                # Unreachable / time exceeded: quoted original header + 8 bytes.
+                inner = data[8:]
+                ihl = (inner[0] & 0x0F) * 4
+                if len(inner) < ihl + 8:
+                    continue
+                dst = socket.inet_ntoa(inner[16:20])
+                _t, _c, _s, o_ident, o_seq = struct.unpack("!BBHHH", inner[ihl:ihl+8])
+                if o_ident != self.ident:
+                    continue
+                with self._lock:
+                    w = self._waiting.get((dst, o_seq))
+                if w: self._resolve(w, False, "destination unreachable" if typ == 3 else "ttl exceeded")
+
+    def ping_many(self, ips: List[str], timeout_ms: int = 2000) -> Dict[str, Tuple[bool,int,str]]:
+        """Send one echo to every host, then wait for all replies up to timeout_ms."""
+        out: Dict[str, Tuple[bool,int,str]] = {}
+        pending: List[Tuple[str, Tuple[str,int], Dict[str, Any]]] = []
+        for ip in ips:
+            if not ip:
+                out[ip] = (False, 0, "empty ip"); continue
+            try:
+                addr = socket.gethostbyname(ip)
+            except OSError as e:
+                out[ip] = (False, 0, str(e)); continue
+            w = {"event": threading.Event(), "sent": 0.0, "recv": 0.0, "ok": False, "err": ""}
+            with self._lock:
+                seq = self._next_seq()
+                self._waiting[(addr, seq)] = w
+            w["sent"] = time.perf_counter()
+            try:
+                self.sock.sendto(self._packet(seq), (addr, 0))
+            except OSError as e:
+                self._resolve(w, False, str(e))
+            pending.append((ip, (addr, seq), w))
+        deadline = time.perf_counter() + timeout_ms / 1000.0
+        try:
+            for ip, _key, w in pending:
+                if not w["event"].wait(max(0.0, deadline - time.perf_counter())):
+                    out[ip] = (False, 0, f"timeout after {timeout_ms} ms"); continue
+                if not w["ok"]:
+                    out[ip] = (False, 0, w["err"]); continue
+                out[ip] = (True, int((w["recv"] - w["sent"]) * 1000 + 0.5), "")
+        finally:
+            with self._lock:
+                for _ip, key, _w in pending:
+                    self._waiting.pop(key, None)
+        return out
+
+    def ping(self, ip: str, timeout_ms: int = 2000) -> Tuple[bool,int,str]:
+        return self.ping_many([ip], timeout_ms)[ip]
+
+_ICMP_PINGER: Optional[IcmpPinger] = None
+_ICMP_PINGER_ERROR = ""
+_icmp_init_lock = threading.Lock()
+
+def icmp_pinger() -> Optional[IcmpPinger]:
+    """Shared native pinger, or None when no ICMP socket can be opened."""
+    global _ICMP_PINGER, _ICMP_PINGER_ERROR
+    if _ICMP_PINGER is not None or _ICMP_PINGER_ERROR:
+        return _ICMP_PINGER
+    with _icmp_init_lock:
+        if _ICMP_PINGER is None and not _ICMP_PINGER_ERROR:
+            try:
+                _ICMP_PINGER = IcmpPinger()
+            except OSError as e:
+                _ICMP_PINGER_ERROR = repr(e)
+                print("Native ICMP unavailable, using ping subprocess:", e)
+    return _ICMP_PINGER
+
+def icmp_backend() -> str:
+    if PROBE_BACKEND != "subprocess":
+        pinger = icmp_pinger()
+        if pinger is not None:
+            return pinger.kind
+    return "subprocess"
+
+def parse_ports(v: Any) -> List[int]:
+    """Port list from a list or a "22,80 443" style string; raises ValueError."""
+    if isinstance(v, str):
+        v = [p for p in re.split(r"[,;\s]+", v.strip()) if p]
+    ports = sorted({int(p) for p in (v or [])})
+    if any(not 0 < p < 65536 for p in ports):
+        raise ValueError("ports must be between 1 and 65535")
+    return ports
+
+def check_settings(src: Dict[str, Any], cur: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Check-specific fields from ``src``, falling back to ``cur`` then defaults; raises ValueError."""
+    cur = cur or {}
+    get = lambda k, d: src[k] if k in src else cur.get(k, d)
+    out = {
+        "tcp_ports": parse_ports(get("tcp_ports", [])),
+        "http_path": str(get("http_path", "/") or "/").strip(),
+        "http_tls": as_bool(get("http_tls", False)),
+        "http_status": int(get("http_status", 0) or 0),
+        "http_match": str(get("http_match", "") or ""),
+        "http_verify": as_bool(get("http_verify", True)),
+        "check_timeout_ms": int(get("check_timeout_ms", 0) or 0),
+    }
+    if not out["http_path"].startswith("/"):
+        out["http_path"] = "/" + out["http_path"]
+    if out["http_status"] and not 100 <= out["http_status"] <= 599:
+        raise ValueError("http_status must be between 100 and 599")
+    if not 0 <= out["check_timeout_ms"] <= 60000:
+        raise ValueError("check_timeout_ms must be between 0 and 60000")
+    return out
+
+def validate_check(m: Dict[str, Any]) -> None:
+    if m["check"] not in CHECK_TYPES:
+        raise ValueError(f"unknown check {m['check']!r}")
+    if m["check"] == "tcp_multi" and not m["tcp_ports"]:
+        raise ValueError("tcp_multi check needs tcp_ports")
+
+def http_check_session() -> requests.Session:
+    global _HTTP_CHECK_SESSION
+    with _http_session_lock:
+        if _HTTP_CHECK_SESSION is None:
+            s = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=256, pool_maxsize=4, max_retries=0)
+            s.mount("http://", adapter); s.mount("https://", adapter)
+            s.headers["User-Agent"] = f"pc-monitor/{APP_VERSION}"
+            _HTTP_CHECK_SESSION = s
+        return _HTTP_CHECK_SESSION
+
+_HTTP_CHECK_SESSION: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+_unverified_hosts: Set[str] = set()
+
+def allow_unverified(host: str) -> None:
+    """Silence urllib3's InsecureRequestWarning for one host checked with http_verify off.
+
+    A per-host filter rather than catch_warnings(), which swaps the
+    process-wide filter list and is not safe across probe threads.
+    """
+    with _http_session_lock:
+        if host in _unverified_hosts:
+            return
+        _unverified_hosts.add(host)
+    warnings.filterwarnings("ignore", message=f"Unverified HTTPS request is being made to host '{re.escape(host)}'",
+                            category=urllib3.exceptions.InsecureRequestWarning)
+
+def check_http(m: Dict[str, Any], timeout_ms: int) -> Tuple[bool,int,str,Dict[str,int]]:
+    """GET http(s)://ip[:tcp_port]/http_path over the shared keep-alive pool."""
+    ip = m.get("ip","")
+    if not ip:
+        return False, 0, "empty ip", {}
+    scheme = "https" if m.get("http_tls") else "http"
+    port = int(m.get("tcp_port") or 0)
+    host = f"[{ip}]" if is_ipv6(ip) else ip
+    url = f"{scheme}://{host}{':' + str(port) if port else ''}{m.get('http_path') or '/'}"
+    verify = bool(m.get("http_verify", True))
+    if not verify:
+        allow_unverified(ip)
+    t0 = time.perf_counter()
+    try:
+        with http_check_session().get(url, timeout=timeout_ms / 1000.0, verify=verify,
+                                      stream=True, allow_redirects=False) as r:
+            ttfb = int((time.perf_counter() - t0) * 1000 + 0.5)
+            body = b""
+            for chunk in r.iter_content(8192):
+                body += chunk
+                if len(body) >= HTTP_CHECK_MAX_BODY:
+                    break
+            total = int((time.perf_counter() - t0) * 1000 + 0.5)
+            detail = {"ttfb_ms": ttfb, "body_ms": total - ttfb, "status": r.status_code}
+            want = int(m.get("http_status") or 0)
+            if (want and r.status_code != want) or (not want and r.status_code >= 400):
+                return False, 0, f"HTTP {r.status_code}" + (f", expected {want}" if want else ""), detail
+            match = m.get("http_match") or ""
+            if match and match not in body.decode(r.encoding or "utf-8", "replace"):
+                return False, 0, f"body does not contain {match[:60]!r}", detail
+            return True, total, "", detail
+    except requests.RequestException as e:
+        return False, 0, str(e)[:240], {}
+
+def check_tcp_ports(m: Dict[str, Any], timeout_ms: int) -> Tuple[bool,int,str,Dict[str,int]]:
+    """Connect to every port in tcp_ports at once; up only if all accept."""
+    ip, ports = m.get("ip",""), m.get("tcp_ports") or []
+    if not ip or not ports:
+        return False, 0, "tcp_multi requires ip and tcp_ports", {}
+    try:
+        addr = ip if is_ipv6(ip) else socket.gethostbyname(ip)
+    except OSError as e:
+        return False, 0, str(e), {}
+    opened = tcp_connect_sweep([(addr, p) for p in ports], timeout_ms, len(ports))
+    detail = {str(p): opened[(addr, p)] for p in ports if (addr, p) in opened}
+    closed = [str(p) for p in ports if (addr, p) not in opened]
+    if closed:
+        return False, 0, f"closed or filtered: {', '.join(closed)}", detail
+    return True, max(detail.values()), "", detail
+
+def do_check(m: Dict[str, Any]) -> Tuple[bool,int,str,Dict[str,int]]:
+    """Run the device's check: (ok, rtt_ms, error, per-step/per-port RTT breakdown)."""
+    check = (m.get("check") or "icmp").lower()
+    timeout_ms = int(m.get("check_timeout_ms") or 0) or CHECK_TIMEOUT_MS
+    if check == "http":
+        return check_http(m, timeout_ms)
+    if check == "tcp_multi":
+        return check_tcp_ports(m, timeout_ms)
+    if check == "tcp":
+        ok, rtt, err = ping_tcp(m.get("ip",""), int(m.get("tcp_port") or 0), timeout_ms)
+        return ok, rtt, err, {"connect_ms": rtt} if ok else {}
+    if PROBE_BACKEND != "subprocess" and not is_ipv6(m.get("ip","")):
+        pinger = icmp_pinger()  # IPv4 only; IPv6 targets go through the system ping
+        if pinger is not None:
+            return (*pinger.ping(m.get("ip",""), timeout_ms), {})
+    return (*ping_icmp(m.get("ip",""), timeout_ms), {})
+
+def tcp_connect_sweep(targets: Iterable[Tuple[str, int]], timeout_ms: int, concurrency: int,
+                      progress=None) -> Dict[Tuple[str, int], int]:
+    """Non-blocking TCP connects to many (ip, port) pairs from one thread.
+
+    At most ``concurrency`` sockets are in flight; each gets ``timeout_ms``.
+    Returns the pairs that accepted, with connect time in ms. ``progress``
+    is called with the number of pairs finished so far.
+    """
+    sel = selectors.DefaultSelector()
+    pending = iter(targets)
+    inflight: Dict[socket.socket, Tuple[Tuple[str, int], float]] = {}   # insertion order = start order
+    found: Dict[Tuple[str, int], int] = {}
+    timeout = timeout_ms / 1000.0
+    done = 0
+    in_progress = (errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", 10035))
+
+    def finish(sock: socket.socket) -> None:
+        nonlocal done
+        sel.unregister(sock)
+        sock.close()
+        done += 1
+
+    try:
+        while True:
+            while len(inflight) < concurrency:
+                target = next(pending, None)
+                if target is None:
+                    break
+                sock = socket.socket(socket.AF_INET6 if ":" in target[0] else socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    err = sock.connect_ex(target)
+                except OSError:
+                    err = -1
+                if err == 0:
+                    found[target] = 0
+                if err not in in_progress:
+                    sock.close(); done += 1
+                    continue
+                inflight[sock] = (target, time.perf_counter())
+                sel.register(sock, selectors.EVENT_WRITE)
+            if not inflight:
+                break
+            for key, _ev in sel.select(timeout=0.05):
+                sock = key.fileobj
+                target, started = inflight.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    found[target] = int((time.perf_counter() - started) * 1000 + 0.5)
+                finish(sock)
+            now = time.perf_counter()
+            for sock, (target, started) in list(inflight.items()):
+                if now - started < timeout:
+                    break
+                del inflight[sock]
+                finish(sock)
+            if progress is not None:
+                progress(done)
+    finally:
+        for sock in inflight:
+            sock.close()
+        sel.close()
+    return found
+
+def guess_category(ports: Iterable[int]) -> str:
+    open_ports = set(ports)
+    for cat, sig in DISCOVERY_FINGERPRINTS.items():
+        if cat in CATEGORIES and open_ports & sig:
+            return cat
+    return "global"
+
+class AlertDispatcher:
+    """Queues state-change alerts and delivers them off the probe threads.
+
+    Flap damping is stateless: a device is reported down when its
+    ``consec_down`` reaches ALERT_DOWN_AFTER, and back up only if it had
+    got that far. Events arriving within ALERT_BATCH_SECONDS of the first
+    one are merged into a single digest post carrying each device's net
+    change: UP is only sent for devices whose DOWN was delivered, so a
+    device that went down and came back within one window posts nothing.
+    Delivery uses one pooled session and retries with exponential backoff.
+    """
+    def __init__(self, url: str, window_s: float, retries: int, maxsize: int):
+        self.url = url
+        self.window_s = window_s
+        self.retries = retries
+        self._q: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=maxsize)
+        self._session: Optional[requests.Session] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.queued = self.dropped = self.messages = self.delivered = self.failed = self.retried = 0
+        self.suppressed = 0
+        self._reported_down: set = set()   # device ids whose DOWN was delivered
+        self.latency_ms_last = self.latency_ms_max = 0.0
+        self._latency_ms_sum = 0.0
+
+    def observe(self, m: Dict[str, Any], prev_down: int) -> None:
+        """Called with a snapshot of the device after each probe result."""
+        if not self.url:
+            return
+        down = int(m.get("consec_down") or 0)
+        if m.get("last_status") == "down" and down == ALERT_DOWN_AFTER:
+            self.enqueue(m, "down")
+        elif m.get("last_status") == "up" and prev_down >= ALERT_DOWN_AFTER:
+            self.enqueue(m, "up")
+
+    def enqueue(self, m: Dict[str, Any], status: str) -> None:
+        ev = {"status": status, "id": m.get("id") or "", "name": m.get("name") or "(unnamed)", "ip": m.get("ip",""),
+              "os": m.get("os",""), "rtt_ms": m.get("last_rtt_ms",0), "at": time.monotonic()}
+        try:
+            self._q.put_nowait(ev)
+        except queue.Full:
+            with self._lock: self.dropped += 1
+            METRICS.inc("pcmon_alerts_dropped_total")
+            return
+        with self._lock:
+            self.queued += 1
+            if self._thread is None:
+                self._session = requests.Session()
+                self._session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+                self._thread = threading.Thread(target=self._run, name="alerts", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._q.get()]
+            until = time.monotonic() + self.window_s
+            while True:
+                left = until - time.monotonic()
+                if left <= 0: break
+                try: batch.append(self._q.get(timeout=left))
+                except queue.Empty: break
+            self._deliver(batch)
+
+    def net_changes(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Each device's latest event, kept only if it changes what was last delivered."""
+        latest = {e["id"] or (e["name"], e["ip"]): e for e in batch}
+        with self._lock:
+            reported = set(self._reported_down)
+        return [e for key, e in latest.items() if (e["status"] == "down") != (key in reported)]
+
+    def format(self, events: List[Dict[str, Any]]) -> str:
+        if len(events) == 1:
+            e = events[0]
+            return f"[{APP_NAME}] {e['name']} is {e['status'].upper()}\nIP: {e['ip']}\nOS: {e['os']}\nRTT: {e['rtt_ms']} ms"
+        downs = [e for e in events if e["status"] == "down"]
+        ups = [e for e in events if e["status"] == "up"]
+        lines = [f"[{APP_NAME}] {len(downs)} DOWN, {len(ups)} UP"]
+        for e in (downs + ups)[:ALERT_DIGEST_LINES]:
+            lines.append(f"{e['status'].upper()}: {e['name']} ({e['ip']})")
+        if len(events) > ALERT_DIGEST_LINES:
+            lines.append(f"… and {len(events) - ALERT_DIGEST_LINES} more")
+        return "\n".join(lines)
+
+    def _deliver(self, batch: List[Dict[str, Any]]) -> None:
+        events = self.net_changes(batch)
+        with self._lock:
+            self.suppressed += len(batch) - len(events)
+        if not events:
+            return
+        text = self.format(events)
+        ok = False
+        for attempt in range(self.retries + 1):
+            delay = 2 ** attempt
+            try:
+                r = self._session.post(self.url, json={"text": text}, timeout=6)
+                if r.status_code < 400:
+                    ok = True
+                    break
+                if r.status_code != 429 and r.status_code < 500:
+                    print("Slack alert rejected:", r.status_code)  # retrying won't help
+                    METRICS.inc("pcmon_alert_messages_total", ("rejected",))
+                    break
+                ra = r.headers.get("Retry-After", "")
+                delay = int(ra) if ra.isdigit() else delay
+            except Exception as e:
+                print("Slack alert failed:", e)
+            if attempt < self.retries:
+                with self._lock: self.retried += 1
+                METRICS.inc("pcmon_alert_retries_total")
+                time.sleep(min(delay, 60))
+        now = time.monotonic()
+        METRICS.inc("pcmon_alert_messages_total", ("delivered" if ok else "failed",))
+        with self._lock:
+            self.messages += 1
+            if ok:
+                for e in events:
+                    key = e["id"] or (e["name"], e["ip"])
+                    if e["status"] == "down": self._reported_down.add(key)
+                    else: self._reported_down.discard(key)
+                self.delivered += len(events)
+                for e in events:
+                    METRICS.observe("pcmon_alert_delivery_seconds", (), now - e["at"])
+                    ms = (now - e["at"]) * 1000.0
+                    self._latency_ms_sum += ms
+                    self.latency_ms_max = max(self.latency_ms_max, ms)
+                self.latency_ms_last = (now - events[-1]["at"]) * 1000.0
+            else:
+                self.failed += len(events)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"enabled": bool(self.url), "queue_depth": self._q.qsize(), "queued": self.queued,
+                    "dropped": self.dropped, "messages": self.messages, "delivered": self.delivered,
+                    "failed": self.failed, "retries": self.retried, "suppressed": self.suppressed,
+                    "latency_ms_avg": round(self._latency_ms_sum / self.delivered, 1) if self.delivered else 0,
+                    "latency_ms_last": round(self.latency_ms_last, 1),
+                    "latency_ms_max": round(self.latency_ms_max, 1)}
+
+ALERTS = AlertDispatcher(os.getenv("SLACK_WEBHOOK_URL",""), ALERT_BATCH_SECONDS, ALERT_RETRIES, ALERT_QUEUE_SIZE)
+
+def update_after_ping(mid: str, ok: bool, rtt_ms: int, err: str, detail: Optional[Dict[str, int]] = None) -> None:
+    with state_lock:
+        m = STATE["machines"].get(mid)
+        if not m:
+            return
+        m = STATE["machines"][mid] = dict(m)  # copy-on-write; snapshots share the old record
+        prev = m.get("last_status","down")
+        prev_down = int(m.get("consec_down",0))
+        now = datetime.utcnow()
+        m["total_pings"] = int(m.get("total_pings",0)) + 1
+        if ok:
+            m["up_pings"] = int(m.get("up_pings",0)) + 1
+            m["last_seen"] = now.isoformat()
+            m["last_status"] = "up"
+            m["consec_down"] = 0
+            m["last_rtt_ms"] = rtt_ms
+            m["last_error"] = ""
+        else:
+            m["consec_down"] = int(m.get("consec_down",0)) + 1
+            m["last_status"] = "down"
+            m["last_rtt_ms"] = 0
+            m["last_error"] = err
+        m["last_rtt_detail"] = detail or {}
+        PERSIST.mark_dirty(); append_log(m, ok, rtt_ms, err)
+        ROLLUPS.record(now, m, ok, rtt_ms, prev != m["last_status"])
+        CHANGES.machines([m])
+        interval = SCHEDULER.interval_for(m)
+        snap = dict(m)
+    SCHEDULER.schedule(mid, interval)
+    ALERTS.observe(snap, prev_down)
+
+def subnet_key(ip: str, prefix: int = PING_SUBNET_PREFIX) -> str:
+    try:
+        return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+    except ValueError:
+        return ip or ""
+
+def check_key(m: Dict[str, Any]) -> Tuple:
+    """The fields a check result depends on; a cached result only answers for the same key."""
+    return (m.get("ip"), m.get("check"), m.get("tcp_port"), tuple(m.get("tcp_ports") or ()), m.get("http_path"),
+            m.get("http_tls"), m.get("http_status"), m.get("http_match"), m.get("http_verify"), m.get("check_timeout_ms"))
+
+class ProbeFlights:
+    """Per-device single-flight for checks plus a short-lived result cache.
+
+    Callers asking for a device that is already being checked with the
+    same ``check_key`` wait for that check instead of starting another;
+    only the caller that ran it records the result, so the state file and
+    history see one probe. A caller whose key differs (the device was just
+    edited) leads a new flight. Callers that pass ``max_age`` may also get
+    a result recorded within that many seconds for the same key. A waiter
+    with a ``deadline`` (time.monotonic()) gives up then and gets None.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[str, Tuple[Tuple, Future]] = {}
+        self._recent: Dict[str, Tuple[float, Tuple, Any]] = {}
+
+    def run(self, mid: str, key: Tuple, fn, max_age: float = 0,
+            deadline: Optional[float] = None) -> Tuple[Any, str]:
+        with self._lock:
+            hit = self._recent.get(mid)
+            if max_age > 0 and hit and hit[1] == key and time.monotonic() - hit[0] <= max_age:
+                METRICS.inc("pcmon_probes_deduplicated_total", ("cache",))
+                return hit[2], "cache"
+            flight = self._flights.get(mid)
+            leader = flight is None or flight[0] != key
+            if leader:
+                flight = self._flights[mid] = (key, Future())
+        fut = flight[1]
+        if not leader:
+            METRICS.inc("pcmon_probes_deduplicated_total", ("shared",))
+            try:
+                return fut.result(None if deadline is None else max(0.0, deadline - time.monotonic())), "shared"
+            except FutureTimeout:
+                return None, "shared"
+        try:
+            res = fn()
+        except BaseException as e:
+            self._land(mid, flight)
+            fut.set_exception(e)
+            raise
+        self._land(mid, flight, key, res)
+        fut.set_result(res)
+        return res, "probe"
+
+    def _land(self, mid: str, flight: Tuple[Tuple, Future], key: Optional[Tuple] = None, res: Any = None) -> None:
+        with self._lock:
+            if self._flights.get(mid) is flight:  # a newer flight for an edited device stays
+                del self._flights[mid]
+            if res is not None and mid in STATE.get("machines", {}):  # not if deleted mid-check
+                self._recent[mid] = (time.monotonic(), key, res)
+
+    def forget(self, mid: str) -> None:
+        """Drop a deleted device's cached result."""
+        with self._lock:
+            self._recent.pop(mid, None)
+
+FLIGHTS = ProbeFlights()
+
+class ProbeEngine:
+    """Runs device checks on a shared, bounded thread pool.
+
+    Optional per-floor / per-subnet caps keep a single switch or floor from
+    being hammered; a sweep deadline bounds how long one pass may take.
+    """
+    def __init__(self, workers: int, floor_cap: int = 0, subnet_cap: int = 0):
+        self.workers = max(1, workers)
+        self.floor_cap = floor_cap
+        self.subnet_cap = subnet_cap
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="probe")
+        self._caps: Dict[str, threading.BoundedSemaphore] = {}
+        self._caps_lock = threading.Lock()
+
+    def _cap(self, key: str, limit: int) -> threading.BoundedSemaphore:
+        with self._caps_lock:
+            sem = self._caps.get(key)
+            if sem is None:
+                sem = self._caps[key] = threading.BoundedSemaphore(limit)
+            return sem
+
+    def _group_keys(self, m: Dict[str, Any]) -> List[Tuple[str,int]]:
+        keys = []
+        if self.floor_cap > 0:
+            keys.append(("floor:" + (m.get("floor_id") or ""), self.floor_cap))
+        if self.subnet_cap > 0:
+            keys.append(("net:" + subnet_key(m.get("ip","")), self.subnet_cap))
+        return keys
+
+    def _interleave(self, items: List[Tuple[str, Dict[str, Any]]]) -> List[Tuple[str, Dict[str, Any]]]:
+        # Round-robin across cap groups so workers blocked on one capped
+        # floor/subnet don't starve the rest of the queue.
+        if not (self.floor_cap or self.subnet_cap):
+            return items
+        groups: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {}
+        for it in items:
+            groups.setdefault("|".join(k for k,_ in self._group_keys(it[1])), []).append(it)
+        out = []
+        queues = list(groups.values())
+        while queues:
+            for q in queues:
+                out.append(q.pop(0))
+            queues = [q for q in queues if q]
+        return out
+
+    def probe(self, m: Dict[str, Any], deadline: Optional[float] = None) -> Optional[Tuple[bool,int,str,Dict[str,int]]]:
+        """Check one device honouring the group caps; None if the deadline passed first."""
+        held = []
+        try:
+            for key, limit in self._group_keys(m):
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    return None
+                sem = self._cap(key, limit)
+                if not sem.acquire(timeout=timeout):
+                    return None
+                held.append(sem)
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            t0 = time.perf_counter()
+            res = do_check(m)
+            METRICS.observe("pcmon_probe_duration_seconds", (m.get("check") or "icmp", "up" if res[0] else "down"),
+                            time.perf_counter() - t0)
+            return res
+        finally:
+            for sem in reversed(held):
+                sem.release()
+
+    def check(self, mid: str, m: Dict[str, Any], deadline: Optional[float] = None, max_age: float = 0,
+              capped: bool = True) -> Tuple[Optional[Tuple[bool,int,str,Dict[str,int]]], str]:
+        """Probe and record one device through FLIGHTS; returns (result, source)."""
+        def run():
+            res = self.probe(m, deadline) if capped else do_check(m)
+            if res is not None:
+                update_after_ping(mid, *res)
+            return res
+        return FLIGHTS.run(mid, check_key(m), run, max_age, deadline)
+
+    def _run(self, mid: str, m: Dict[str, Any], deadline: Optional[float]):
+        t0 = time.perf_counter()
+        res, _ = self.check(mid, m, deadline)
+        if res is None:
+            return None
+        return res[0], (time.perf_counter() - t0) * 1000.0
+
+    def submit(self, mid: str, m: Dict[str, Any]):
+        """Queue a single check (e.g. a new device's first probe) on the pool."""
+        return self.pool.submit(self._run, mid, m, None)
+
+    def sweep(self, ids: Optional[List[str]] = None, deadline_s: Optional[float] = None) -> Dict[str, Any]:
+        machines = VIEW.get().machines
+        items = [(mid, machines[mid]) for mid in (ids if ids is not None else list(machines)) if mid in machines]
+        items = self._interleave(items)
+        started = time.monotonic()
+        deadline = started + deadline_s if deadline_s else None
+        futs = [self.pool.submit(self._run, mid, m, deadline) for mid, m in items]
+        done, pending = wait(futs, timeout=deadline_s or None)
+        up = down = skipped = unfinished = 0
+        for f in pending:
+            # Never-started probes are dropped; ones already running still
+            # land through update_after_ping when they finish.
+            if f.cancel(): skipped += 1
+            else: unfinished += 1
+        probe_ms: List[float] = []
+        for f in done:
+            res = None if f.cancelled() or f.exception() else f.result()
+            if res is None:
+                skipped += 1; continue
+            ok, ms = res
+            probe_ms.append(ms)
+            if ok: up += 1
+            else: down += 1
+        PERSIST.flush()
+        METRICS.observe("pcmon_sweep_duration_seconds", (), time.monotonic() - started)
+        if pending or skipped:
+            METRICS.inc("pcmon_sweep_overruns_total")
+        return {
+            "up": up, "down": down, "total": len(items),
+            "skipped": skipped,
+            "unfinished": unfinished,
+            "deadline_hit": bool(pending) or skipped > 0,
+            "elapsed_ms": int((time.monotonic() - started) * 1000),
+            "probe_ms_avg": round(sum(probe_ms) / len(probe_ms), 1) if probe_ms else 0,
+            "probe_ms_max": round(max(probe_ms), 1) if probe_ms else 0,
+            "workers": self.workers,
+        }
+
+PROBE_ENGINE = ProbeEngine(PING_WORKERS, PING_FLOOR_CONCURRENCY, PING_SUBNET_CONCURRENCY)
+
+def ping_all_once() -> Dict[str,Any]:
+    return PROBE_ENGINE.sweep(deadline_s=PING_SWEEP_DEADLINE_SECONDS)
+
+class ProbeScheduler:
+    """Probes each device on its own clock from a min-heap of due times.
+
+    Intervals come from the device (``probe_interval_s``), its category
+    (PROBE_CATEGORY_INTERVALS) or PROBE_INTERVAL_SECONDS, with jitter so
+    probes spread out instead of bunching. A device that just went down is
+    rechecked every PROBE_RECHECK_SECONDS; after PROBE_BACKOFF_AFTER misses
+    the interval doubles per miss up to PROBE_BACKOFF_MAX_SECONDS.
+    Heap entries are invalidated lazily: ``_due`` holds the live due time.
+    """
+    def __init__(self, engine: ProbeEngine):
+        self.engine = engine
+        self._heap: List[Tuple[float, str]] = []
+        self._due: Dict[str, float] = {}
+        self._inflight: set = set()
+        self._cond = threading.Condition()
+        self._started = False
+        self.dispatched = 0
+
+    def interval_for(self, m: Dict[str, Any]) -> float:
+        base = int(m.get("probe_interval_s") or 0) or PROBE_CATEGORY_INTERVALS.get(m.get("category") or "global") or PROBE_INTERVAL_SECONDS
+        down = int(m.get("consec_down") or 0)
+        if down == 0:
+            iv = base
+        elif down <= PROBE_BACKOFF_AFTER:
+            iv = min(base, PROBE_RECHECK_SECONDS)
+        else:
+            # Never probe a dead device more often than a healthy one.
+            iv = min(max(base, PROBE_BACKOFF_MAX_SECONDS), base * 2 ** min(down - PROBE_BACKOFF_AFTER, 16))
+        return max(1.0, iv * (1 + random.uniform(-PROBE_JITTER, PROBE_JITTER)))
+
+    def schedule(self, mid: str, delay: float) -> None:
+        with self._cond:
+            if not self._started:
+                return
+            due = time.monotonic() + delay
+            self._due[mid] = due
+            heapq.heappush(self._heap, (due, mid))
+            self._cond.notify()
 
-def notify_state_change(mid: str, old: str, new: str):
-    if old == new:
-        return
-    with state_lock:
-        m = STATE["machines"].get(mid)
-    if not m:
-        return
-    slack = os.getenv("SLACK_WEBHOOK_URL","")
-    if slack:
+    def start(self) -> None:
+        with state_lock:
+            spread = [(mid, random.uniform(0, min(PROBE_STARTUP_SPREAD_SECONDS, self.interval_for(m))))
+                      for mid, m in STATE["machines"].items()]
+        with self._cond:
+            self._started = True
+        for mid, delay in spread:
+            self.schedule(mid, delay)
+        threading.Thread(target=self._loop, name="probe-scheduler", daemon=True).start()
+        threading.Thread(target=self._reconcile_loop, name="probe-reconcile", daemon=True).start()
+
+    def _reconcile_loop(self) -> None:
+        # Devices added or removed by any route are picked up here.
+        while True:
+            time.sleep(30)
+            with self._cond:
+                known = set(self._due) | self._inflight
+            with state_lock:
+                live = set(STATE["machines"])
+                new = [(mid, random.uniform(0, min(PROBE_STARTUP_SPREAD_SECONDS, self.interval_for(m))))
+                       for mid, m in STATE["machines"].items() if mid not in known]
+            with self._cond:
+                for mid in [mid for mid in self._due if mid not in live]:
+                    del self._due[mid]
+            for mid, delay in new:
+                self.schedule(mid, delay)
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait_s = self._heap[0][0] - time.monotonic()
+                    if wait_s > 0:
+                        self._cond.wait(wait_s)
+                    elif len(self._inflight) < self.engine.workers:
+                        break
+                    else:
+                        self._cond.wait()  # pool saturated; a finishing probe notifies
+                _, mid = heapq.heappop(self._heap)
+                del self._due[mid]
+                self._inflight.add(mid)
+                self.dispatched += 1
+            self.engine.pool.submit(self._probe, mid)
+
+    def _probe(self, mid: str) -> None:
         try:
-            text = f"[{APP_NAME}] {m.get('name','(unnamed)')} is {new.upper()}\nIP: {m.get('ip','')}\nOS: {m.get('os','')}\nRTT: {m.get('last_rtt_ms',0)} ms"
-            requests.post(slack, json={"text": text}, timeout=6)
+            with state_lock:
+                m = STATE["machines"].get(mid)
+                m = m.copy() if m else None
+            if m is not None and self.engine.check(mid, m)[0] is None:
+                self.schedule(mid, PROBE_RECHECK_SECONDS)  # joined a sweep probe that hit its deadline
         except Exception as e:
-            print("Slack alert failed:", e)
+            print("Scheduled probe failed:", mid, e)
+            with state_lock:
+                m = STATE["machines"].get(mid)
+                interval = self.interval_for(m) if m else None
+            if interval:
+                self.schedule(mid, interval)
+        finally:
+            with self._cond:
+                self._inflight.discard(mid)
+                self._cond.notify()
 
-def update_after_ping(mid: str, ok: bool, rtt_ms: int, err: str) -> None:
-    with state_lock:
-        m = STATE["machines"].get(mid)
-        if not m:
-            return
-        prev = m.get("last_status","down")
-        m["total_pings"] = int(m.get("total_pings",0)) + 1
-        if ok:
-            m["up_pings"] = int(m.get("up_pings",0)) + 1
-            m["last_seen"] = datetime.utcnow().isoformat()
-            m["last_status"] = "up"
-            m["consec_down"] = 0
-            m["last_rtt_ms"] = rtt_ms
-            m["last_error"] = ""
-        else:
-            m["consec_down"] = int(m.get("consec_down",0)) + 1
-            m["last_status"] = "down"
-            m["last_rtt_ms"] = 0
-            m["last_error"] = err
-        save_state(STATE); append_log(m, ok, rtt_ms, err)
-    if prev != m["last_status"]:
-        notify_state_change(mid, prev, m["last_status"])
+    def summary(self) -> Dict[str, Any]:
+        downs = [int(m.get("consec_down") or 0) for m in VIEW.get(PUBLIC_SNAPSHOT_SECONDS).machines.values()]
+        now = time.monotonic()
+        with self._cond:
+            dues = sorted(self._due.values())
+            inflight = len(self._inflight)
+        nxt = max(0.0, dues[0] - now) if dues else None
+        return {
+            "scheduler": "adaptive" if self._started else "off",
+            "next_probe_in_s": round(nxt, 1) if nxt is not None else None,
+            "next_probe_at": (datetime.utcnow() + timedelta(seconds=nxt)).isoformat() + "Z" if nxt is not None else None,
+            "scheduled": len(dues),
+            "in_flight": inflight,
+            "overdue": sum(1 for d in dues if d < now - 5),
+            "due_next_minute": sum(1 for d in dues if d <= now + 60),
+            "rechecking": sum(1 for d in downs if 0 < d <= PROBE_BACKOFF_AFTER),
+            "backed_off": sum(1 for d in downs if d > PROBE_BACKOFF_AFTER),
+            "default_interval_s": PROBE_INTERVAL_SECONDS,
+            "dispatched": self.dispatched,
+        }
 
-def ping_all_once() -> Dict[str,int]:
-    with state_lock:
-        ids = list(STATE["machines"].keys())
-    up = down = 0
-    for mid in ids:
-        with state_lock:
-            mm = STATE["machines"][mid].copy()
-        ok,rtt,err = do_check(mm)
-        update_after_ping(mid, ok, rtt, err)
-        if ok: up+=1
-        else: down+=1
-    return {"up":up,"down":down,"total":len(ids)}
-
-def convert_pdf_to_png(input_path: Path, output_png: Path, page: int = 1, dpi: int = 220) -> None:
+SCHEDULER = ProbeScheduler(PROBE_ENGINE)
+
+def convert_pdf_to_png(input_path: Path, output_png: Path, page: int = 1, dpi: int = MAP_DEFAULT_DPI, rotation: int = 0) -> None:
     if pdfium is None:
         raise RuntimeError(f"PDF not supported: pypdfium2 not available. Import error: {PDFIUM_IMPORT_ERROR or 'install pypdfium2'}")
     doc = pdfium.PdfDocument(str(input_path))
@@ -259,14 +2432,336 @@ def convert_pdf_to_png(input_path: Path, output_png: Path, page: int = 1, dpi: i
         page_index = page - 1
         page_obj = doc.get_page(page_index)
         try:
-            bitmap = page_obj.render(scale=(dpi/72.0))
+            bitmap = page_obj.render(scale=(dpi/72.0), rotation=rotation)
             pil_img = bitmap.to_pil()
-            pil_img.save(str(output_png))
+            pil_img.save(str(output_png), format="PNG")
         finally:
             page_obj.close()
     finally:
         doc.close()
 
+def pdf_page_count(path: Path) -> int:
+    if pdfium is None:
+        raise RuntimeError(f"PDF not supported: pypdfium2 not available. Import error: {PDFIUM_IMPORT_ERROR or 'install pypdfium2'}")
+    doc = pdfium.PdfDocument(str(path))
+    try:
+        return len(doc)
+    finally:
+        doc.close()
+
+def store_map_source(upload: Path) -> Path:
+    """Move an uploaded PDF into SOURCES_DIR under its content hash."""
+    h = hashlib.sha256()
+    with upload.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    SOURCES_DIR.mkdir(parents=True, exist_ok=True)
+    dest = SOURCES_DIR / f"{h.hexdigest()[:16]}.pdf"
+    if dest.exists():
+        upload.unlink(missing_ok=True)
+    else:
+        upload.replace(dest)
+    return dest
+
+class RenderCache:
+    """On-disk cache of rendered PDF pages, evicted least-recently-used by size.
+
+    Entries are keyed by (source hash, page, dpi, rotation); the source hash
+    is the stem of the file in SOURCES_DIR. Recency survives restarts via
+    file mtimes, which are bumped on every hit.
+    """
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._rendering: Dict[str, threading.Lock] = {}
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        files = sorted((p.stat().st_mtime, p.name, p.stat().st_size) for p in self.root.glob("*.png"))
+        for _, name, size in files:
+            self._entries[name] = size
+            self._bytes += size
+        self._loaded = True
+
+    def _lookup(self, name: str) -> Optional[Path]:
+        p = self.root / name
+        if name in self._entries and p.exists():
+            self._entries.move_to_end(name)
+            self.hits += 1
+            try: os.utime(p)
+            except OSError: pass
+            return p
+        if name in self._entries:
+            self._bytes -= self._entries.pop(name)
+        return None
+
+    def get(self, source: Path, page: int, dpi: int, rotation: int = 0) -> Path:
+        name = f"{source.stem}-p{page}-d{dpi}-r{rotation}.png"
+        with self._lock:
+            self._load()
+            hit = self._lookup(name)
+            if hit:
+                return hit
+            key_lock = self._rendering.setdefault(name, threading.Lock())
+        with key_lock:
+            with self._lock:
+                hit = self._lookup(name)
+                if hit:
+                    return hit
+                self.misses += 1
+            tmp = self.root / f"{name}.{os.urandom(4).hex()}.tmp"
+            try:
+                JOBS.run_in_process(convert_pdf_to_png, source, tmp, page, dpi, rotation)
+                out = self.root / name
+                tmp.replace(out)
+            except BaseException:
+                with self._lock:
+                    self._rendering.pop(name, None)
+                raise
+            finally:
+                tmp.unlink(missing_ok=True)
+            # Register before the key lock is released, so a waiter finds the entry.
+            with self._lock:
+                size = out.stat().st_size
+                self._bytes += size - self._entries.pop(name, 0)
+                self._entries[name] = size
+                self._rendering.pop(name, None)
+                self._evict(keep=name)
+            return out
+
+    def _evict(self, keep: str) -> None:
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = next(iter(self._entries.items()))
+            if name == keep:
+                break
+            del self._entries[name]
+            self._bytes -= size
+            self.evictions += 1
+            (self.root / name).unlink(missing_ok=True)
+
+    def drop_source(self, stem: str) -> None:
+        with self._lock:
+            self._load()
+            for name in [n for n in self._entries if n.startswith(stem + "-")]:
+                self._bytes -= self._entries.pop(name)
+                (self.root / name).unlink(missing_ok=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+RENDER_CACHE = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MB * 1024 * 1024)
+
+def build_map_tiles(png: Path) -> Dict[str, Any]:
+    """Cut a rendered map into a tile pyramid plus a small preview.
+
+    Tiles live under ``TILES_DIR/<content hash>/<z>/<x>_<y>.<fmt>``; level
+    ``max_zoom`` is full resolution and each lower level halves it, down to
+    a single tile at z=0. The directory is built under a temporary name and
+    renamed into place, so a hash directory is always complete.
+    """
+    if Image is None:
+        raise RuntimeError("Map tiles need Pillow")
+    h = hashlib.sha1()
+    with png.open("rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()[:16]
+    out = TILES_DIR / digest
+    meta_file = out / "meta.json"
+    if meta_file.exists():
+        return json.loads(meta_file.read_text(encoding="utf-8"))
+    fmt = "webp" if pil_features is not None and pil_features.check("webp") else "png"
+    T = MAP_TILE_SIZE
+    tmp = TILES_DIR / f"{digest}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    with Image.open(png) as src:
+        im = src.convert("RGB")
+    w, hgt = im.size
+    max_zoom = max(0, math.ceil(math.log2(max(w, hgt) / T))) if max(w, hgt) > T else 0
+    level = im
+    for z in range(max_zoom, -1, -1):
+        zdir = tmp / str(z)
+        zdir.mkdir()
+        lw, lh = level.size
+        for ty in range(math.ceil(lh / T)):
+            for tx in range(math.ceil(lw / T)):
+                tile = level.crop((tx*T, ty*T, min(lw, (tx+1)*T), min(lh, (ty+1)*T)))
+                tile.save(zdir / f"{tx}_{ty}.{fmt}", quality=82)
+        if z:
+            level = level.resize((max(1, (lw+1)//2), max(1, (lh+1)//2)), Image.LANCZOS)
+    preview = im.copy()
+    preview.thumbnail((MAP_PREVIEW_PX, MAP_PREVIEW_PX), Image.LANCZOS)
+    preview.save(tmp / f"preview.{fmt}", quality=82)
+    meta = {"hash": digest, "width": w, "height": hgt, "tile": T, "max_zoom": max_zoom, "format": fmt}
+    (tmp / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+    if out.exists():
+        shutil.rmtree(out, ignore_errors=True)
+    tmp.replace(out)
+    return meta
+
+def prune_map_tiles() -> None:
+    """Remove tile sets and source PDFs no floor refers to any more."""
+    with state_lock:
+        live = {(f.get("tiles") or {}).get("hash") for f in STATE.get("floors", [])}
+        sources = {Path(f["map_source"]).name for f in STATE.get("floors", []) if f.get("map_source")}
+    if TILES_DIR.exists():
+        for d in TILES_DIR.iterdir():
+            if d.is_dir() and d.name not in live and not d.name.endswith(".tmp"):
+                shutil.rmtree(d, ignore_errors=True)
+    if SOURCES_DIR.exists():
+        for p in SOURCES_DIR.glob("*.pdf"):
+            if p.name not in sources:
+                RENDER_CACHE.drop_source(p.stem)
+                p.unlink(missing_ok=True)
+
+class JobQueue:
+    """Background jobs with progress reporting for work too slow for a request.
+
+    Job bodies run on a small thread pool and hand CPU-heavy steps (PDF
+    rendering, tiling) to a process pool, so pdfium and Pillow never hold
+    the server's GIL. Only the last ``keep`` jobs are remembered.
+    """
+    def __init__(self, keep: int, processes: int):
+        self.keep = keep
+        self.processes = max(1, processes)
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._threads = ThreadPoolExecutor(max_workers=2, thread_name_prefix="job")
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def run_in_process(self, fn, *args):
+        with self._lock:
+            if self._pool is None:
+                # spawn: forking a threaded server can deadlock the child.
+                self._pool = ProcessPoolExecutor(max_workers=self.processes,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            pool = self._pool
+        return pool.submit(fn, *args).result()
+
+    def submit(self, kind: str, fn, *args, **info) -> Dict[str, Any]:
+        job = {"id": os.urandom(6).hex(), "kind": kind, "state": "queued", "progress": 0,
+               "message": "queued", "error": "", "result": None,
+               "created_at": datetime.utcnow().isoformat() + "Z", "finished_at": "", **info}
+        with self._lock:
+            self._jobs[job["id"]] = job
+            while len(self._jobs) > self.keep:
+                del self._jobs[next(iter(self._jobs))]
+        self._threads.submit(self._run, job, fn, args)
+        return dict(job)
+
+    def _run(self, job: Dict[str, Any], fn, args) -> None:
+        self.update(job["id"], state="running", message="running")
+        try:
+            result = fn(job["id"], *args)
+            self.update(job["id"], state="done", progress=100, message="done", result=result)
+        except Exception as e:
+            self.update(job["id"], state="error", message="failed", error=str(e))
+        finally:
+            self.update(job["id"], finished_at=datetime.utcnow().isoformat() + "Z")
+
+    def update(self, jid: str, **fields) -> None:
+        with self._lock:
+            job = self._jobs.get(jid)
+            if job is not None:
+                job.update(fields)
+
+    def get(self, jid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            job = self._jobs.get(jid)
+            return dict(job) if job else None
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(j) for j in reversed(list(self._jobs.values()))]
+
+JOBS = JobQueue(JOB_HISTORY, MAP_RENDER_WORKERS)
+LATEST_MAP_JOB: Dict[str, str] = {}
+
+_map_switch_lock = threading.Lock()
+
+def map_render_job(jid: str, floor_id: str, source: Path, page: int, dpi: int) -> Dict[str, Any]:
+    """Render (via the cache) and tile a floor's PDF page, then switch the floor over atomically."""
+    rendered = MAPS_DIR / f"{floor_id}.{jid}.png"
+    try:
+        JOBS.update(jid, progress=5, message="reading PDF")
+        pages = pdf_page_count(source)
+        if not 1 <= page <= pages:
+            raise RuntimeError(f"PDF page {page} out of range (1..{pages})")
+        JOBS.update(jid, progress=10, message=f"rendering page {page} at {dpi} dpi")
+        shutil.copyfile(RENDER_CACHE.get(source, page, dpi), rendered)
+        JOBS.update(jid, progress=60, message="building tiles")
+        try:
+            tiles = JOBS.run_in_process(build_map_tiles, rendered)
+        except Exception as e:
+            print("Map tiling failed:", e)
+            tiles = None
+        JOBS.update(jid, progress=95, message="switching map")
+        out_file = MAPS_DIR / f"{floor_id}.png"
+        # The rename runs outside state_lock; _map_switch_lock keeps a superseded
+        # job from swapping its file in after a newer one.
+        with _map_switch_lock:
+            with state_lock:
+                if LATEST_MAP_JOB.get(floor_id) != jid:
+                    raise RuntimeError("superseded by a newer upload")
+            rendered.replace(out_file)
+            with state_lock:
+                for floor in STATE["floors"]:
+                    if floor["id"] == floor_id:
+                        floor["map_file"] = str(out_file.resolve())
+                        floor["map_type"] = "raster"
+                        floor["tiles"] = tiles
+                        floor["map_source"] = str(source.resolve())
+                        floor["map_pages"] = pages
+                        floor["map_page"] = page
+                        floor["map_dpi"] = dpi
+                save_state(STATE); floors_changed()
+        for old in [MAPS_DIR / f"{floor_id}.svg",
+                    MAPS_DIR / f"{floor_id}.jpg", MAPS_DIR / f"{floor_id}.jpeg", MAPS_DIR / f"{floor_id}.webp"]:
+            if old.exists():
+                try: old.unlink()
+                except: pass
+    finally:
+        rendered.unlink(missing_ok=True)
+    prune_map_tiles()
+    return {"floor_id": floor_id, "map_type": "raster", "tiles": bool(tiles), "page": page, "pages": pages, "dpi": dpi}
+
+def parse_dpi(v: Any) -> int:
+    dpi = int(v)
+    if not MAP_DPI_MIN <= dpi <= MAP_DPI_MAX:
+        raise ValueError(f"dpi must be between {MAP_DPI_MIN} and {MAP_DPI_MAX}")
+    return dpi
+
+def queue_map_render(floor_id: str, source: Path, page: int, dpi: int) -> Dict[str, Any]:
+    # Callers hold state_lock, so the job cannot finish before it is marked latest.
+    job = JOBS.submit("map-render", map_render_job, floor_id, source, page, dpi, floor_id=floor_id)
+    LATEST_MAP_JOB[floor_id] = job["id"]
+    return job
+
+def ensure_map_tiles() -> None:
+    """Build tiles for floors whose map predates tiling."""
+    with state_lock:
+        todo = [(f["id"], f["map_file"]) for f in STATE.get("floors", []) if f.get("map_file") and not f.get("tiles")]
+    for fid, mf in todo:
+        try:
+            meta = JOBS.run_in_process(build_map_tiles, Path(mf))
+        except Exception as e:
+            print(f"Tiling map for floor {fid} failed:", e); continue
+        with state_lock:
+            for fl in STATE["floors"]:
+                if fl["id"] == fid and fl.get("map_file") == mf:
+                    fl["tiles"] = meta
+            save_state(STATE); floors_changed()
+
 @app.get("/")
 def ui():
     return render_template("index.html", app_name=APP_NAME, app_version=APP_VERSION)
@@ -279,9 +2774,50 @@ def diagnostics():
         "data_dir": str(DATA_DIR),
         "pdfium_ok": pdfium is not None,
         "pdfium_error": PDFIUM_IMPORT_ERROR,
+        "icmp_backend": icmp_backend(),
+        "icmp_error": _ICMP_PINGER_ERROR,
+        "log_writer": LOG_WRITER.stats(),
+        "log_lifecycle": LOG_LIFECYCLE.stats(),
+        "storage": STORE.stats() if STORE is not None else {"backend": "json", "path": str(STATE_FILE)},
+        "render_cache": RENDER_CACHE.stats(),
+        "alerts": ALERTS.stats(),
         "authenticated": authed(),
     })
 
+@app.before_request
+def _request_started():
+    g.t0 = time.perf_counter()
+
+@app.after_request
+def _request_finished(resp):
+    t0 = g.get("t0")
+    if t0 is not None:
+        route = request.url_rule.rule if request.url_rule else "<unmatched>"
+        METRICS.observe("pcmon_http_request_seconds", (route, request.method, str(resp.status_code)),
+                        time.perf_counter() - t0)
+    return resp
+
+def _machine_gauge() -> Dict[Tuple[str, ...], float]:
+    out: Dict[Tuple[str, ...], float] = {}
+    for m in VIEW.get(PUBLIC_SNAPSHOT_SECONDS).machines.values():
+        status = m.get("last_status", "down") if m.get("operational", True) else "storage"
+        key = (m.get("floor_id") or "", status)
+        out[key] = out.get(key, 0) + 1
+    return out
+
+METRICS.gauge("pcmon_machines", "Machines by floor and status (storage devices counted separately).",
+              ("floor", "status"), _machine_gauge)
+METRICS.gauge("pcmon_alert_queue_depth", "Alerts waiting to be sent.", (), lambda: {(): ALERTS.stats()["queue_depth"]})
+METRICS.gauge("pcmon_log_buffer_rows", "Ping log rows waiting to be flushed.", (), lambda: {(): LOG_WRITER.stats()["buffer_depth"]})
+METRICS.gauge("pcmon_probes_in_flight", "Scheduled probes currently running.", (), lambda: {(): SCHEDULER.summary()["in_flight"]})
+METRICS.gauge("pcmon_probes_overdue", "Devices past their scheduled probe time.", (), lambda: {(): SCHEDULER.summary()["overdue"]})
+
+@app.get("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 @app.post("/api/login")
 def api_login():
     body = request.get_json(silent=True) or {}
@@ -306,23 +2842,127 @@ def api_whoami():
 
 @app.get("/api/public/status")
 def public_status():
+    fleet = SCHEDULER.summary()
+    left = fleet["next_probe_in_s"]
     now = datetime.utcnow()
-    nxt = NEXT_PING_AT_UTC or next_quarter_utc(now)
     return jsonify({"now": now.isoformat()+"Z",
-                    "next_ping_at": nxt.isoformat()+"Z",
-                    "seconds_left": max(0, int((nxt-now).total_seconds()))})
+                    "next_ping_at": (now + timedelta(seconds=left)).isoformat()+"Z" if left is not None else None,
+                    "seconds_left": int(math.ceil(left)) if left is not None else None,
+                    "fleet": fleet})
 
-@app.get("/api/public/floors")
-def public_floors():
-    with state_lock:
-        fl = [{
+def public_floor_list(snap: Optional[Snapshot] = None) -> List[Dict[str, Any]]:
+    with state_lock if snap is None else contextlib.nullcontext():
+        floors = STATE.get("floors",[]) if snap is None else snap.floors
+        default = STATE.get("default_floor_id","main") if snap is None else snap.default_floor_id
+        return [{
             "id": f["id"],
             "name": f["name"],
-            "default": (f["id"]==STATE.get("default_floor_id","main")),
+            "default": (f["id"]==default),
             "categories_enabled": bool(f.get("categories_enabled", False)),
             "has_map": bool(f.get("map_file")),
-        } for f in STATE.get("floors",[])]
-    resp = make_response(jsonify(fl)); resp.headers["Cache-Control"]="no-store"; return resp
+            "tiles": f.get("tiles") if f.get("map_file") else None,
+            "pages": int(f.get("map_pages") or 1) if f.get("map_source") else 0,
+            "page": int(f.get("map_page") or 1),
+            "dpi": int(f.get("map_dpi") or MAP_DEFAULT_DPI),
+        } for f in floors]
+
+def floors_changed() -> None:
+    # Callers hold state_lock.
+    CHANGES.publish("floors", public_floor_list(), ("floors",))
+
+class PublicCache:
+    """Serialised public payloads keyed by (view, key), valid for one scope version."""
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], Tuple[int, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, view: str, key: str, version: int, build) -> bytes:
+        with self._lock:
+            hit = self._entries.get((view, key))
+        if hit is not None and hit[0] == version:
+            return hit[1]
+        body = app.json.dumps(build()).encode("utf-8")
+        with self._lock:
+            if len(self._entries) >= 512:
+                self._entries.clear()
+            self._entries[(view, key)] = (version, body)
+        return body
+
+PUBLIC_CACHE = PublicCache()
+
+def cached_public(view: str, key: str, scope: str, build):
+    """JSON response with a strong ETag; 304 when the client's copy is current."""
+    tag = lambda v: f"{CHANGES.epoch}.{v}.{hashlib.sha1(f'{view}|{key}'.encode()).hexdigest()[:10]}"
+    snap = VIEW.get(PUBLIC_SNAPSHOT_SECONDS)
+    version = snap.scope_version(scope)
+    if request.if_none_match.contains(tag(version)):
+        resp = make_response("", 304)
+    else:
+        body = PUBLIC_CACHE.get(view, key, version, lambda: build(snap))
+        resp = make_response(body)
+        resp.mimetype = "application/json"
+        resp.set_etag(tag(version))
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.get("/api/public/floors")
+def public_floors():
+    return cached_public("floors", "", "floors", public_floor_list)
+
+def sse_event(kind: str, version: int, payload: Any) -> str:
+    return f"id: {CHANGES.epoch}:{version}\nevent: {kind}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+def coalesce_changes(events: List[Tuple[int, str, Any]]) -> List[Tuple[int, str, Any]]:
+    """Fold a run of events into at most one machines and one floors event."""
+    upsert: Dict[str, Dict[str, Any]] = {}
+    deleted: Dict[str, None] = {}
+    floors = None
+    last = events[-1][0]
+    for _v, kind, payload in events:
+        if kind == "floors":
+            floors = payload
+            continue
+        for m in payload["upsert"]:
+            upsert[m.get("id","")] = m; deleted.pop(m.get("id",""), None)
+        for mid in payload["delete"]:
+            upsert.pop(mid, None); deleted[mid] = None
+    out = []
+    if floors is not None:
+        out.append((last, "floors", floors))
+    if upsert or deleted:
+        out.append((last, "machines", {"upsert": list(upsert.values()), "delete": list(deleted)}))
+    return out
+
+@app.get("/api/public/events")
+def public_events():
+    last_id = request.headers.get("Last-Event-ID") or request.args.get("since") or ""
+    epoch, _, v = last_id.partition(":")
+    start = int(v) if epoch == CHANGES.epoch and v.isdigit() else -1
+
+    def snapshot() -> Tuple[int, str]:
+        snap = VIEW.get(PUBLIC_SNAPSHOT_SECONDS)
+        body = {"machines": list(snap.machines.values()), "floors": public_floor_list(snap)}
+        return snap.version, sse_event("snapshot", snap.version, body)
+
+    def stream():
+        version = start
+        yield "retry: 3000\n\n"
+        while True:
+            events = CHANGES.since(version) if version >= 0 else None
+            if events is None:
+                version, ev = snapshot()
+                yield ev
+            elif events:
+                for v, kind, payload in coalesce_changes(events):
+                    yield sse_event(kind, v, payload)
+                version = events[-1][0]
+            elif not CHANGES.wait(version, SSE_HEARTBEAT_SECONDS):
+                yield ": keepalive\n\n"
+
+    resp = Response(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-store"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
 
 @app.route("/api/floors", methods=["GET","POST"])
 def floors_list_create():
@@ -335,7 +2975,7 @@ def floors_list_create():
     fid = (body.get("id") or re.sub(r"[^a-z0-9\-]+","", name.lower().replace(" ","-")) or f"floor-{int(time.time())}")
     with state_lock:
         STATE.setdefault("floors", []).append({"id": fid, "name": name, "map_file": "", "map_type": "", "categories_enabled": False})
-        save_state(STATE)
+        save_state(STATE); floors_changed()
     return jsonify({"id": fid, "name": name, "map_file": "", "map_type": "", "categories_enabled": False})
 
 @app.route("/api/floors/<fid>", methods=["PUT","DELETE"])
@@ -353,24 +2993,38 @@ def floors_update_delete(fid):
                 floors[idx]["categories_enabled"] = bool(body["categories_enabled"])
             if body.get("default") is True:
                 STATE["default_floor_id"] = fid
-            save_state(STATE); return jsonify(floors[idx])
-        if any(m.get("floor_id")==fid for m in STATE.get("machines",{}).values()):
+            job = None
+            if "map_page" in body or "map_dpi" in body:
+                fl = floors[idx]
+                if not fl.get("map_source") or not Path(fl["map_source"]).exists():
+                    return jsonify({"error":"floor has no source PDF; upload it again"}), 400
+                try:
+                    page = int(body.get("map_page", fl.get("map_page", 1)))
+                    dpi = parse_dpi(body.get("map_dpi", fl.get("map_dpi", MAP_DEFAULT_DPI)))
+                except (TypeError, ValueError) as e:
+                    return jsonify({"error": str(e)}), 400
+                if not 1 <= page <= int(fl.get("map_pages") or 1):
+                    return jsonify({"error": f"page must be between 1 and {fl.get('map_pages') or 1}"}), 400
+                job = queue_map_render(fid, Path(fl["map_source"]), page, dpi)
+            save_state(STATE); floors_changed()
+            return jsonify({**floors[idx], "job_id": job["id"], "job": job} if job else floors[idx])
+        if INDEX.by_floor.get(fid):
             return jsonify({"error":"floor has machines"}), 400
         floors.pop(idx)
         if STATE.get("default_floor_id")==fid and floors:
             STATE["default_floor_id"]=floors[0]["id"]
-        save_state(STATE); return "",204
+        save_state(STATE); floors_changed(); return "",204
 
 @app.get("/api/export/floors")
 def export_floors():
     require_auth()
-    with state_lock:
-        export_data = {
-            "floors": STATE.get("floors", []),
-            "default_floor_id": STATE.get("default_floor_id", "main"),
-            "export_timestamp": datetime.utcnow().isoformat() + "Z",
-            "version": APP_VERSION
-        }
+    snap = VIEW.get()
+    export_data = {
+        "floors": list(snap.floors),
+        "default_floor_id": snap.default_floor_id,
+        "export_timestamp": datetime.utcnow().isoformat() + "Z",
+        "version": APP_VERSION
+    }
     resp = make_response(jsonify(export_data))
     resp.headers["Content-Disposition"] = f"attachment; filename=floors-backup-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
     resp.headers["Content-Type"] = "application/json"
@@ -402,7 +3056,7 @@ def import_floors():
             if "default_floor_id" in data:
                 STATE["default_floor_id"] = data["default_floor_id"]
             
-            save_state(STATE)
+            save_state(STATE); floors_changed()
         
         return jsonify({"ok": True, "message": f"Imported {len(imported_floors)} floors"})
     except Exception:
@@ -411,84 +3065,275 @@ def import_floors():
 @app.get("/api/export/machines")
 def export_machines():
     require_auth()
-    with state_lock:
-        export_data = {
-            "version": APP_VERSION,
-            "exported_at": datetime.utcnow().isoformat() + "Z",
-            "floors": [{"id": f["id"], "name": f["name"]} for f in STATE.get("floors", [])],
-            "machines": list(STATE.get("machines", {}).values())
-        }
+    snap = VIEW.get()
+    export_data = {
+        "version": APP_VERSION,
+        "exported_at": datetime.utcnow().isoformat() + "Z",
+        "floors": [{"id": f["id"], "name": f["name"]} for f in snap.floors],
+        "machines": list(snap.machines.values())
+    }
     resp = make_response(jsonify(export_data))
     resp.headers["Content-Disposition"] = f"attachment; filename=devices-export-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.json"
     resp.headers["Content-Type"] = "application/json"
     return resp
 
+IMPORT_MAX_ERRORS = 200
+HOST_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9.\-_]{0,252}$")
+
+def valid_host(v: str) -> bool:
+    """An IPv4/IPv6 address literal or a hostname."""
+    try:
+        ipaddress.ip_address(v)
+        return True
+    except ValueError:
+        return bool(HOST_RE.match(v))
+
+def iter_json_array(f: Iterable[str], chunk: int = 1 << 16) -> Iterable[Any]:
+    """Yield the elements of a top-level JSON array, or of the ``"machines"``
+    array inside an export object, while reading ``f`` in chunks."""
+    dec = json.JSONDecoder()
+    buf, eof = "", False
+    def more() -> bool:
+        nonlocal buf, eof
+        data = f.read(chunk)
+        eof = not data
+        buf += data
+        return not eof
+    def skip_ws(pos: int) -> int:
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or not more():
+                return pos
+    def decode(pos: int) -> Tuple[Any, int]:
+        # A value that runs to the end of the buffer (e.g. a number) may be cut off.
+        while True:
+            try:
+                val, end = dec.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    return val, end
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            more()
+    more()
+    pos = skip_ws(0)
+    if pos < len(buf) and buf[pos] == "[":
+        pos += 1
+    elif pos < len(buf) and buf[pos] == "{":
+        # Walk the top-level keys so "machines" elsewhere (a floor's name) is not mistaken for them.
+        pos += 1
+        while True:
+            pos = skip_ws(pos)
+            if pos < len(buf) and buf[pos] == ",":
+                pos = skip_ws(pos + 1)
+            if pos >= len(buf) or buf[pos] != '"':
+                raise ValueError("no device array found")
+            key, pos = decode(pos)
+            pos = skip_ws(pos)
+            if pos >= len(buf) or buf[pos] != ":":
+                raise ValueError("invalid JSON object")
+            pos = skip_ws(pos + 1)
+            if key == "machines":
+                if pos >= len(buf) or buf[pos] != "[":
+                    raise ValueError('"machines" is not an array')
+                pos += 1
+                break
+            _, pos = decode(pos)
+    else:
+        raise ValueError("expected a JSON array or an export object")
+    while True:
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf, pos = buf[pos:], 0
+            more()
+        if pos >= len(buf):
+            raise ValueError("unterminated JSON array")
+        if buf[pos] == "]":
+            return
+        try:
+            val, end = dec.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            buf, pos = buf[pos:], 0
+            more()
+            continue
+        yield val
+        pos = end
+        if pos > chunk:
+            buf, pos = buf[pos:], 0
+
+def iter_import_rows(f, fmt: str) -> Iterable[Tuple[int, Any]]:
+    """(row number, raw row) pairs from a text stream in ``fmt`` (json, ndjson or csv)."""
+    if fmt == "csv":
+        for n, row in enumerate(csv.DictReader(f), 1):
+            yield n, {k.strip(): v for k, v in row.items() if k and v not in (None, "")}
+    elif fmt == "ndjson":
+        for n, line in enumerate(f, 1):
+            if line.strip():
+                try: yield n, json.loads(line)
+                except ValueError as e: yield n, e
+    else:
+        yield from enumerate(iter_json_array(f), 1)
+
+def sniff_import_format(f, name: str, content_type: str) -> str:
+    name, content_type = (name or "").lower(), (content_type or "").lower()
+    if name.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type or "jsonl" in content_type:
+        return "ndjson"
+    head = f.peek(4096)[:4096].decode("utf-8-sig", "replace").lstrip() if hasattr(f, "peek") else ""
+    if head.startswith("{"):
+        first = head.split("\n", 1)[0]
+        try:
+            return "json" if "machines" in json.loads(first) else "ndjson"
+        except ValueError:
+            return "json"
+    return "json" if head.startswith("[") or not head else "csv"
+
+def as_bool(v: Any) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("1", "true", "yes", "y", "on")
+    return bool(v)
+
+def normalize_machine(raw: Any, default_floor: str, now: str) -> Dict[str, Any]:
+    """Validate an imported row and fill in defaults; raises ValueError."""
+    if isinstance(raw, Exception):
+        raise ValueError(f"invalid JSON: {raw}")
+    if not isinstance(raw, dict):
+        raise ValueError("row is not an object")
+    m = dict(raw)
+    m["name"] = str(m.get("name") or "").strip()
+    m["ip"] = str(m.get("ip") or "").strip()
+    if not m["name"] and not m["ip"]:
+        raise ValueError("name or ip is required")
+    if m["ip"] and not valid_host(m["ip"]):
+        raise ValueError(f"invalid ip/host {m['ip']!r}")
+    m["id"] = str(m.get("id") or "").strip() or generate_id(m["name"], m["ip"]) + f"-{os.urandom(2).hex()}"
+    m["check"] = str(m.get("check") or "icmp").strip().lower()
+    m.update(check_settings(m))
+    validate_check(m)
+    try:
+        m["tcp_port"] = int(m.get("tcp_port") or 0)
+        m["probe_interval_s"] = int(m.get("probe_interval_s") or 0)
+    except (TypeError, ValueError):
+        raise ValueError("tcp_port and probe_interval_s must be integers")
+    if not 0 <= m["tcp_port"] <= 65535 or (m["check"] == "tcp" and not m["tcp_port"]):
+        raise ValueError("tcp check needs a tcp_port between 1 and 65535")
+    if m["probe_interval_s"] < 0:
+        raise ValueError("probe_interval_s must not be negative")
+    if m.get("x") is not None or m.get("y") is not None:
+        try:
+            m["x"], m["y"] = float(m["x"]), float(m["y"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("x and y must both be numbers")
+    else:
+        m.pop("x", None); m.pop("y", None)
+    m["floor_id"] = str(m.get("floor_id") or default_floor)
+    m["category"] = m.get("category") if m.get("category") in CATEGORIES else "global"
+    m["operational"] = as_bool(m.get("operational", True))
+    for k in ("serial", "os", "grid", "notes"):
+        m[k] = str(m.get(k) or "")
+    m.setdefault("created_at", now)
+    return m
+
 @app.post("/api/import/machines")
 def import_machines():
+    """Bulk import from a JSON array / export object, NDJSON or CSV.
+
+    Rows are parsed and validated one at a time straight off the upload
+    stream and applied in one step under the state lock. Any invalid row
+    rejects the whole import unless ``?partial=1`` is given, in which case
+    the valid rows are committed. New devices, and ones whose address or
+    check settings changed, get a first probe on the shared probe pool.
+    """
     require_auth()
+    if request.content_type and 'multipart/form-data' in request.content_type:
+        if 'file' not in request.files:
+            return jsonify({"error": "No file provided"}), 400
+        file = request.files['file']
+        if not file.filename:
+            return jsonify({"error": "Empty filename"}), 400
+        raw, name, ctype = file.stream, file.filename, file.content_type
+    else:
+        raw, name, ctype = request.stream, "", request.content_type
+    raw = raw if hasattr(raw, "peek") else io.BufferedReader(raw)
+    fmt = request.args.get("format") or sniff_import_format(raw, name, ctype)
+    partial = request.args.get("partial") == "1"
+    now = datetime.utcnow().isoformat()
+    with state_lock:
+        default_floor = STATE.get("default_floor_id", "main")
+
+    rows: Dict[str, Dict[str, Any]] = {}
+    errors: List[Dict[str, Any]] = []
+    error_count = 0
     try:
-        # Handle both multipart file upload and raw JSON
-        if request.content_type and 'multipart/form-data' in request.content_type:
-            if 'file' not in request.files:
-                return jsonify({"error": "No file provided"}), 400
-            file = request.files['file']
-            if not file.filename:
-                return jsonify({"error": "Empty filename"}), 400
+        for n, row in iter_import_rows(io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""), fmt):
             try:
-                data = json.loads(file.read().decode('utf-8'))
-            except Exception:
-                return jsonify({"error": "Invalid JSON in file"}), 400
-        else:
-            data = request.get_json(silent=True) or {}
-        
-        if not data or "machines" not in data:
-            return jsonify({"error": "Invalid devices export format"}), 400
-        
-        imported_machines = data.get("machines", [])
-        if not isinstance(imported_machines, list):
-            return jsonify({"error": "Invalid machines data"}), 400
-        
-        with state_lock:
-            existing_floors = {f["id"]: f for f in STATE.get("floors", [])}
-            upserted = 0
-            replaced = 0
-            
-            for machine in imported_machines:
-                mid = machine.get("id")
-                if not mid:
-                    continue
-                
-                # Auto-create floor if it doesn't exist
-                floor_id = machine.get("floor_id")
-                if floor_id and floor_id not in existing_floors:
-                    new_floor = {
-                        "id": floor_id,
-                        "name": floor_id,
-                        "map_file": "",
-                        "map_type": "",
-                        "categories_enabled": False
-                    }
-                    STATE["floors"].append(new_floor)
-                    existing_floors[floor_id] = new_floor
-                
-                # Upsert machine (replace if exists)
-                if mid in STATE["machines"]:
-                    replaced += 1
-                else:
-                    upserted += 1
-                
-                STATE["machines"][mid] = machine
-            
+                m = normalize_machine(row, default_floor, now)
+                rows[m["id"]] = m
+            except ValueError as e:
+                error_count += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({"row": n, "error": str(e)})
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"error": f"Failed to read {fmt} import: {e}"}), 400
+    if error_count and not partial:
+        return jsonify({"error": f"{error_count} invalid row(s); nothing imported",
+                        "errors": errors, "error_count": error_count}), 400
+
+    upserted = replaced = 0
+    changed, old, probe = [], [], []
+    with state_lock:
+        floors = STATE.setdefault("floors", [])
+        floor_ids = {f["id"] for f in floors}
+        floor_count = len(floor_ids)
+        machines = STATE["machines"]
+        for mid, m in rows.items():
+            if m["floor_id"] not in floor_ids:
+                floors.append({"id": m["floor_id"], "name": m["floor_id"], "map_file": "",
+                               "map_type": "", "categories_enabled": False})
+                floor_ids.add(m["floor_id"])
+            prev = machines.get(mid)
+            if prev is not None:
+                old.append(prev); replaced += 1
+                # Rows without probe history (e.g. CSV) keep the device's.
+                for k in VOLATILE_FIELDS:
+                    if k not in m and k in prev:
+                        m[k] = prev[k]
+            else:
+                upserted += 1
+            for k, v in (("last_status", "down"), ("last_seen", ""), ("last_rtt_ms", 0), ("last_error", ""), ("last_rtt_detail", {}),
+                         ("total_pings", 0), ("up_pings", 0), ("consec_down", 0)):
+                m.setdefault(k, v)
+            if prev is None or check_key(prev) != check_key(m):
+                probe.append(mid)
+            machines[mid] = m
+            INDEX.add(mid, m)
+            changed.append(m)
+        if changed:
             save_state(STATE)
-        
-        return jsonify({
-            "ok": True,
-            "upserted": upserted,
-            "replaced": replaced,
-            "total": upserted + replaced
-        })
-    except Exception as e:
-        return jsonify({"error": f"Failed to import devices: {str(e)}"}), 400
+            CHANGES.machines(changed, old=old)
+        if len(floor_ids) != floor_count:
+            floors_changed()
+        snaps = [(mid, dict(machines[mid])) for mid in probe]
+    for mid, m in snaps:
+        PROBE_ENGINE.submit(mid, m)
+
+    return jsonify({
+        "ok": True,
+        "format": fmt,
+        "upserted": upserted,
+        "replaced": replaced,
+        "total": upserted + replaced,
+        "probing": len(snaps),
+        "errors": errors,
+        "error_count": error_count,
+    })
 
 @app.post("/api/floors/upload")
 def floors_upload():
@@ -505,29 +3350,35 @@ def floors_upload():
     ext = os.path.splitext(name)[1].lower()
     if ext != ".pdf":
         return jsonify({"error":"Only PDF is supported for maps"}), 400
-    out_file = MAPS_DIR / f"{fl['id']}.png"
-    tmp = MAPS_DIR / f"{fl['id']}.upload.pdf"
+    if pdfium is None:
+        return jsonify({"error": f"PDF not supported: pypdfium2 not available. Import error: {PDFIUM_IMPORT_ERROR or 'install pypdfium2'}"}), 400
+    try:
+        page = int(request.form.get("page") or 1)
+        dpi = parse_dpi(request.form.get("dpi") or MAP_DEFAULT_DPI)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    tmp = MAPS_DIR / f"{fl['id']}.{os.urandom(4).hex()}.upload.pdf"
     try:
         f.save(tmp)
-        try:
-            convert_pdf_to_png(tmp, out_file, page=1, dpi=220)
-        finally:
-            tmp.unlink(missing_ok=True)
+        source = store_map_source(tmp)
     except Exception as e:
+        tmp.unlink(missing_ok=True)
         return jsonify({"error": str(e)}), 400
-
     with state_lock:
-        for old in [MAPS_DIR / f"{fl['id']}.svg",
-                    MAPS_DIR / f"{fl['id']}.jpg", MAPS_DIR / f"{fl['id']}.jpeg", MAPS_DIR / f"{fl['id']}.webp"]:
-            if old.exists():
-                try: old.unlink()
-                except: pass
-        for floor in STATE["floors"]:
-            if floor["id"] == fl["id"]:
-                floor["map_file"] = str(out_file.resolve())
-                floor["map_type"] = "raster"
-        save_state(STATE)
-    return jsonify({"ok":True,"map_type":"raster"})
+        job = queue_map_render(fl["id"], source, page, dpi)
+    return jsonify({"ok":True,"job_id":job["id"],"job":job}), 202
+
+@app.get("/api/jobs")
+def jobs_list():
+    require_auth()
+    return jsonify(JOBS.list())
+
+@app.get("/api/jobs/<jid>")
+def job_status(jid):
+    require_auth()
+    job = JOBS.get(jid)
+    if not job: abort(404)
+    return jsonify(job)
 
 @app.get("/map-image")
 def map_image():
@@ -542,103 +3393,337 @@ def map_image():
     resp.headers["Cache-Control"] = "no-store"
     return resp
 
+@app.get("/map-render/<fid>")
+def map_render(fid):
+    """Render a page/dpi/rotation of a floor's source PDF, through the render cache.
+
+    Anonymous clients only get the floor's configured render; any other
+    page, dpi or rotation needs a login.
+    """
+    with state_lock:
+        fl = next((f for f in STATE.get("floors", []) if f["id"] == fid), None)
+        src = Path(fl["map_source"]) if fl and fl.get("map_source") else None
+        pages = int(fl.get("map_pages") or 1) if fl else 0
+        page_default, dpi_default = (fl or {}).get("map_page", 1), (fl or {}).get("map_dpi", MAP_DEFAULT_DPI)
+    if not src or not src.exists():
+        abort(404)
+    try:
+        page = int(request.args.get("page") or page_default)
+        dpi = parse_dpi(request.args.get("dpi") or dpi_default)
+        rotation = int(request.args.get("rotation") or 0)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if (page, dpi, rotation) != (int(page_default), parse_dpi(dpi_default), 0):
+        require_auth()
+    if not 1 <= page <= pages or rotation not in (0, 90, 180, 270):
+        return jsonify({"error": "bad page or rotation"}), 400
+    try:
+        p = RENDER_CACHE.get(src, page, dpi, rotation)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    # A re-upload changes what this URL renders; let the ETag do the caching.
+    resp = make_response(send_file(p, mimetype="image/png"))
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.get("/map-tiles/<digest>/preview")
+@app.get("/map-tiles/<digest>/<int:z>/<int:x>/<int:y>")
+def map_tile(digest, z=None, x=None, y=None):
+    if not re.fullmatch(r"[0-9a-f]{16}", digest):
+        abort(404)
+    d = TILES_DIR / digest
+    meta_file = d / "meta.json"
+    if not meta_file.exists():
+        abort(404)
+    fmt = json.loads(meta_file.read_text(encoding="utf-8"))["format"]
+    p = d / f"preview.{fmt}" if z is None else d / str(z) / f"{x}_{y}.{fmt}"
+    if not p.exists():
+        abort(404)
+    # URLs embed the content hash, so a given URL never changes.
+    resp = make_response(send_file(p, mimetype=f"image/{fmt}", max_age=31536000))
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
 @app.get("/api/public/machines")
 def public_machines():
-    floor_id = request.args.get("floor_id")
-    with state_lock:
-        ms = list(STATE["machines"].values())
+    floor_id = request.args.get("floor_id") or ""
+    def build(snap: Snapshot):
         # Only return operational devices for the map
-        ms = [m for m in ms if m.get("operational", True)]
-        if floor_id:
-            ms = [m for m in ms if m.get("floor_id")==floor_id]
-    resp = make_response(jsonify(ms)); resp.headers["Cache-Control"]="no-store"; return resp
+        ids = snap.by_floor.get(floor_id, ()) if floor_id else snap.machines.keys()
+        return [snap.machines[mid] for mid in ids if mid not in snap.storage]
+    return cached_public("machines", floor_id, "floor:"+floor_id if floor_id else "all", build)
 
 @app.get("/api/public/storage")
 def public_storage():
-    with state_lock:
-        ms = [m for m in STATE["machines"].values() if not m.get("operational", True)]
-    resp = make_response(jsonify(ms)); resp.headers["Cache-Control"]="no-store"; return resp
+    return cached_public("storage", "", "storage",
+                         lambda snap: [snap.machines[mid] for mid in snap.storage])
+
+def new_machine(m: Dict[str, Any]) -> Dict[str, Any]:
+    """A fresh machine record from a create request; callers hold state_lock. Raises ValueError."""
+    cat = m.get("category") or "global"
+    cur = {
+        "id": m.get("id") or generate_id(m.get("name",""), m.get("ip","")),
+        "name": m.get("name",""), "ip": m.get("ip",""), "serial": m.get("serial",""),
+        "os": m.get("os",""), "grid": m.get("grid",""), "notes": m.get("notes",""),
+        "floor_id": m.get("floor_id") or STATE.get("default_floor_id","main"),
+        "category": cat if cat in CATEGORIES else "global",
+        "check": (m.get("check") or "icmp").lower(), "tcp_port": int(m.get("tcp_port") or 0),
+        "probe_interval_s": int(m.get("probe_interval_s") or 0),
+        "created_at": datetime.utcnow().isoformat(), "last_seen":"", "last_status":"down", "last_rtt_ms":0,
+        "total_pings":0, "up_pings":0, "consec_down":0, "last_error":"", "last_rtt_detail": {},
+        "operational": m.get("operational", True),
+        **check_settings(m),
+    }
+    validate_check(cur)
+    if "x" in m and "y" in m and m["x"] is not None and m["y"] is not None:
+        try:
+            cur["x"] = float(m["x"]); cur["y"] = float(m["y"])
+        except Exception:
+            pass
+    return cur
+
+def apply_machine_update(cur: Dict[str, Any], body: Dict[str, Any]) -> None:
+    """Apply an update request's fields to ``cur``, a fresh copy of the record. Raises ValueError."""
+    if body.get("clear_pos"):
+        cur.pop("x", None); cur.pop("y", None)
+    if "x" in body and "y" in body and body["x"] is not None and body["y"] is not None:
+        try: cur["x"] = float(body["x"]); cur["y"] = float(body["y"])
+        except Exception: pass
+    cur["name"] = body.get("name",cur["name"])
+    cur["ip"] = body.get("ip",cur["ip"])
+    cur["serial"] = body.get("serial",cur["serial"])
+    cur["os"] = body.get("os",cur["os"])
+    cur["grid"] = body.get("grid",cur["grid"])
+    cur["notes"] = body.get("notes",cur["notes"])
+    cur["check"] = (body.get("check",cur["check"]) or "icmp").lower()
+    cur["tcp_port"] = int(body.get("tcp_port",cur["tcp_port"]))
+    cur.update(check_settings(body, cur))
+    validate_check(cur)
+    cur["probe_interval_s"] = int(body.get("probe_interval_s", cur.get("probe_interval_s", 0)) or 0)
+    if "floor_id" in body and body["floor_id"]:
+        cur["floor_id"] = body["floor_id"]
+    if "category" in body and body["category"]:
+        cur["category"] = body["category"] if body["category"] in CATEGORIES else "global"
+    if "operational" in body:
+        cur["operational"] = bool(body["operational"])
 
 @app.route("/api/machines", methods=["GET","POST"])
 def machines_list_create():
     if request.method=="GET":
         require_auth()
-        with state_lock: return jsonify(list(STATE["machines"].values()))
+        return jsonify(list(VIEW.get().machines.values()))
     require_auth()
     m = request.get_json(silent=True) or {}
-    now = datetime.utcnow().isoformat()
     with state_lock:
-        mid = m.get("id") or generate_id(m.get("name",""), m.get("ip",""))
-        floor_id = m.get("floor_id") or STATE.get("default_floor_id","main")
-        cat = m.get("category") or "global"
-        if cat not in CATEGORIES:
-            cat = "global"
-        cur = {
-            "id": mid, "name": m.get("name",""), "ip": m.get("ip",""), "serial": m.get("serial",""),
-            "os": m.get("os",""), "grid": m.get("grid",""), "notes": m.get("notes",""),
-            "floor_id": floor_id,
-            "category": cat,
-            "check": (m.get("check") or "icmp").lower(), "tcp_port": int(m.get("tcp_port") or 0),
-            "created_at": now, "last_seen":"", "last_status":"down", "last_rtt_ms":0,
-            "total_pings":0, "up_pings":0, "consec_down":0, "last_error":"",
-            "operational": m.get("operational", True)
-        }
-        if "x" in m and "y" in m and m["x"] is not None and m["y"] is not None:
-            try:
-                cur["x"] = float(m["x"]); cur["y"] = float(m["y"])
-            except Exception:
-                pass
-        STATE["machines"][mid]=cur; save_state(STATE)
-    threading.Thread(target=lambda: update_after_ping(mid, *do_check(cur)), daemon=True).start()
+        try:
+            cur = new_machine(m)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        mid = cur["id"]
+        STATE["machines"][mid]=cur; INDEX.add(mid, cur)
+        save_state(STATE); CHANGES.machines([cur])
+        snap = dict(cur)
+    PROBE_ENGINE.submit(mid, snap)
     return jsonify(cur)
 
 @app.route("/api/machines/<mid>", methods=["GET","PUT","DELETE"])
 def machine_by_id(mid):
     require_auth()
-    with state_lock:
-        m = STATE["machines"].get(mid)
+    m = VIEW.get().machines.get(mid)
     if not m: abort(404)
     if request.method=="GET": return jsonify(m)
     if request.method=="PUT":
         body = request.get_json(silent=True) or {}
         with state_lock:
-            cur = STATE["machines"][mid]
-            if body.get("clear_pos"):
-                cur.pop("x", None); cur.pop("y", None)
-            if "x" in body and "y" in body and body["x"] is not None and body["y"] is not None:
-                try: cur["x"] = float(body["x"]); cur["y"] = float(body["y"])
-                except Exception: pass
-            cur["name"] = body.get("name",cur["name"])
-            cur["ip"] = body.get("ip",cur["ip"])
-            cur["serial"] = body.get("serial",cur["serial"])
-            cur["os"] = body.get("os",cur["os"])
-            cur["grid"] = body.get("grid",cur["grid"])
-            cur["notes"] = body.get("notes",cur["notes"])
-            cur["check"] = (body.get("check",cur["check"]) or "icmp").lower()
-            cur["tcp_port"] = int(body.get("tcp_port",cur["tcp_port"]))
-            if "floor_id" in body and body["floor_id"]:
-                cur["floor_id"] = body["floor_id"]
-            if "category" in body and body["category"]:
-                cur["category"] = body["category"] if body["category"] in CATEGORIES else "global"
-            if "operational" in body:
-                cur["operational"] = bool(body["operational"])
-            save_state(STATE)
+            prev = STATE["machines"][mid]
+            cur = dict(prev)
+            try:
+                apply_machine_update(cur, body)
+            except (TypeError, ValueError) as e:
+                return jsonify({"error": str(e)}), 400
+            STATE["machines"][mid] = cur
+            INDEX.add(mid, cur)
+            save_state(STATE); CHANGES.machines([cur], old=[prev])
         return jsonify(cur)
     with state_lock:
-        STATE["machines"].pop(mid,None); save_state(STATE)
+        gone = STATE["machines"].pop(mid,None); INDEX.remove(mid); FLIGHTS.forget(mid); save_state(STATE)
+        CHANGES.machines(delete=[mid], old=[gone] if gone else [])
     return "",204
 
+BATCH_MAX_OPS = 10000
+
+@app.post("/api/machines/batch")
+def machines_batch():
+    """Apply many create/update/delete/position ops all-or-nothing.
+
+    Body: ``{"ops": [{"op": "create", ...fields}, {"op": "update", "id": ..., ...fields},
+    {"op": "delete", "id": ...}, {"op": "position", "id": ..., "x": .., "y": .., "floor_id": ..}]}``.
+    Ops run in order against a working copy; the first failing op rejects
+    the whole batch. On success the state is saved once and one change
+    event is published.
+    """
+    require_auth()
+    ops = (request.get_json(silent=True) or {}).get("ops")
+    if not isinstance(ops, list) or not ops:
+        return jsonify({"error": "ops must be a non-empty list"}), 400
+    if len(ops) > BATCH_MAX_OPS:
+        return jsonify({"error": f"at most {BATCH_MAX_OPS} ops per batch"}), 400
+    with state_lock:
+        machines = STATE["machines"]
+        floor_ids = {f["id"] for f in STATE.get("floors", [])}
+        work: Dict[str, Optional[Dict[str, Any]]] = {}   # mid -> new record, None = deleted
+        created: List[str] = []
+        for i, op in enumerate(ops):
+            kind = op.get("op") if isinstance(op, dict) else None
+            fields = {k: v for k, v in op.items() if k != "op"} if kind else {}
+            mid = fields.get("id") or ""
+            cur = work[mid] if mid in work else machines.get(mid)
+            try:
+                if kind == "create":
+                    if cur is not None:
+                        raise ValueError(f"machine {mid} already exists")
+                    m = new_machine(fields)
+                    while m["id"] in work or m["id"] in machines:
+                        m["id"] += "-" + os.urandom(2).hex()
+                    mid = m["id"]; created.append(mid)
+                elif kind in ("update", "position", "delete"):
+                    if cur is None:
+                        raise ValueError(f"unknown machine {mid!r}")
+                    m = dict(cur)
+                    if kind == "delete":
+                        m = None
+                    elif kind == "update":
+                        apply_machine_update(m, fields)
+                    elif fields.get("x") is None or fields.get("y") is None:
+                        m.pop("x", None); m.pop("y", None)
+                        if fields.get("floor_id"): m["floor_id"] = fields["floor_id"]
+                    else:
+                        m["x"], m["y"] = float(fields["x"]), float(fields["y"])
+                        if fields.get("floor_id"): m["floor_id"] = fields["floor_id"]
+                else:
+                    raise ValueError(f"unknown op {kind!r}")
+                if m is not None and m["floor_id"] not in floor_ids:
+                    raise ValueError(f"unknown floor {m['floor_id']!r}")
+            except (TypeError, ValueError) as e:
+                return jsonify({"error": f"op {i}: {e}", "index": i}), 400
+            work[mid] = m
+
+        upserts, deletes, old = [], [], []
+        for mid, m in work.items():
+            prev = machines.get(mid)
+            if prev is not None:
+                old.append(prev)
+            if m is None:
+                if prev is not None:
+                    del machines[mid]; INDEX.remove(mid); FLIGHTS.forget(mid); deletes.append(mid)
+            else:
+                machines[mid] = m; INDEX.add(mid, m); upserts.append(m)
+        save_state(STATE)
+        CHANGES.machines(upserts, delete=deletes, old=old)
+        snaps = [(mid, dict(work[mid])) for mid in created if work.get(mid) is not None]
+    for mid, m in snaps:
+        PROBE_ENGINE.submit(mid, m)
+    return jsonify({"ok": True, "upserted": len(upserts), "deleted": len(deletes),
+                    "created": [mid for mid, _ in snaps], "machines": upserts})
+
+def discovery_job(jid: str, network: ipaddress.IPv4Network, ports: List[int], icmp: bool,
+                  floor_id: str, dry_run: bool) -> Dict[str, Any]:
+    """Sweep ``network`` and add responsive hosts as storage devices in one commit."""
+    hosts = [str(h) for h in (network.hosts() if network.num_addresses > 2 else network)]
+    total = len(hosts) * len(ports)
+    pings: Dict[str, Tuple[bool, int, str]] = {}
+    pinger = icmp_pinger() if icmp and PROBE_BACKEND != "subprocess" else None
+    icmp_thread = None
+    if pinger is not None:
+        icmp_thread = threading.Thread(target=lambda: pings.update(pinger.ping_many(hosts, max(500, DISCOVERY_TIMEOUT_MS * 3))),
+                                       name="discovery-icmp", daemon=True)
+        icmp_thread.start()
+    last = [0.0]
+    def progress(done: int) -> None:
+        now = time.perf_counter()
+        if now - last[0] >= 0.25:
+            last[0] = now
+            JOBS.update(jid, progress=min(95, int(95 * done / max(1, total))), message=f"probed {done}/{total} ports")
+    JOBS.update(jid, message=f"probing {len(hosts)} hosts")
+    t0 = time.perf_counter()
+    opened = tcp_connect_sweep(((h, p) for h in hosts for p in ports), DISCOVERY_TIMEOUT_MS,
+                               DISCOVERY_CONCURRENCY, progress)
+    if icmp_thread is not None:
+        icmp_thread.join()
+    by_host: Dict[str, Dict[int, int]] = {}
+    for (h, p), rtt in opened.items():
+        by_host.setdefault(h, {})[p] = rtt
+    found = []
+    for h in hosts:
+        ping = pings.get(h)
+        if h not in by_host and not (ping and ping[0]):
+            continue
+        open_ports = sorted(by_host.get(h, {}))
+        rtts = [ping[1]] if ping and ping[0] else [by_host[h][p] for p in open_ports]
+        found.append({"ip": h, "ports": open_ports, "icmp": bool(ping and ping[0]),
+                      "category": guess_category(open_ports), "rtt_ms": min(rtts)})
+    JOBS.update(jid, progress=97, message=f"{len(found)} responsive hosts")
+    added, known = [], 0
+    if not dry_run and found:
+        now = datetime.utcnow()
+        with state_lock:
+            machines = STATE["machines"]
+            have = {m.get("ip") for m in machines.values()}
+            fid = floor_id if any(f["id"] == floor_id for f in STATE.get("floors", [])) else STATE.get("default_floor_id", "main")
+            for d in found:
+                if d["ip"] in have:
+                    known += 1
+                    continue
+                m = new_machine({
+                    "name": d["ip"], "ip": d["ip"], "floor_id": fid, "category": d["category"], "operational": False,
+                    "check": "icmp" if d["icmp"] or not d["ports"] else "tcp", "tcp_port": 0 if d["icmp"] else d["ports"][0],
+                    "notes": f"Discovered {now.strftime('%Y-%m-%d')} in {network}" +
+                             (f"; open ports {', '.join(map(str, d['ports']))}" if d["ports"] else ""),
+                })
+                while m["id"] in machines:
+                    m["id"] += "-" + os.urandom(2).hex()
+                m.update(last_status="up", last_seen=now.isoformat(), last_rtt_ms=d["rtt_ms"])
+                machines[m["id"]] = m; INDEX.add(m["id"], m); added.append(m)
+            if added:
+                save_state(STATE)
+                CHANGES.machines(added)
+    return {"cidr": str(network), "hosts": len(hosts), "ports": ports, "icmp": pinger is not None,
+            "elapsed_s": round(time.perf_counter() - t0, 2), "responsive": len(found), "added": len(added),
+            "already_known": known, "dry_run": dry_run, "found": found}
+
+@app.post("/api/discovery")
+def start_discovery():
+    """Queue a subnet sweep. Body: cidr, optional ports, icmp, floor_id, dry_run."""
+    require_auth()
+    body = request.get_json(silent=True) or {}
+    try:
+        network = ipaddress.ip_network(str(body.get("cidr") or "").strip(), strict=False)
+        if network.version != 4:
+            raise ValueError("only IPv4 ranges are supported")
+        ports = parse_ports(body.get("ports") or DISCOVERY_PORTS)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e) or "cidr is required"}), 400
+    if network.num_addresses > DISCOVERY_MAX_HOSTS:
+        return jsonify({"error": f"range too large ({network.num_addresses} addresses, max {DISCOVERY_MAX_HOSTS})"}), 400
+    job = JOBS.submit("discovery", discovery_job, network, ports, as_bool(body.get("icmp", True)),
+                      str(body.get("floor_id") or ""), as_bool(body.get("dry_run", False)), cidr=str(network))
+    return jsonify({"ok": True, "job_id": job["id"], "job": job}), 202
+
 @app.get("/api/ping/<mid>")
 def ping_now(mid):
     require_auth()
     with state_lock:
         m = STATE["machines"].get(mid)
     if not m: abort(404)
-    ok,rtt,err = do_check(m)
-    update_after_ping(mid, ok, rtt, err)
+    force = as_bool(request.args.get("force"))
+    res, source = PROBE_ENGINE.check(mid, m, max_age=0 if force else PING_CACHE_SECONDS, capped=False)
+    if res is None:
+        return jsonify({"error": "probe skipped by a sweep deadline; retry"}), 503
+    ok,rtt,err,detail = res
     with state_lock:
-        status = STATE["machines"][mid]["last_status"]
-    return jsonify({"id":mid,"ok":ok,"rtt_ms":rtt,"status":status,"error":err})
+        m = STATE["machines"].get(mid)
+        status = m["last_status"] if m else "down"
+    return jsonify({"id":mid,"ok":ok,"rtt_ms":rtt,"status":status,"error":err,"detail":detail,"source":source})
 
 @app.post("/api/ping-all")
 def ping_all():
@@ -646,27 +3731,181 @@ def ping_all():
     stats = ping_all_once()
     return jsonify({"ok":True,"stats":stats})
 
+def read_csv_day(mid: str, day: datetime) -> List[Tuple[datetime, bool, str, int]]:
+    out = []
+    for row in iter_log_day(day.strftime("%Y-%m-%d")):
+        if row.get("id")!=mid: continue
+        try: ts = datetime.fromisoformat(row["timestamp"])
+        except: continue
+        out.append((ts, row.get("ok")=="1", row.get("status","unknown"), int(row.get("rtt_ms") or 0)))
+    return out
+
 @app.get("/api/history/<mid>")
 def history(mid):
+    """Raw points for short windows, hourly summaries for long ones (``res`` = auto, raw or hour).
+
+    Days already downsampled only have hourly points, whatever ``res`` asks for.
+    """
     days = int(request.args.get("days","7"))
-    since = datetime.utcnow() - timedelta(days=days)
-    pts=[]
+    res = request.args.get("res", "auto")
+    if res not in ("auto", "raw", "hour"):
+        return jsonify({"error": "res must be auto, raw or hour"}), 400
+    if res == "auto":
+        res = "raw" if days <= HISTORY_RAW_MAX_DAYS else "hour"
+    LOG_WRITER.flush()
     cur = datetime.utcnow()
-    for i in range(days+1):
-        p = log_path_for(cur - timedelta(days=i))
-        if not p.exists(): continue
-        with p.open("r", encoding="utf-8") as f:
-            rdr = csv.DictReader(f)
-            for row in rdr:
-                if row.get("id")!=mid: continue
-                try: ts = datetime.fromisoformat(row["timestamp"])
-                except: continue
-                if ts < since: continue
-                pts.append({"t":ts.isoformat(),"rtt_ms":int(row.get("rtt_ms") or 0),
-                            "ok":row.get("ok")=="1","status":row.get("status","unknown")})
+    since = cur - timedelta(days=days)
+    if STORE is not None:
+        return jsonify(STORE.history(mid, since, cur + timedelta(seconds=1), res))
+    pts=[]
+    for i in range(days, -1, -1):
+        d = cur - timedelta(days=i)
+        day = d.strftime("%Y-%m-%d")
+        hourly = HOURLY_STORE.read_day(mid, day)
+        if hourly is None:
+            rows = HISTORY_STORE.read_day(mid, day)
+            if rows is None:
+                rows = read_csv_day(mid, d)
+            if res == "raw":
+                pts += [{"t":ts.isoformat(),"rtt_ms":rtt,"ok":ok,"status":status} for ts, ok, status, rtt in rows if ts >= since]
+                continue
+            hourly = hourly_rows(rows)
+        pts += [hourly_point(*h) for h in hourly if h[0] + timedelta(hours=1) > since]
     pts.sort(key=lambda x: x["t"])
     return jsonify(pts)
 
+def iter_hourly_results(since: datetime, until: datetime, wanted: Optional[set]
+                        ) -> Iterable[Tuple[datetime, str, int, int, int, int]]:
+    """(hour, id, n, up, rtt_sum, rtt_max) for hours starting in [since, until), a day at a time.
+
+    Downsampled days come from HOURLY_STORE; raw days are folded in one
+    pass over that day's log, so memory is bounded by one day of devices.
+    """
+    if STORE is not None:
+        for rec in STORE.iter_hourly(since, until):
+            if wanted is None or rec[1] in wanted:
+                yield rec
+        return
+    day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    while day < until:
+        key = day.strftime("%Y-%m-%d")
+        day += timedelta(days=1)
+        recs: List[Tuple[datetime, str, int, int, int, int]] = []
+        if HOURLY_STORE.has_day(key):
+            for mid in (wanted if wanted is not None else HOURLY_STORE.ids(key)):
+                recs += [(h, mid, *rest) for h, *rest in HOURLY_STORE.read_day(mid, key) or []]
+        else:
+            buckets: Dict[Tuple[datetime, str], List[int]] = {}
+            for row in iter_log_day(key):
+                mid = row.get("id") or ""
+                if wanted is not None and mid not in wanted:
+                    continue
+                try: ts = datetime.fromisoformat(row["timestamp"])
+                except Exception: continue
+                b = buckets.setdefault((ts.replace(minute=0, second=0, microsecond=0), mid), [0, 0, 0, 0])
+                b[0] += 1
+                if row.get("ok") == "1":
+                    rtt = int(row.get("rtt_ms") or 0)
+                    b[1] += 1; b[2] += rtt; b[3] = max(b[3], rtt)
+            recs = [(h, mid, *b) for (h, mid), b in buckets.items()]
+        recs.sort()
+        for rec in recs:
+            if since <= rec[0] < until:
+                yield rec
+
+def parse_when(v: str, default: datetime) -> datetime:
+    """ISO date or datetime (UTC, a trailing Z is accepted); ``default`` when empty."""
+    v = (v or "").strip()
+    if not v:
+        return default
+    dt = datetime.fromisoformat(v[:-1] if v.endswith("Z") else v)
+    return dt.replace(tzinfo=None) if dt.tzinfo is None else (dt - dt.utcoffset()).replace(tzinfo=None)
+
+EXPORT_CHUNK_BYTES = 1 << 16
+
+@app.get("/api/export/history")
+def export_history():
+    """Stream probe history for many devices as CSV or NDJSON.
+
+    Query: ``from``/``to`` (ISO, UTC; default the last 24 hours), ``floor_id``,
+    ``category``, ``ids`` (comma-separated), ``format`` (csv | ndjson) and
+    ``res`` (raw | hour). Filters combine; rows come out oldest first.
+    """
+    require_auth()
+    fmt = request.args.get("format", "csv")
+    res = request.args.get("res", "raw")
+    if fmt not in ("csv", "ndjson") or res not in ("raw", "hour"):
+        return jsonify({"error": "format must be csv or ndjson, res raw or hour"}), 400
+    now = datetime.utcnow()
+    try:
+        until = parse_when(request.args.get("to", ""), now)
+        since = parse_when(request.args.get("from", ""), until - timedelta(days=1))
+    except ValueError as e:
+        return jsonify({"error": f"bad from/to: {e}"}), 400
+    if since >= until:
+        return jsonify({"error": "from must be before to"}), 400
+    snap = VIEW.get()
+    wanted: Optional[set] = None
+    floor_id, category = request.args.get("floor_id", ""), request.args.get("category", "")
+    if floor_id or category:
+        wanted = {mid for mid, m in snap.machines.items()
+                  if (not floor_id or m.get("floor_id") == floor_id) and (not category or m.get("category") == category)}
+    if request.args.get("ids"):
+        ids = {i.strip() for i in request.args["ids"].split(",") if i.strip()}
+        wanted = ids if wanted is None else wanted & ids
+    machines = snap.machines
+    LOG_WRITER.flush()
+
+    if res == "raw":
+        header = ["timestamp", "id", "name", "floor_id", "category", "ok", "status", "rtt_ms", "error"]
+        def rows():
+            for ts, mid, ok, status, rtt, err in iter_probe_results(since, until):
+                if wanted is None or mid in wanted:
+                    m = machines.get(mid) or {}
+                    yield [ts.isoformat(), mid, m.get("name", ""), m.get("floor_id", ""), m.get("category", ""),
+                           ok, status, rtt, err]
+    else:
+        header = ["hour", "id", "name", "floor_id", "category", "n", "up", "uptime", "rtt_ms", "rtt_max_ms"]
+        def rows():
+            for h, mid, n, up, rtt_sum, rtt_max in iter_hourly_results(since, until, wanted):
+                m = machines.get(mid) or {}
+                yield [h.isoformat(), mid, m.get("name", ""), m.get("floor_id", ""), m.get("category", ""),
+                       n, up, round(100.0 * up / n, 2) if n else 0.0, round(rtt_sum / up) if up else 0, rtt_max]
+
+    def stream():
+        out = io.StringIO()
+        w = csv.writer(out)
+        if fmt == "csv":
+            w.writerow(header)
+        for row in rows():
+            if fmt == "csv":
+                w.writerow(["1" if v is True else "0" if v is False else v for v in row])
+            else:
+                out.write(json.dumps(dict(zip(header, row)), separators=(",", ":")) + "\n")
+            if out.tell() >= EXPORT_CHUNK_BYTES:
+                yield out.getvalue()
+                out.seek(0); out.truncate()
+        yield out.getvalue()
+
+    name = f"history-{since.strftime('%Y%m%d%H%M')}-{until.strftime('%Y%m%d%H%M')}.{fmt}"
+    resp = Response(stream(), mimetype="text/csv" if fmt == "csv" else "application/x-ndjson")
+    resp.headers["Content-Disposition"] = f"attachment; filename={name}"
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+@app.get("/api/stats")
+def stats():
+    scope = request.args.get("scope", "fleet")
+    if scope not in ("fleet", "device", "floor", "category"):
+        return jsonify({"error": "scope must be fleet, device, floor or category"}), 400
+    res = request.args.get("res", "hour")
+    if res not in ("hour", "day"):
+        return jsonify({"error": "res must be hour or day"}), 400
+    sid = "all" if scope == "fleet" else (request.args.get("id") or "")
+    if not sid:
+        return jsonify({"error": "id is required"}), 400
+    return jsonify({"scope": scope, "id": sid, "res": res, "buckets": ROLLUPS.query(scope, sid, res)})
+
 def generate_id(name: str, ip: str) -> str:
     base = re.sub(r"[^a-z0-9\-]+","", (name or "pc").lower().replace(" ","-"))
     ipn = (ip or "").replace(".","_")
@@ -675,34 +3914,10 @@ def generate_id(name: str, ip: str) -> str:
 def start_background():
     if os.environ.get("DISABLE_SCHEDULER") == "1":
         return
-    def _first_ping():
-        try:
-            ping_all_once()
-        except Exception as e:
-            print("Initial ping failed:", e)
-    threading.Thread(target=_first_ping, daemon=True).start()
-    threading.Thread(target=scheduler_loop, daemon=True).start()
-
-def next_quarter_utc(now: Optional[datetime]=None) -> datetime:
-    if not now: now = datetime.utcnow()
-    q = ((now.minute // 15) + 1) * 15
-    if q >= 60:
-        return now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
-    return now.replace(minute=0, second=0, microsecond=0) + timedelta(minutes=q)
-
-def scheduler_loop():
-    global NEXT_PING_AT_UTC
-    while True:
-        now = datetime.utcnow()
-        NEXT_PING_AT_UTC = next_quarter_utc(now)
-        sleep_sec = max(1, int((NEXT_PING_AT_UTC - now).total_seconds()))
-        time.sleep(sleep_sec)
-        try:
-            ping_all_once()
-        except Exception as e:
-            print("Scheduled ping failed:", e)
+    SCHEDULER.start()
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     try: _ = require_password()
     except RuntimeError as e: print(str(e)); raise SystemExit(1)
     with state_lock:
@@ -714,5 +3929,13 @@ if __name__ == "__main__":
     print(f"{APP_NAME} {APP_VERSION}")
     print(f"Data directory: {DATA_DIR}")
     print(f"Running on http://{host}:{port}")
+    def history_upkeep():
+        # Index first, so maintenance never races the backfill for a day.
+        if STORE is None:
+            HISTORY_STORE.backfill()
+        LOG_LIFECYCLE.run_forever()
+    threading.Thread(target=history_upkeep, name="history-upkeep", daemon=True).start()
+    threading.Thread(target=ROLLUPS.backfill, name="rollup-backfill", daemon=True).start()
+    threading.Thread(target=ensure_map_tiles, name="map-tiles", daemon=True).start()
     start_background()
     app.run(host=host, port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,259 @@
+"""Benchmark harness for app.py against a synthetic fleet.
+
+Builds a throwaway data directory with a generated state.json and daily
+ping logs, points TCP checks at local listeners (and at a "blackhole"
+port whose accept queue is full, so connects hang until the timeout),
+then measures the hot paths and prints one JSON document:
+
+    python bench.py --devices 5000 --days 30 --out before.json
+
+Run it on two versions and diff the JSON to spot regressions. Nothing
+outside the temporary directory is touched.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+def pct(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return round(s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))], 3)
+
+def summary(ms: List[float]) -> Dict[str, Any]:
+    return {"n": len(ms), "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+            "p50_ms": pct(ms, 50), "p95_ms": pct(ms, 95), "p99_ms": pct(ms, 99), "max_ms": pct(ms, 100)}
+
+def timed(fn: Callable[[], Any]) -> float:
+    t0 = time.perf_counter()
+    fn()
+    return (time.perf_counter() - t0) * 1000.0
+
+class Listeners:
+    """Local probe targets: accepting ports and one blackhole port."""
+    def __init__(self, n: int):
+        self.socks: List[socket.socket] = []
+        self.ports: List[int] = []
+        for _ in range(max(1, n)):
+            s = socket.socket()
+            s.bind(("127.0.0.1", 0)); s.listen(1024)
+            self.socks.append(s); self.ports.append(s.getsockname()[1])
+            threading.Thread(target=self._accept, args=(s,), daemon=True).start()
+        # A listener nobody accepts on, with its backlog filled: further
+        # SYNs are dropped, so a connect waits for the probe timeout.
+        self.blackhole = socket.socket()
+        self.blackhole.bind(("127.0.0.1", 0)); self.blackhole.listen(0)
+        self.blackhole_port = self.blackhole.getsockname()[1]
+        self._fillers = []
+        for _ in range(4):
+            c = socket.socket(); c.setblocking(False)
+            try: c.connect(("127.0.0.1", self.blackhole_port))
+            except (BlockingIOError, OSError): pass
+            self._fillers.append(c)
+
+    @staticmethod
+    def _accept(s: socket.socket) -> None:
+        while True:
+            try:
+                c, _ = s.accept()
+                c.close()
+            except OSError:
+                return
+
+def make_fleet(A, args, rng: random.Random, targets: Listeners) -> Dict[str, Any]:
+    n_floors = max(1, (args.devices + 499) // 500)
+    floors = [{"id": "main" if i == 0 else f"floor-{i}", "name": f"Floor {i}", "map_file": "",
+               "map_type": "", "categories_enabled": True} for i in range(n_floors)]
+    machines = {}
+    for i in range(args.devices):
+        mid = f"bench-{i:06d}"
+        dead = rng.random() < args.blackhole_ratio
+        machines[mid] = {
+            "id": mid, "name": f"ws-{i:06d}", "ip": "127.0.0.1", "serial": f"SN{i:08d}", "os": "Windows 11 (LTSC)",
+            "grid": "", "notes": "", "floor_id": floors[i % n_floors]["id"],
+            "category": A.CATEGORIES[i % len(A.CATEGORIES)],
+            "check": "tcp", "tcp_port": targets.blackhole_port if dead else rng.choice(targets.ports),
+            "probe_interval_s": 0, "created_at": datetime.utcnow().isoformat(),
+            "last_seen": "", "last_status": "down", "last_rtt_ms": 0, "total_pings": 0, "up_pings": 0,
+            "consec_down": 0, "last_error": "", "operational": rng.random() > 0.05,
+            "x": rng.random(), "y": rng.random(),
+        }
+    return {"floors": floors, "default_floor_id": "main", "machines": machines}
+
+def write_logs(A, st: Dict[str, Any], args, rng: random.Random) -> int:
+    """One CSV per day for the ``args.days`` days before today; returns rows written."""
+    rows = 0
+    step = 86400.0 / max(1, args.rows_per_day)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    machines = list(st["machines"].values())
+    for d in range(args.days, 0, -1):
+        day = today - timedelta(days=d)
+        with A.log_path_for(day).open("w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(A.LOG_HEADER)
+            for k in range(args.rows_per_day):
+                ts = (day + timedelta(seconds=k * step)).isoformat()
+                for m in machines:
+                    ok = rng.random() > 0.03
+                    w.writerow([ts, m["id"], m["name"], m["ip"], m["serial"], "1" if ok else "0",
+                                "up" if ok else "down", rng.randint(1, 40) if ok else 0, "" if ok else "timeout"])
+                    rows += 1
+    return rows
+
+def bench_public(A, args, floor_ids: List[str], revalidate: bool) -> Dict[str, Any]:
+    paths = [f"/api/public/machines?floor_id={fid}" for fid in floor_ids] + \
+            ["/api/public/floors", "/api/public/storage", "/api/public/status"]
+    per_client = max(1, args.requests // args.clients)
+    lat: List[float] = []
+    codes: Dict[int, int] = {}
+    lock = threading.Lock()
+
+    def client(seed: int) -> None:
+        c = A.app.test_client()
+        etags: Dict[str, str] = {}
+        mine, mycodes = [], {}
+        for i in range(per_client):
+            path = paths[(seed + i) % len(paths)]
+            headers = {"If-None-Match": etags[path]} if revalidate and path in etags else {}
+            t0 = time.perf_counter()
+            r = c.get(path, headers=headers)
+            r.get_data()
+            mine.append((time.perf_counter() - t0) * 1000.0)
+            mycodes[r.status_code] = mycodes.get(r.status_code, 0) + 1
+            if r.headers.get("ETag"):
+                etags[path] = r.headers["ETag"]
+        with lock:
+            lat.extend(mine)
+            for k, v in mycodes.items():
+                codes[k] = codes.get(k, 0) + v
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as ex:
+        list(ex.map(client, range(args.clients)))
+    wall = time.perf_counter() - t0
+    return {"clients": args.clients, "requests": len(lat), "wall_s": round(wall, 3),
+            "req_per_s": round(len(lat) / wall, 1) if wall else 0.0,
+            "status": {str(k): v for k, v in sorted(codes.items())}, **summary(lat)}
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--devices", type=int, default=1000, help="synthetic devices (100 to 50000)")
+    ap.add_argument("--days", type=int, default=7, help="days of history logs (1 to 90)")
+    ap.add_argument("--rows-per-day", type=int, default=24, help="log rows per device per day")
+    ap.add_argument("--blackhole-ratio", type=float, default=0.02, help="share of devices probing the blackhole port")
+    ap.add_argument("--listeners", type=int, default=8, help="accepting TCP listeners")
+    ap.add_argument("--clients", type=int, default=8, help="concurrent public-endpoint clients")
+    ap.add_argument("--requests", type=int, default=2000, help="public-endpoint requests in total")
+    ap.add_argument("--history-samples", type=int, default=20, help="devices sampled for /api/history")
+    ap.add_argument("--save-iterations", type=int, default=10)
+    ap.add_argument("--append-rows", type=int, default=20000)
+    ap.add_argument("--sweep-deadline", type=float, default=120.0)
+    ap.add_argument("--skip-sweep", action="store_true")
+    ap.add_argument("--storage", choices=("json", "sqlite"), default="json",
+                    help="STORAGE_BACKEND; sqlite migrates the generated files on load")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--data-dir", help="use this directory instead of a temporary one")
+    ap.add_argument("--out", help="write the JSON here instead of stdout")
+    args = ap.parse_args()
+
+    tmp = Path(args.data_dir or tempfile.mkdtemp(prefix="pc-monitor-bench-"))
+    # app.py picks its data directory at import time.
+    os.environ.update({"XDG_DATA_HOME": str(tmp), "LOCALAPPDATA": str(tmp), "PASSWORD": "bench",
+                       "DISABLE_SCHEDULER": "1", "SLACK_WEBHOOK_URL": "",
+                       "STORAGE_BACKEND": args.storage})
+    if sys.platform == "darwin":
+        os.environ["HOME"] = str(tmp)
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import app as A
+
+    rng = random.Random(args.seed)
+    targets = Listeners(args.listeners)
+    results: Dict[str, Any] = {}
+
+    st = make_fleet(A, args, rng, targets)
+    t0 = time.perf_counter()
+    A.STATE_FILE.write_text(json.dumps(st), encoding="utf-8")
+    results["generate"] = {"state_ms": round((time.perf_counter() - t0) * 1000.0, 1)}
+    t0 = time.perf_counter()
+    results["generate"]["log_rows"] = write_logs(A, st, args, rng)
+    results["generate"]["logs_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    results["generate"]["log_bytes"] = sum(p.stat().st_size for p in A.LOG_DIR.glob("pings-*.csv"))
+
+    results["load_state_ms"] = round(timed(lambda: A.STATE.update(A.load_state())), 3)
+
+    def save() -> None:
+        with A.state_lock:
+            A.save_state(A.STATE)
+    save_ms, write_ms = [], []
+    for _ in range(args.save_iterations):
+        save_ms.append(timed(save))
+        write_ms.append(timed(A.PERSIST.flush))  # the writes the persister thread does off the lock
+    if A.STORE is not None:
+        sizes = {"db_bytes": A.DB_FILE.stat().st_size}
+    else:
+        sizes = {"state_bytes": A.STATE_FILE.stat().st_size,
+                 "probe_bytes": A.PROBE_STATE_FILE.stat().st_size if A.PROBE_STATE_FILE.exists() else 0}
+    results["save_state"] = {**summary(save_ms), "write": summary(write_ms), **sizes}
+
+    sample = list(A.STATE["machines"].values())
+    append_ms: List[float] = []
+    for i in range(args.append_rows):
+        m = sample[i % len(sample)]
+        append_ms.append(timed(lambda: A.append_log(m, True, 5, "")))
+    results["append_log"] = {**summary(append_ms), "flush_ms": round(timed(A.LOG_WRITER.flush), 3),
+                             "rows": args.append_rows}
+
+    c = A.app.test_client()
+    ids = rng.sample(list(A.STATE["machines"]), min(args.history_samples, len(A.STATE["machines"])))
+    def history(mid: str) -> float:
+        return timed(lambda: c.get(f"/api/history/{mid}?days={args.days}").get_data())
+    results["history_csv"] = summary([history(mid) for mid in ids[:max(1, len(ids) // 4)]])
+    if A.STORE is None:
+        results["history_index_build_ms"] = round(timed(A.HISTORY_STORE.backfill), 1)
+    results["history_indexed"] = summary([history(mid) for mid in ids])
+    results["rollup_backfill_ms"] = round(timed(A.ROLLUPS.backfill), 1)
+
+    floor_ids = [f["id"] for f in st["floors"]]
+    results["public_cold"] = bench_public(A, args, floor_ids, revalidate=False)
+    results["public_revalidate"] = bench_public(A, args, floor_ids, revalidate=True)
+
+    if not args.skip_sweep:
+        t0 = time.perf_counter()
+        stats = A.PROBE_ENGINE.sweep(deadline_s=args.sweep_deadline)
+        results["sweep"] = {"wall_ms": round((time.perf_counter() - t0) * 1000.0, 1), **stats}
+
+    doc = {
+        "app_version": A.APP_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started_at": datetime.utcnow().isoformat() + "Z",
+        "params": {k: v for k, v in vars(args).items() if k not in ("out", "data_dir")},
+        "results": results,
+    }
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    A.LOG_WRITER.close()
+    A.PERSIST.flush()
+    if not args.data_dir:
+        import shutil
+        shutil.rmtree(tmp, ignore_errors=True)
+    os._exit(0)  # skip joining the idle probe/job pool threads at exit
+
+if __name__ == "__main__":
+    main()
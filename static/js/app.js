@@ -134,11 +134,53 @@ document.addEventListener("DOMContentLoaded", () => {
     else if (deg===180) mapRot.style.transform = `translate(${scaledW}px,${scaledH}px) rotate(180deg)`;
     else if (deg===270) mapRot.style.transform = `translate(0px,${scaledW}px) rotate(270deg)`;
     zoomLabel && (zoomLabel.textContent = `${Math.round(100*zoom)}% · ${deg}°`);
+    scheduleTiles();
   }
 
+  // Map source: small preview + tile pyramid when the floor has tiles, full image otherwise
+  const mapSrc = f => f?.tiles ? `/map-tiles/${f.tiles.hash}/preview` : "/map-image?floor_id="+encodeURIComponent(f?.id||"")+"&ts="+Date.now();
+
+  // Tile layer: only tiles intersecting the viewport, at the level matching the current zoom
+  const tileLayer=$("#map-tiles"), tileEls=new Map();
+  let tileLevel=-1, tileHash="", tileRaf=0;
+  function clearTiles(){ if (tileLayer) tileLayer.innerHTML=""; tileEls.clear(); tileLevel=-1; tileHash=""; }
+  function scheduleTiles(){ if (!tileRaf) tileRaf=requestAnimationFrame(()=>{ tileRaf=0; renderTiles(); }); }
+  function renderTiles(){
+    const t=currentFloor?.tiles;
+    if (!tileLayer || !t || !scaledW || !scaledH){ clearTiles(); return; }
+    const scale=scaledW/t.width, dpr=window.devicePixelRatio||1;
+    let z=0; while (z<t.max_zoom && Math.ceil(t.width/2**(t.max_zoom-z)) < scaledW*dpr) z++;
+    if (z!==tileLevel || t.hash!==tileHash){ clearTiles(); tileLevel=z; tileHash=t.hash; }
+    const f=2**(t.max_zoom-z), lw=Math.ceil(t.width/f), lh=Math.ceil(t.height/f), span=t.tile*f*scale;
+    // Viewport in map-area coordinates, mapped back through the rotation
+    const wr=canvasWrap.getBoundingClientRect(), ar=mapArea.getBoundingClientRect();
+    const x0=wr.left-ar.left, y0=wr.top-ar.top, x1=wr.right-ar.left, y1=wr.bottom-ar.top;
+    const deg=getRot(currentFloor?.id||"");
+    const unrot=(X,Y)=> deg===90?[Y,scaledH-X] : deg===180?[scaledW-X,scaledH-Y] : deg===270?[scaledW-Y,X] : [X,Y];
+    const pts=[unrot(x0,y0),unrot(x1,y0),unrot(x0,y1),unrot(x1,y1)];
+    const us=pts.map(p=>p[0]), vs=pts.map(p=>p[1]);
+    const tx0=Math.max(0,Math.floor(Math.min(...us)/span)), tx1=Math.min(Math.ceil(lw/t.tile)-1,Math.floor(Math.max(...us)/span));
+    const ty0=Math.max(0,Math.floor(Math.min(...vs)/span)), ty1=Math.min(Math.ceil(lh/t.tile)-1,Math.floor(Math.max(...vs)/span));
+    const want=new Set();
+    for (let ty=ty0; ty<=ty1; ty++) for (let tx=tx0; tx<=tx1; tx++){
+      const key=`${tx}_${ty}`; want.add(key);
+      let img=tileEls.get(key);
+      if (!img){
+        img=document.createElement("img"); img.alt=""; img.decoding="async";
+        img.src=`/map-tiles/${t.hash}/${z}/${tx}/${ty}`;
+        tileLayer.appendChild(img); tileEls.set(key,img);
+      }
+      const w=Math.min(t.tile, lw-tx*t.tile), h=Math.min(t.tile, lh-ty*t.tile);
+      img.style.left=(tx*span)+"px"; img.style.top=(ty*span)+"px";
+      img.style.width=(w*f*scale)+"px"; img.style.height=(h*f*scale)+"px";
+    }
+    tileEls.forEach((img,key)=>{ if (!want.has(key)){ img.remove(); tileEls.delete(key); } });
+  }
+  canvasWrap?.addEventListener("scroll", scheduleTiles);
+
   // Floors
   async function loadFloors(){
-    const r=await fetch("/api/public/floors",{cache:"no-store"}); floors=await r.json();
+    const r=await fetch("/api/public/floors",{cache:"no-cache"}); floors=await r.json();
     if (!floors.length) return;
     const saved=localStorage.getItem("floor_id");
     const pick = floors.find(f=>f.id===saved) || floors.find(f=>f.has_map) || floors.find(f=>f.default) || floors[0];
@@ -178,13 +220,14 @@ document.addEventListener("DOMContentLoaded", () => {
   // Map image + markers
   mapImg?.addEventListener("load", ()=>{
     noMap?.classList.add("hidden");
-    naturalW = mapImg.naturalWidth || 1600;
-    naturalH = mapImg.naturalHeight || 900;
+    const t = currentFloor?.tiles;
+    naturalW = t ? t.width : (mapImg.naturalWidth || 1600);
+    naturalH = t ? t.height : (mapImg.naturalHeight || 900);
     computeFit(); applyZoom(); drawMarkers();
   });
   mapImg?.addEventListener("error", ()=>{
     noMap?.classList.remove("hidden");
-    markers.innerHTML="";
+    markers.innerHTML=""; clearTiles();
   });
 
   async function refreshPublic(){
@@ -196,11 +239,11 @@ document.addEventListener("DOMContentLoaded", () => {
     currentFloor = floors.find(f=>f.id===fid) || floors[0];
     const q = `?floor_id=${encodeURIComponent(fid)}`;
     const [ms, status] = await Promise.all([
-      fetch("/api/public/machines"+q,{cache:"no-store"}).then(r=>r.json()),
+      fetch("/api/public/machines"+q,{cache:"no-cache"}).then(r=>r.json()),
       fetch("/api/public/status",{cache:"no-store"}).then(r=>r.json()).catch(()=>null),
     ]);
     machines=ms;
-    mapImg.src="/map-image"+q+"&ts="+Date.now();
+    mapImg.src=mapSrc(currentFloor);
     lastUpdated && (lastUpdated.textContent=new Date().toLocaleString());
     updateCounts(); forceDrawMarkers(); if (status) startCountdown(status);
   }
@@ -213,10 +256,18 @@ document.addEventListener("DOMContentLoaded", () => {
 
   // Countdown
   let countdownTimer=null;
+  // Probes are scheduled per device, so the badge counts down to the next
+  // due probe; the status itself is refetched at most every 30 s.
   function startCountdown(st){
     if (countdownTimer) clearInterval(countdownTimer);
-    let left=st.seconds_left||0; renderCountdown(left);
-    countdownTimer=setInterval(()=>{ left=Math.max(0,left-1); renderCountdown(left); if(!left){clearInterval(countdownTimer); refreshPublic();}},1000);
+    let left=st.seconds_left||0, refetch=Math.max(left, 30); renderCountdown(left);
+    const f=st.fleet||{};
+    countdownEl && (countdownEl.title = `Scheduled: ${f.scheduled??"—"} · in flight: ${f.in_flight??0} · rechecking: ${f.rechecking??0} · backed off: ${f.backed_off??0} · overdue: ${f.overdue??0}`);
+    countdownTimer=setInterval(()=>{ left=Math.max(0,left-1); refetch--; renderCountdown(left); if(refetch<=0){clearInterval(countdownTimer); liveOk ? refreshStatus() : refreshPublic();}},1000);
+  }
+  async function refreshStatus(){
+    const st=await fetch("/api/public/status",{cache:"no-store"}).then(r=>r.json()).catch(()=>null);
+    if (st) startCountdown(st);
   }
   function renderCountdown(sec){
     countdownEl && (countdownEl.textContent = `${String(Math.floor(sec/60)).padStart(2,"0")}:${String(sec%60).padStart(2,"0")}`);
@@ -257,7 +308,7 @@ document.addEventListener("DOMContentLoaded", () => {
       <div class="tip-row"><span class="k">OS</span><span class="v">${esc(m.os||"")}</span></div>
       <div class="tip-row"><span class="k">IP</span><span class="v">${esc(m.ip||"")}</span></div>
       <div class="tip-row"><span class="k">Serial</span><span class="v">${esc(m.serial||"")}</span></div>
-      <div class="tip-row"><span class="k">RTT</span><span class="v">${m.last_rtt_ms||0} ms</span></div>
+      <div class="tip-row"><span class="k">RTT</span><span class="v">${m.last_rtt_ms||0} ms</span></div>${rttDetail(m)}
       <div class="tip-row"><span class="k">Uptime</span><span class="v">${pct(m.up_pings,m.total_pings)}</span></div>
       <div class="tip-row"><span class="k">Last seen</span><span class="v">${fmt(m.last_seen)}</span></div>`;
     moveTip(ev);
@@ -326,6 +377,10 @@ document.addEventListener("DOMContentLoaded", () => {
     const f = floors.find(x=>x.id===(floorSettingsSel?.value||""));
     const enabled = !!f?.categories_enabled;
     if (floorCategoriesChk) floorCategoriesChk.checked = enabled;
+    const pageIn=$("#floor-page"), dpiIn=$("#floor-dpi");
+    if (pageIn){ pageIn.value = f?.page||1; pageIn.max = f?.pages||1; }
+    if (dpiIn) dpiIn.value = f?.dpi||220;
+    $("#rerender-floor")?.toggleAttribute("disabled", !f?.pages);
     const catSel = $("#m-category");
     if (catSel){ catSel.disabled = !enabled; catSel.title = enabled ? "" : "Enable categories on this floor to assign categories"; }
   }
@@ -366,15 +421,43 @@ document.addEventListener("DOMContentLoaded", () => {
     await loadFloors(); populateFloorSelectors(); populateTableFloorFilter(); refreshPublic(); showToast("Updated");
   });
 
+  // Map rendering runs as a background job; poll it until it settles.
+  async function waitJob(j, verb){
+    let job=j.job||{};
+    while(job.state!=="done" && job.state!=="error"){
+      $("#upload-msg").textContent = `Processing… ${job.progress||0}% (${job.message||"queued"})`;
+      await new Promise(res=>setTimeout(res, 1000));
+      const jr=await fetch(`/api/jobs/${encodeURIComponent(j.job_id)}`);
+      if(!jr.ok){ $("#upload-msg").textContent="Lost track of map job"; return; }
+      job=await jr.json();
+    }
+    $("#upload-msg").textContent = job.state==="done"
+      ? `${verb} (page ${job.result?.page||1}/${job.result?.pages||1}, ${job.result?.dpi||"?"} dpi)`
+      : (job.error||`${verb} failed`);
+    await loadFloors(); populateFloorSelectors(); populateTableFloorFilter(); refreshPublic();
+  }
+
   $("#upload-floor")?.addEventListener("click", async ()=>{
     const file=$("#floor-file")?.files?.[0]; if(!file){ $("#upload-msg").textContent="Choose a PDF"; return; }
     const fid=floorSettingsSel?.value; const fd=new FormData();
     fd.append("file", file, file.name);
     fd.append("floor_id", fid||"");
+    if ($("#floor-page")?.value) fd.append("page", $("#floor-page").value);
+    if ($("#floor-dpi")?.value) fd.append("dpi", $("#floor-dpi").value);
     const r=await fetch("/api/floors/upload",{method:"POST", body:fd});
     const j=await r.json().catch(()=>({}));
-    $("#upload-msg").textContent = r.ok ? `Uploaded (${j.map_type||"?"})` : (j.error||"Upload failed");
-    await loadFloors(); populateTableFloorFilter(); refreshPublic();
+    if(!r.ok){ $("#upload-msg").textContent = j.error||"Upload failed"; return; }
+    await waitJob(j, "Uploaded");
+  });
+
+  // Re-render the stored PDF at another page/DPI without uploading again
+  $("#rerender-floor")?.addEventListener("click", async ()=>{
+    const fid=floorSettingsSel?.value;
+    const body={map_page: Number($("#floor-page")?.value||1), map_dpi: Number($("#floor-dpi")?.value||220)};
+    const r=await fetch("/api/floors/"+encodeURIComponent(fid),{method:"PUT", headers:{"Content-Type":"application/json"}, body:JSON.stringify(body)});
+    const j=await r.json().catch(()=>({}));
+    if(!r.ok){ $("#upload-msg").textContent = j.error||"Re-render failed"; return; }
+    await waitJob(j, "Rendered");
   });
 
   // Export floors (backup)
@@ -479,6 +562,7 @@ document.addEventListener("DOMContentLoaded", () => {
           statusMsg += `Devices: ${devicesJson.total || 0} imported (${devicesJson.upserted || 0} new, ${devicesJson.replaced || 0} replaced)`;
         } else {
           statusMsg += `Devices: ${devicesJson.error || "Failed"}`;
+          (devicesJson.errors||[]).slice(0,5).forEach(e=>{ statusMsg += ` · row ${e.row}: ${e.error}`; });
         }
       }
       
@@ -500,12 +584,62 @@ document.addEventListener("DOMContentLoaded", () => {
     $("#import-backup-file").value = "";
   });
 
+  // Bulk device import (CSV / NDJSON / JSON), streamed to the server as-is
+  $("#bulk-import")?.addEventListener("click", async ()=>{
+    const file=$("#bulk-import-file")?.files?.[0];
+    const msg=$("#bulk-import-msg");
+    if(!file){ msg.textContent="Choose a file"; return; }
+    const fd=new FormData(); fd.append("file", file, file.name);
+    msg.textContent="Importing…";
+    const partial=$("#bulk-import-partial")?.checked ? "?partial=1" : "";
+    const r=await fetch("/api/import/machines"+partial,{method:"POST", body:fd});
+    const j=await r.json().catch(()=>({}));
+    const errs=(j.errors||[]).slice(0,5).map(e=>`row ${e.row}: ${e.error}`).join(" · ");
+    msg.textContent = r.ok
+      ? `${j.total||0} imported (${j.upserted||0} new, ${j.replaced||0} updated)` + (j.error_count ? `, ${j.error_count} skipped — ${errs}` : "")
+      : `${j.error||"Import failed"}${errs ? " — "+errs : ""}`;
+    if (r.ok){
+      $("#bulk-import-file").value="";
+      await loadFloors(); populateFloorSelectors(); populateTableFloorFilter();
+      await loadMachinesTable(); await loadStorageDevices(); await refreshPublic();
+    }
+  });
+
+  // Subnet discovery: responsive hosts land in storage
+  $("#discover")?.addEventListener("click", async ()=>{
+    const msg=$("#discover-msg");
+    const cidr=($("#discover-cidr")?.value||"").trim();
+    if(!cidr){ msg.textContent="Enter a CIDR range"; return; }
+    const r=await fetch("/api/discovery",{method:"POST", headers:{"Content-Type":"application/json"},
+      body:JSON.stringify({cidr, floor_id: floorSettingsSel?.value||""})});
+    const j=await r.json().catch(()=>({}));
+    if(!r.ok){ msg.textContent=j.error||"Discovery failed"; return; }
+    let job=j.job||{};
+    while(job.state!=="done" && job.state!=="error"){
+      msg.textContent=`Scanning… ${job.progress||0}% (${job.message||"queued"})`;
+      await new Promise(res=>setTimeout(res, 500));
+      const jr=await fetch(`/api/jobs/${encodeURIComponent(j.job_id)}`);
+      if(!jr.ok){ msg.textContent="Lost track of discovery job"; return; }
+      job=await jr.json();
+    }
+    const res=job.result||{};
+    msg.textContent = job.state==="done"
+      ? `${res.responsive||0} responding in ${res.elapsed_s}s: ${res.added||0} added to storage, ${res.already_known||0} already known`
+      : (job.error||"Discovery failed");
+    if (job.state==="done" && res.added){ await loadMachinesTable(); await loadStorageDevices(); }
+  });
+
   // Settings — Machines
+  function rttDetail(m){
+    const d=m.last_rtt_detail||{};
+    return Object.keys(d).map(k=>`<div class="tip-row"><span class="k">${esc(k.replace(/_ms$/,"").replace("_"," "))}</span><span class="v">${esc(String(d[k]))}${/_ms$|^\d+$/.test(k)?" ms":""}</span></div>`).join("");
+  }
   function clearForm(){
     $("#m-id").value=""; $("#m-name").value="";
     $("#m-os").value="";
     $("#m-ip").value=""; $("#m-serial").value="";
-    $("#m-notes").value=""; $("#m-tcp").value=""; $("#m-check").value="icmp"; $("#m-pos").textContent="(use Map placement)";
+    $("#m-notes").value=""; $("#m-tcp").value=""; $("#m-interval") && ($("#m-interval").value=""); $("#m-check").value="icmp"; $("#m-pos").textContent="(use Map placement)";
+    fillCheckFields({});
     $("#m-category").value="global";
     if ($("#m-floor")) $("#m-floor").value = currentFloor?.id || floors[0]?.id || "";
     $("#m-non-operational").checked = false;
@@ -534,6 +668,24 @@ document.addEventListener("DOMContentLoaded", () => {
     });
   });
 
+  // Check-type specific editor fields
+  function syncCheckFields(){
+    const check=$("#m-check")?.value||"icmp";
+    $$(".check-multi").forEach(el=>el.style.display = check==="tcp_multi" ? "" : "none");
+    $$(".check-http").forEach(el=>el.style.display = check==="http" ? "" : "none");
+  }
+  function fillCheckFields(m){
+    $("#m-timeout").value = m.check_timeout_ms || "";
+    $("#m-ports").value = (m.tcp_ports||[]).join(", ");
+    $("#m-http-path").value = m.http_path || "";
+    $("#m-http-status").value = m.http_status || "";
+    $("#m-http-match").value = m.http_match || "";
+    $("#m-http-tls").checked = !!m.http_tls;
+    $("#m-http-verify").checked = m.http_verify !== false;
+    syncCheckFields();
+  }
+  $("#m-check")?.addEventListener("change", syncCheckFields);
+
   $("#save-machine")?.addEventListener("click", async ()=>{
     const name=$("#m-name").value.trim();
     const os=$("#m-os").value;
@@ -566,6 +718,14 @@ document.addEventListener("DOMContentLoaded", () => {
       notes: $("#m-notes").value.trim(),
       check,
       tcp_port: +($("#m-tcp").value||0),
+      probe_interval_s: +($("#m-interval")?.value||0),
+      check_timeout_ms: +($("#m-timeout").value||0),
+      tcp_ports: $("#m-ports").value,
+      http_path: $("#m-http-path").value.trim() || "/",
+      http_status: +($("#m-http-status").value||0),
+      http_match: $("#m-http-match").value,
+      http_tls: $("#m-http-tls").checked,
+      http_verify: $("#m-http-verify").checked,
       category: $("#m-category").disabled ? "global" : ($("#m-category").value || "global"),
       floor_id,
       operational: !isNonOperational,
@@ -598,6 +758,54 @@ document.addEventListener("DOMContentLoaded", () => {
     const ms=await fetch("/api/machines").then(r=>r.json()).catch(()=>[]);
     machines=ms; populateMachinesTableRows();
   }
+  // Multi-select in the machines table; bulk actions go through one batch request
+  const selectedIds=new Set();
+  function shownMachines(){
+    return machines.filter(m=>{
+      const catOk = tableCategory==="all" ? true : (m.category||"global")===tableCategory;
+      const floorOk = tableFloorId==="all" ? true : (m.floor_id===tableFloorId);
+      return catOk && floorOk;
+    });
+  }
+  function syncBulkBar(){
+    const known=new Set(machines.map(m=>m.id));
+    [...selectedIds].forEach(id=>{ if(!known.has(id)) selectedIds.delete(id); });
+    $("#bulk-bar")?.classList.toggle("hidden", !selectedIds.size);
+    $("#bulk-count") && ($("#bulk-count").textContent=`${selectedIds.size} selected`);
+    const bf=$("#bulk-floor");
+    if (bf && bf.options.length!==floors.length) bf.innerHTML=floors.map(f=>`<option value="${f.id}">${esc(f.name)}</option>`).join("");
+    const all=$("#sel-all"), shown=shownMachines();
+    if (all) all.checked = shown.length>0 && shown.every(m=>selectedIds.has(m.id));
+  }
+  async function runBatch(ops, okMsg){
+    const r=await fetch("/api/machines/batch",{method:"POST", headers:{"Content-Type":"application/json"}, body:JSON.stringify({ops})});
+    const j=await r.json().catch(()=>({}));
+    if(!r.ok){ showToast(j.error||"Bulk update failed"); return false; }
+    await loadMachinesTable(); await loadStorageDevices(); await refreshPublic(); showToast(okMsg);
+    return true;
+  }
+  $("#sel-all")?.addEventListener("change", ev=>{
+    shownMachines().forEach(m=> ev.target.checked ? selectedIds.add(m.id) : selectedIds.delete(m.id));
+    populateMachinesTableRows();
+  });
+  $("#bulk-move")?.addEventListener("click", ()=>{
+    const fid=$("#bulk-floor")?.value; if(!fid) return;
+    // Positions belong to the old floor plan, so moved devices need placing again.
+    runBatch([...selectedIds].map(id=>({op:"position", id, x:null, y:null, floor_id:fid})), "Devices moved");
+  });
+  $("#bulk-set-category")?.addEventListener("click", ()=>{
+    const category=$("#bulk-category")?.value||"global";
+    runBatch([...selectedIds].map(id=>({op:"update", id, category})), "Category updated");
+  });
+  $("#bulk-storage")?.addEventListener("click", ()=>
+    runBatch([...selectedIds].map(id=>({op:"update", id, operational:false})), "Devices moved to storage"));
+  $("#bulk-operational")?.addEventListener("click", ()=>
+    runBatch([...selectedIds].map(id=>({op:"update", id, operational:true})), "Devices moved to operational"));
+  $("#bulk-delete")?.addEventListener("click", async ()=>{
+    if(!confirm(`Delete ${selectedIds.size} machines?`)) return;
+    await runBatch([...selectedIds].map(id=>({op:"delete", id})), "Machines deleted");
+  });
+
   function populateMachinesTableRows(){
     const tb=$("#list tbody"); if (!tb) return; tb.innerHTML="";
     machines
@@ -614,6 +822,7 @@ document.addEventListener("DOMContentLoaded", () => {
         const toggleLabel = operational ? "To Storage" : "To Operational";
         const tr=document.createElement("tr");
         tr.innerHTML=`
+          <td><input type="checkbox" class="row-sel" data-id="${m.id}" ${selectedIds.has(m.id)?"checked":""}/></td>
           <td>${esc((CAT_LABEL[m.category||"global"])||"Global")}</td>
           <td>${esc(m.name||"")}</td>
           <td>${esc(m.os||"")}</td>
@@ -631,6 +840,11 @@ document.addEventListener("DOMContentLoaded", () => {
           </td>`;
         tb.appendChild(tr);
       });
+    tb.querySelectorAll(".row-sel").forEach(cb=>cb.addEventListener("change", ()=>{
+      cb.checked ? selectedIds.add(cb.dataset.id) : selectedIds.delete(cb.dataset.id);
+      syncBulkBar();
+    }));
+    syncBulkBar();
     tb.querySelectorAll("button").forEach(b=>{
       b.addEventListener("click", async ()=>{
         const id=b.dataset.id, act=b.dataset.act, m=machines.find(x=>x.id===id);
@@ -657,6 +871,8 @@ document.addEventListener("DOMContentLoaded", () => {
           if ($("#m-floor")) $("#m-floor").value = m.floor_id || currentFloor?.id || "";
           $("#m-check").value = m.check || "icmp";
           $("#m-tcp").value = m.tcp_port || "";
+          $("#m-interval") && ($("#m-interval").value = m.probe_interval_s || "");
+          fillCheckFields(m);
           $("#m-non-operational").checked = !m.operational;
           $("#m-pos").textContent = (typeof m.x==="number"&&typeof m.y==="number") ? `x:${m.x.toFixed(3)}, y:${m.y.toFixed(3)}` : "(use Map placement)";
           placement={mid:m.id,x:m.x,y:m.y,floor_id:m.floor_id};
@@ -798,10 +1014,52 @@ document.addEventListener("DOMContentLoaded", () => {
       setTimeout(validateStorageForm, 0);
     }
   }
-  function startAutoRefresh(){ if(timer) clearInterval(timer); const secs=+($("#refresh-interval")?.value||60); timer=setInterval(refreshPublic, secs*1000); }
+  function startAutoRefresh(){ if(timer) clearInterval(timer); timer=null; if(liveOk) return; const secs=+($("#refresh-interval")?.value||60); timer=setInterval(refreshPublic, secs*1000); }
   $("#refresh-interval")?.addEventListener("change", startAutoRefresh);
   $("#refresh")?.addEventListener("click", refreshPublic);
 
+  // Live updates via Server-Sent Events; polling above is only the fallback
+  let live=null, liveOk=false, liveFails=0;
+  const allMachines=new Map();
+  function applyLive(){
+    const all=[...allMachines.values()];
+    storageDevices = all.filter(m=>m.operational===false);
+    renderStorageDevices();
+    if (!$("#tab-map")?.classList.contains("active") || !currentFloor) return;
+    machines = all.filter(m=>m.operational!==false && m.floor_id===currentFloor.id);
+    lastUpdated && (lastUpdated.textContent=new Date().toLocaleString());
+    updateCounts(); drawMarkers();
+  }
+  function applyFloors(list){
+    if (JSON.stringify(list)===JSON.stringify(floors)) return;
+    floors=list;
+    if (!floors.length) return;
+    currentFloor = floors.find(f=>f.id===currentFloor?.id) || floors.find(f=>f.default) || floors[0];
+    if (floorSel){ floorSel.innerHTML=floors.map(f=>`<option value="${f.id}">${esc(f.name)}</option>`).join(""); floorSel.value=currentFloor.id; }
+    renderCategoryBar();
+    mapImg.src=mapSrc(currentFloor);
+  }
+  function startLive(){
+    if (!window.EventSource) return;
+    live = new EventSource("/api/public/events");
+    live.addEventListener("open", ()=>{ liveOk=true; liveFails=0; if(timer){ clearInterval(timer); timer=null; } });
+    live.addEventListener("snapshot", ev=>{
+      const d=JSON.parse(ev.data);
+      allMachines.clear(); d.machines.forEach(m=>allMachines.set(m.id,m));
+      applyFloors(d.floors); applyLive();
+    });
+    live.addEventListener("machines", ev=>{
+      const d=JSON.parse(ev.data);
+      d.upsert.forEach(m=>allMachines.set(m.id,m)); d.delete.forEach(id=>allMachines.delete(id));
+      applyLive();
+    });
+    live.addEventListener("floors", ev=> applyFloors(JSON.parse(ev.data)));
+    live.addEventListener("error", ()=>{
+      liveOk=false;
+      if ((++liveFails>=3 || live.readyState===EventSource.CLOSED) && !timer) startAutoRefresh();
+    });
+  }
+
   // Credits hover
   const creditWrap = $(".credit-wrap");
   creditWrap?.addEventListener("mouseenter", ()=> $("#credit-tip")?.classList.add("show"));
@@ -853,7 +1111,7 @@ document.addEventListener("DOMContentLoaded", () => {
   // Load storage devices
   async function loadStorageDevices(){
     try {
-      const r = await fetch("/api/public/storage", {cache:"no-store"});
+      const r = await fetch("/api/public/storage", {cache:"no-cache"});
       storageDevices = await r.json();
       renderStorageDevices();
     } catch(e){
@@ -1139,5 +1397,6 @@ document.addEventListener("DOMContentLoaded", () => {
     await checkAuth(); 
     validateStorageForm(); // Initialize form validation state
     startAutoRefresh(); 
+    startLive();
   })();
 });
\ No newline at end of file
@@ -0,0 +1,24 @@
+"""Point the app at a throwaway data directory before any test imports it."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+os.environ["XDG_DATA_HOME"] = tempfile.mkdtemp(prefix="pcmon-test-")
+os.environ["PASSWORD"] = "pw"
+os.environ["DISABLE_SCHEDULER"] = "1"
+os.environ["PROBE_BACKEND"] = "subprocess"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def logged_in():
+    """A logged-in test client over freshly loaded state."""
+    import app as A
+    if not A.STATE:
+        A.STATE.update(A.load_state())
+    c = A.app.test_client()
+    assert c.post("/api/login", json={"password": "pw"}).status_code == 204
+    return c
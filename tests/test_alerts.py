@@ -0,0 +1,120 @@
+"""AlertDispatcher against a local webhook stub: batching, retry/backoff and flap damping."""
+import http.server
+import json
+import threading
+import time
+
+import pytest
+
+import app as A
+
+
+class Stub(http.server.ThreadingHTTPServer):
+    """Records posted texts; answers with queued (status, headers) replies, then 200."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.texts, self.replies = [], []
+        self.posted = threading.Event()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/hook"
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        status, headers = self.server.replies.pop(0) if self.server.replies else (200, {})
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.server.texts.append((status, body["text"]))
+        if status < 400:
+            self.server.posted.set()
+
+    def log_message(self, *a):
+        pass
+
+
+@pytest.fixture
+def stub():
+    srv = Stub()
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+
+
+def dev(i, status="down"):
+    return {"id": f"dev-{i}", "name": f"pc{i}", "ip": f"192.0.2.{i}", "os": "", "last_rtt_ms": 3,
+            "last_status": status, "consec_down": A.ALERT_DOWN_AFTER if status == "down" else 0}
+
+
+def event(i):
+    return {"status": "down", "id": f"dev-{i}", "name": f"pc{i}", "ip": f"192.0.2.{i}", "os": "", "rtt_ms": 0,
+            "at": time.monotonic()}
+
+
+def test_events_in_one_window_become_one_digest(stub):
+    d = A.AlertDispatcher(stub.url, 0.3, 0, 100)
+    for i in range(3):
+        d.observe(dev(i), 0)
+    assert stub.posted.wait(5)
+    time.sleep(0.2)
+    assert [t for _, t in stub.texts] == [f"[{A.APP_NAME}] 3 DOWN, 0 UP\nDOWN: pc0 (192.0.2.0)\n"
+                                          "DOWN: pc1 (192.0.2.1)\nDOWN: pc2 (192.0.2.2)"]
+    assert d.stats()["delivered"] == 3
+
+
+def test_retries_with_backoff_and_retry_after(stub, monkeypatch):
+    delays = []
+    monkeypatch.setattr(A.time, "sleep", delays.append)
+    stub.replies = [(503, {}), (429, {"Retry-After": "7"}), (500, {})]
+    d = A.AlertDispatcher(stub.url, 0, 4, 100)
+    d._session = A.requests.Session()
+    d._deliver([event(1)])
+    assert [s for s, _ in stub.texts] == [503, 429, 500, 200]
+    assert delays == [1, 7, 4]
+    st = d.stats()
+    assert (st["retries"], st["delivered"], st["failed"]) == (3, 1, 0)
+
+
+def test_rejected_post_is_not_retried(stub, monkeypatch):
+    monkeypatch.setattr(A.time, "sleep", lambda s: None)
+    stub.replies = [(400, {})]
+    d = A.AlertDispatcher(stub.url, 0, 4, 100)
+    d._session = A.requests.Session()
+    d._deliver([event(1)])
+    assert len(stub.texts) == 1
+    assert d.stats()["failed"] == 1
+
+
+def test_down_then_up_within_a_window_posts_nothing(stub):
+    d = A.AlertDispatcher(stub.url, 0.3, 0, 100)
+    for i in range(3):
+        d.observe(dev(i), 0)
+    d.observe(dev(0, "up"), A.ALERT_DOWN_AFTER)
+    assert stub.posted.wait(5)
+    time.sleep(0.2)
+    assert [t for _, t in stub.texts] == [f"[{A.APP_NAME}] 2 DOWN, 0 UP\nDOWN: pc1 (192.0.2.1)\nDOWN: pc2 (192.0.2.2)"]
+    assert d.stats()["suppressed"] == 2
+
+
+def test_up_is_sent_only_after_its_down_was_delivered(stub):
+    d = A.AlertDispatcher(stub.url, 0.2, 0, 100)
+    d.observe(dev(5), 0)
+    assert stub.posted.wait(5)
+    stub.posted.clear()
+    d.observe(dev(5, "up"), A.ALERT_DOWN_AFTER)
+    assert stub.posted.wait(5)
+    assert [t.splitlines()[0] for _, t in stub.texts] == [f"[{A.APP_NAME}] pc5 is DOWN", f"[{A.APP_NAME}] pc5 is UP"]
+
+    # A DOWN that never got through means its recovery is not reported either.
+    stub.replies = [(400, {})]
+    stub.posted.clear()
+    d.observe(dev(6), 0)
+    time.sleep(0.5)
+    d.observe(dev(6, "up"), A.ALERT_DOWN_AFTER)
+    time.sleep(0.5)
+    assert [s for s, _ in stub.texts][2:] == [400]
+    assert d.stats()["suppressed"] == 1
@@ -0,0 +1,39 @@
+"""iter_json_array must find the top-level "machines" array of an export object, whatever surrounds it."""
+import io
+import json
+
+import pytest
+
+import app as A
+
+DEVICES = [{"id": "m1", "name": "machines", "ip": "192.0.2.1"}, {"id": "m2", "name": "b", "ip": "192.0.2.2"}]
+
+
+def parse(doc, chunk):
+    return list(A.iter_json_array(io.StringIO(json.dumps(doc)), chunk))
+
+
+@pytest.mark.parametrize("chunk", [1, 7, 64, 1 << 16])
+def test_floors_before_machines_and_named_machines(chunk):
+    doc = {"version": 20251113, "floors": [{"id": "machines", "name": "machines", "note": "\"machines\": ["}],
+           "default": {"machines": [{"id": "nested"}]}, "machines": DEVICES, "exported_at": "x"}
+    assert parse(doc, chunk) == DEVICES
+
+
+@pytest.mark.parametrize("chunk", [1, 5, 1 << 16])
+def test_bare_array_and_missing_key(chunk):
+    assert parse(DEVICES, chunk) == DEVICES
+    with pytest.raises(ValueError):
+        parse({"floors": [{"id": "machines"}]}, chunk)
+    with pytest.raises(ValueError):
+        parse({"machines": {"id": "m1"}}, chunk)
+
+
+def test_import_with_a_floor_named_machines(logged_in):
+    c = logged_in
+    doc = {"floors": [{"id": "machines", "name": "machines"}], "machines": DEVICES}
+    r = c.post("/api/import/machines", data=json.dumps(doc), content_type="application/json")
+    assert r.status_code == 200, r.get_json()
+    assert r.get_json()["total"] == 2
+    with A.state_lock:
+        assert A.STATE["machines"]["m1"]["name"] == "machines"
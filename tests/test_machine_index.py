@@ -0,0 +1,122 @@
+"""INDEX (floor / category / storage indexes) must always match a full scan of STATE["machines"]."""
+import pytest
+
+import app as A
+
+
+def scan():
+    floors, cats, storage = {}, {}, set()
+    with A.state_lock:
+        for mid, m in A.STATE["machines"].items():
+            floors.setdefault(m.get("floor_id") or "", set()).add(mid)
+            cats.setdefault(m.get("category") or "global", set()).add(mid)
+            if not m.get("operational", True):
+                storage.add(mid)
+    return floors, cats, storage
+
+
+def assert_index_matches():
+    floors, cats, storage = scan()
+    with A.state_lock:
+        assert {k: set(v) for k, v in A.INDEX.by_floor.items()} == floors
+        assert {k: set(v) for k, v in A.INDEX.by_category.items()} == cats
+        assert set(A.INDEX.storage) == storage
+
+
+@pytest.fixture(scope="module")
+def client():
+    A.STATE.clear()
+    A.STATE.update(A.load_state())
+    c = A.app.test_client()
+    assert c.post("/api/login", json={"password": "pw"}).status_code == 204
+    assert c.post("/api/floors", json={"id": "f2", "name": "Floor 2"}).status_code == 200
+    return c
+
+
+def create(c, **fields):
+    r = c.post("/api/machines", json={"ip": "192.0.2.1", **fields})
+    assert r.status_code == 200, r.get_json()
+    return r.get_json()["id"]
+
+
+def category(mid):
+    with A.state_lock:
+        return A.STATE["machines"][mid]["category"]
+
+
+def test_create(client):
+    mid = create(client, name="a", category="apple")
+    create(client, name="b", floor_id="f2", operational=False)
+    assert category(mid) == "apple"
+    assert_index_matches()
+
+
+def test_update(client):
+    mid = create(client, name="c", category="dzb")
+    for body in ({"floor_id": "f2"}, {"category": "brightsign"}, {"operational": False},
+                 {"operational": True, "floor_id": "main", "category": "apple"}):
+        assert client.put(f"/api/machines/{mid}", json=body).status_code == 200
+        if "category" in body:
+            assert category(mid) == body["category"]
+        assert_index_matches()
+    with A.state_lock:
+        assert mid in A.INDEX.by_category["apple"]
+        assert mid not in A.INDEX.by_category.get("dzb", {})
+        assert mid not in A.INDEX.by_category.get("brightsign", {})
+
+
+def test_delete(client):
+    mid = create(client, name="d", floor_id="f2", category="brightsign", operational=False)
+    assert client.delete(f"/api/machines/{mid}").status_code == 204
+    assert_index_matches()
+    with A.state_lock:
+        assert mid not in A.INDEX.storage
+
+
+def test_batch(client):
+    keep, drop = create(client, name="e", category="apple"), create(client, name="f", category="dzb")
+    r = client.post("/api/machines/batch", json={"ops": [
+        {"op": "create", "name": "g", "ip": "192.0.2.7", "floor_id": "f2", "category": "dzb"},
+        {"op": "update", "id": keep, "category": "brightsign", "operational": False},
+        {"op": "delete", "id": drop},
+        {"op": "position", "id": keep, "x": None, "y": None, "floor_id": "f2"},
+    ]})
+    assert r.status_code == 200, r.get_json()
+    assert category(keep) == "brightsign"
+    assert_index_matches()
+
+
+def test_rejected_batch_leaves_index_alone(client):
+    before = scan()
+    r = client.post("/api/machines/batch", json={"ops": [
+        {"op": "create", "name": "h", "ip": "192.0.2.8"},
+        {"op": "delete", "id": "no-such-device"},
+    ]})
+    assert r.status_code == 400
+    assert scan() == before
+    assert_index_matches()
+
+
+def test_import(client):
+    existing = create(client, name="i", category="apple")
+    csv = ("id,name,ip,floor_id,category,operational\n"
+           f"{existing},moved,192.0.2.9,f2,dzb,false\n"
+           "imp-1,new,192.0.2.10,main,brightsign,true\n")
+    r = client.post("/api/import/machines?format=csv", data=csv, content_type="text/csv")
+    assert r.status_code == 200, r.get_json()
+    assert category(existing) == "dzb"
+    assert category("imp-1") == "brightsign"
+    assert_index_matches()
+
+
+def test_load_state(client):
+    A.PERSIST.flush()
+    with A.state_lock:
+        expected = set(A.STATE["machines"])
+        A.INDEX.rebuild({})
+    st = A.load_state()
+    with A.state_lock:
+        A.STATE.clear()
+        A.STATE.update(st)
+    assert set(A.STATE["machines"]) == expected
+    assert_index_matches()
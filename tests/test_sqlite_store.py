@@ -0,0 +1,46 @@
+"""SqliteStore sets its schema up once and reuses a bounded set of connections across threads."""
+import threading
+from datetime import datetime, timedelta
+
+import app as A
+
+
+def test_connections_are_pooled_across_threads(tmp_path, monkeypatch):
+    store = A.SqliteStore(tmp_path / "t.db")
+    opened = []
+    real_open = store._open
+    monkeypatch.setattr(store, "_open", lambda: opened.append(1) or real_open())
+    now = datetime.utcnow()
+    store.append_results([(now - timedelta(seconds=i), "m1", True, "up", 3, "") for i in range(5)])
+
+    def read():
+        assert len(store.history("m1", now - timedelta(hours=1), now + timedelta(seconds=1), "raw")) == 5
+    for _ in range(20):
+        t = threading.Thread(target=read)
+        t.start()
+        t.join()
+    assert opened == []
+    assert len(store._pool) == 1
+
+    barrier = threading.Barrier(8)
+    def hold():
+        with store.conn():
+            barrier.wait(5)
+    threads = [threading.Thread(target=hold) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(opened) == 7
+    assert len(store._pool) == store.POOL_SIZE
+
+
+def test_abandoned_export_returns_its_connection(tmp_path):
+    store = A.SqliteStore(tmp_path / "t.db")
+    now = datetime.utcnow()
+    store.append_results([(now - timedelta(seconds=i), "m1", True, "up", 3, "") for i in range(3)])
+    rows = store.iter_results(now - timedelta(hours=1), now + timedelta(seconds=1))
+    next(rows)
+    assert store._pool == []
+    rows.close()
+    assert len(store._pool) == 1